@@ -205,6 +205,29 @@ export async function getTaskStatus(taskId) {
     return axios.get(`${BASE_URL}/task_status/${taskId}`);
 }
 
+// 订阅任务状态推送（SSE），替代轮询 getTaskStatus
+// onStatus 收到与 /task_status 相同字段的状态对象（另带 event: snapshot/queued/started/progress/completed/failed/requeued），
+// 任务完成或失败后自动关闭；断线时浏览器按 Last-Event-ID 自动续传。返回 { close }
+export function watchTask(taskId, onStatus, onError) {
+    const token = localStorage.getItem('access_token')
+    const query = token ? `?access_token=${encodeURIComponent(token)}` : ''
+    const source = new EventSource(`${BASE_URL}/task_events/${taskId}${query}`)
+    source.onmessage = e => {
+        const status = JSON.parse(e.data)
+        if (status.status === 'completed' || status.status === 'failed' || status.status === 'not_found') {
+            source.close()
+        }
+        onStatus(status)
+    }
+    source.onerror = e => {
+        // CONNECTING 时浏览器会自动重连，只有连接被关闭（例如 401）时才交给调用方
+        if (source.readyState === EventSource.CLOSED && onError) {
+            onError(e)
+        }
+    }
+    return { close: () => source.close() }
+}
+
 // 列出所有任务
 export async function listTasks() {
     return axios.get(`${BASE_URL}/list_tasks`);
@@ -0,0 +1,146 @@
+import os
+import math
+import threading
+
+try:
+    import psutil  # optional: 按实际可用内存再做一次检查
+except ImportError:
+    psutil = None
+
+
+def _default_mem_budget_mb():
+    if psutil is not None:
+        return int(psutil.virtual_memory().total / 1024 / 1024 * 0.5)
+    return 8192
+
+
+# 每个 worker 进程同时运行的任务共享的资源预算：内存（MB，不含常驻模型，默认物理内存的一半）与 CPU 核数。
+# 排在队首的任务估算成本放不进剩余预算时继续排队，不会同时启动一批任务把内存打满。
+WORKER_MEM_BUDGET_MB = int(os.environ.get("IDOCTOR_WORKER_MEM_MB", "0")) or _default_mem_budget_mb()
+WORKER_CPU_BUDGET = int(os.environ.get("IDOCTOR_WORKER_CPUS", "0")) or (os.cpu_count() or 1)
+# 单个任务与体数据无关的固定开销（nnUNet 预处理 / 滑窗推理缓冲、Mask R-CNN 推理等）
+JOB_BASE_MEM_MB = int(os.environ.get("IDOCTOR_JOB_BASE_MEM_MB", "1536"))
+# 单个任务的基础 CPU 占用（解码线程池 + torch 推理线程）
+JOB_BASE_CPUS = int(os.environ.get("IDOCTOR_JOB_CPUS", "2"))
+
+# 体数据按 float32 估算（斜率/截距非整数时 volume 即为 float32）；
+# main 需要完整体数据 + 解码 / 矢状面重排时的临时副本，l3_detect 需要完整体数据生成矢状面，
+# continue_after_l3 只解码 L3 范围内的少量切片
+_VOLUME_FACTOR = {"main": 2.0, "l3_detect": 1.0, "continue_after_l3": 0.25}
+# 每多 500 张切片多占一个核（解码线程池在大序列上更长时间满载）
+_SLICES_PER_EXTRA_CPU = 500
+_DEFAULT_SHAPE = (512, 512)
+
+
+def estimate_cost(kind, slices, rows=None, columns=None):
+    """按切片数与尺寸估算任务成本 {"mem_mb", "cpus"}"""
+    rows, columns = rows or _DEFAULT_SHAPE[0], columns or _DEFAULT_SHAPE[1]
+    volume_mb = slices * rows * columns * 4 / 1024 / 1024
+    mem_mb = JOB_BASE_MEM_MB + volume_mb * _VOLUME_FACTOR.get(kind, 1.0)
+    cpus = JOB_BASE_CPUS + (slices // _SLICES_PER_EXTRA_CPU if kind == "main" else 0)
+    return {"mem_mb": int(math.ceil(mem_mb)), "cpus": int(cpus), "slices": int(slices),
+            "shape": [int(rows), int(columns)]}
+
+
+# worker 交互通道（只领取 L3 检测）自己的小预算，在 IDOCTOR_WORKER_MEM_MB / IDOCTOR_WORKER_CPUS 之外另计：
+# 默认约为一次 1000 张 512x512 序列的 L3 检测，多个交互线程共用，放不下时排队
+INTERACTIVE_MEM_BUDGET_MB = (int(os.environ.get("IDOCTOR_INTERACTIVE_MEM_MB", "0"))
+                             or estimate_cost("l3_detect", 1000)["mem_mb"])
+INTERACTIVE_CPU_BUDGET = int(os.environ.get("IDOCTOR_INTERACTIVE_CPUS", "0")) or JOB_BASE_CPUS
+
+
+def estimate_job_cost(kind, input_folder):
+    """优先使用上传时写出的 series_index.json（主序列张数与尺寸），没有索引时按文件数 + 512x512 估算"""
+    from series_index import read_series_index, is_dicom_name
+    index = read_series_index(os.path.dirname(os.path.abspath(input_folder)))
+    if index and index.get("selected_series"):
+        selected = next((s for s in index["series"] if s["series_instance_uid"] == index["selected_series"]), None)
+        if selected is not None:
+            rows, columns = max(selected["shapes"], key=lambda s: s[0] * s[1]) if selected["shapes"] else (None, None)
+            return estimate_cost(kind, selected["count"], rows, columns)
+    try:
+        count = sum(1 for f in os.listdir(input_folder) if is_dicom_name(f))
+    except OSError:
+        count = 0
+    return estimate_cost(kind, count)
+
+
+class AdmissionController:
+    """进程内的资源记账：try_admit 预留任务成本，任务结束后 release 归还
+
+    - 没有运行中的任务时总是放行（否则超出整个预算的大任务永远无法执行）
+    - 安装了 psutil 时，还要求系统当前可用内存放得下该任务
+    """
+
+    def __init__(self, mem_budget_mb=WORKER_MEM_BUDGET_MB, cpu_budget=WORKER_CPU_BUDGET):
+        self.mem_budget_mb = mem_budget_mb
+        self.cpu_budget = cpu_budget
+        self._running = {}
+        self._lock = threading.Lock()
+        self.blocked = None   # (job_id, 原因)：最近一次因资源不足未放行的任务
+        self.noted = None     # 已写到队列任务提示中的 blocked，避免重复写库
+
+    def _cost(self, job):
+        cost = job.get("cost")
+        if not cost:
+            cost = estimate_job_cost(job["kind"], (job.get("payload") or {}).get("input_folder", ""))
+        return cost
+
+    def used(self):
+        with self._lock:
+            return (sum(c["mem_mb"] for c in self._running.values()),
+                    sum(c["cpus"] for c in self._running.values()))
+
+    def try_admit(self, job):
+        cost = self._cost(job)
+        with self._lock:
+            if self._running:
+                mem = sum(c["mem_mb"] for c in self._running.values())
+                cpus = sum(c["cpus"] for c in self._running.values())
+                reason = None
+                if mem + cost["mem_mb"] > self.mem_budget_mb:
+                    reason = f"等待内存: 需要 {cost['mem_mb']} MB，预算剩余 {self.mem_budget_mb - mem} MB"
+                elif cpus + cost["cpus"] > self.cpu_budget:
+                    reason = f"等待 CPU: 需要 {cost['cpus']} 核，预算剩余 {self.cpu_budget - cpus} 核"
+                elif psutil is not None:
+                    available = psutil.virtual_memory().available / 1024 / 1024
+                    if available < cost["mem_mb"]:
+                        reason = f"等待内存: 需要 {cost['mem_mb']} MB，系统可用 {int(available)} MB"
+                if reason is not None:
+                    self.blocked = (job["id"], reason)
+                    return False
+            self._running[job["id"]] = cost
+            self.blocked = None
+            return True
+
+    def release(self, job_id):
+        with self._lock:
+            self._running.pop(job_id, None)
+
+    def snapshot(self):
+        mem, cpus = self.used()
+        return {"mem_budget_mb": self.mem_budget_mb, "cpu_budget": self.cpu_budget,
+                "mem_used_mb": mem, "cpus_used": cpus, "running": len(self._running)}
+
+
+_CONTROLLER = None
+_INTERACTIVE_CONTROLLER = None
+_CONTROLLER_LOCK = threading.Lock()
+
+
+def get_admission_controller():
+    """进程级共享：同一进程内的所有 worker 线程共用一份预算"""
+    global _CONTROLLER
+    with _CONTROLLER_LOCK:
+        if _CONTROLLER is None:
+            _CONTROLLER = AdmissionController()
+        return _CONTROLLER
+
+
+def get_interactive_admission_controller():
+    """进程级共享的交互通道预算（INTERACTIVE_MEM_BUDGET_MB / INTERACTIVE_CPU_BUDGET）"""
+    global _INTERACTIVE_CONTROLLER
+    with _CONTROLLER_LOCK:
+        if _INTERACTIVE_CONTROLLER is None:
+            _INTERACTIVE_CONTROLLER = AdmissionController(INTERACTIVE_MEM_BUDGET_MB, INTERACTIVE_CPU_BUDGET)
+        return _INTERACTIVE_CONTROLLER
@@ -1,33 +1,361 @@
-try:
-    import SimpleITK as sitk
-except ImportError:
-    print("SimpleITK not found. Please install it with: pip install SimpleITK")
-    import sys
-    sys.exit(1)
 import cv2
 import os
 import numpy as np
 import torch
 import multiprocessing as mp
+import json
+import csv
+import shutil
 from datetime import datetime
 from pipeline_logging import write_log, log_section
-from sagit_save import resize_and_save_sagittal_as_dicom, dicom_to_balanced_png, overlay_and_save, clean_mask_folder
-from verseg import process_spine_and_vertebrae
+from sagit_save import sagittal_to_balanced_png, overlay_and_save, clean_mask_folder
+from verseg import process_spine_and_vertebrae, WHOLE_WEIGHTS, VERTEBRA_WEIGHTS, VERSEG_QUANTIZE
 from extract_slice import load_mask, extract_axial_slices_from_sagittal_mask, reversedNumber, convert_selected_slices
 
 from extract_slice import load_mask, extract_axial_slices_from_sagittal_mask,convert_selected_slices
-from extract_slice import convert_selected_slices_by_z_index
+from extract_slice import convert_selected_slices_by_z_index, export_selected_slices_by_z_index
 
-from seg import run_nnunet_predict_and_overlay
-from compute import process_all
+from seg import run_nnunet_predict_and_overlay, predict_slice_stack_multi, save_label_pngs, resolve_checkpoint
+from compute import process_all, compute_manual_middle_statistics
+from inference_profiles import resolve_profile
+from inference_progress import staged
+from seg_backends import resolve_backend
+from seg_cache import model_fingerprint, inference_variant
+from dicom_series import open_series, index_series, input_signature
+from pipeline_graph import Stage, PipelineGraph, StageRunner, hash_files, file_signature, invalidate_stages
 
 SAGITTAL_BASE = "sagittal_midResize"
 SAGITTAL_INPUT = SAGITTAL_BASE + "_0000.png"   # nnUNet 输入文件
 SAGITTAL_CLEAN = SAGITTAL_BASE + ".png"        # 前端&手动标注&最终mask统一文件
 
+# 肌肉分割推理方式：memory = 切片数组直接送入 nnUNet（默认），files = 旧的 PNG 目录 + predict_from_files
+SEG_MODE = os.environ.get("IDOCTOR_SEG_MODE", "memory")
+# 内存推理时是否仍把 mask 写到 major_mask / full_mask（供 collect_middle_results 等脚本使用）
+SAVE_SEG_MASKS = os.environ.get("IDOCTOR_SAVE_SEG_MASKS", "1") not in ("0", "false", "False")
+INFERENCE_META = "inference_meta.json"
+# 是否额外导出拉伸后的矢状面 DICOM（写到病例输出目录，不参与推理）
+EXPORT_SAGITTAL_DICOM = os.environ.get("IDOCTOR_EXPORT_SAGITTAL_DICOM", "0") not in ("0", "false", "False")
+AXIAL_SELECTION = "axial_selection.json"
 
-def main(input_folder, output_folder):
-    log_section(output_folder, f"MAIN START input={input_folder}")
+FULL_MODEL = ("nnUNet_results/Dataset001_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d", "checkpoint_final.pth")
+MAJOR_MODEL = ("nnUNet_results/Dataset002_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d", "checkpoint_final.pth")
+PROCESS_ALL_PARAMS = dict(area_thresh=1000, area_ratio_thresh=0.05, morph_ksize=3, morph_iters=1, overlay_alpha=0.5)
+
+
+def _sagittal_dicom_export_path(output_folder):
+    return os.path.join(output_folder, SAGITTAL_BASE + ".dcm") if EXPORT_SAGITTAL_DICOM else None
+
+
+def _pngs(folder):
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith(".png")]
+
+
+# ======================= 阶段图（内存推理模式） =======================
+# load → sagittal → vertebra → l3_clean → axial_select → psoas_seg / full_seg → metrics
+# 每个阶段的输入指纹与产物记录在 output/.stages.json（见 pipeline_graph），输入未变且产物未被改动的阶段直接跳过：
+# 上传手动 L3 mask 只重跑 l3_clean 及之后，上传中间张手动 mask 只重跑 metrics。
+
+class CaseContext:
+    """单个病例一次运行内共享的状态：目录、已打开的 DicomSeries、分割结果"""
+
+    def __init__(self, input_folder, output_folder, profile=None, progress=None):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.profile = profile
+        self.progress = progress
+        self.runner = None
+        self._series = {}
+        self._labels = None
+        self._backends = {}
+
+    def path(self, *parts):
+        return os.path.join(self.output_folder, *parts)
+
+    def series(self, kind="index"):
+        """kind = full（完整体数据，矢状面需要）/ index（头信息索引或体数据缓存）；已有完整体数据时两者共用"""
+        if "full" in self._series:
+            return self._series["full"]
+        if kind not in self._series:
+            if kind == "full":
+                self._series[kind] = open_series(self.input_folder, log_root=self.output_folder)
+            else:
+                self._series[kind] = index_series(self.input_folder, log_root=self.output_folder)
+        return self._series[kind]
+
+    def seg_labels(self):
+        """腰大肌 + 全肌肉一次推理（同一切片栈只预处理一次），psoas_seg / full_seg 共用"""
+        if self._labels is None:
+            selection = self.runner.value("axial_select")
+            write_log(self.output_folder, f"SEG_MEMORY nnUNet start psoas={MAJOR_MODEL[0]} full={FULL_MODEL[0]}")
+            self._labels = predict_slice_stack_multi(
+                selection["slices"], {"psoas": MAJOR_MODEL, "full": FULL_MODEL}, log_root=self.output_folder,
+                profile=self.profile, progress=self.progress, backends=self._backends,
+            )
+        return self._labels
+
+    def seg_backends(self):
+        """各分割模型实际使用的前向后端；本次未推理（分割阶段从产物恢复）时按当前导出产物解析"""
+        if self._backends:
+            return dict(self._backends)
+        return {key: _model_backend(model) for key, model in (("psoas", MAJOR_MODEL), ("full", FULL_MODEL))}
+
+
+def _model_backend(model):
+    _, checkpoint_path = resolve_checkpoint(*model)
+    return resolve_backend(model[0], checkpoint_path)
+
+
+def _load_params(ctx):
+    return {"input": input_signature(ctx.input_folder) if os.path.isdir(ctx.input_folder) else None}
+
+
+def _run_load(ctx):
+    series = ctx.series("index")
+    write_log(ctx.output_folder, f"DICOM loaded count={len(series)} volume_shape={series.shape} spacing={series.spacing}")
+    return series
+
+
+def _run_sagittal(ctx):
+    series = ctx.series("full")
+    spacing = series.spacing
+    sagittal_slice = series.sagittal_mid()
+    # 按 spacing 拉伸 + 窗宽归一后直接写 PNG（内存中完成，不再经过工作目录下的中间 DICOM）
+    dcm_path = _sagittal_dicom_export_path(ctx.output_folder)
+    sagittal_to_balanced_png(
+        sagittal_slice, spacing, ctx.path("L3_png"), base_name=SAGITTAL_BASE,
+        reference_dicom_path=series.reference_path, dicom_export_path=dcm_path
+    )
+    write_log(ctx.output_folder, f"Sagittal PNG generated slice_shape={sagittal_slice.shape} "
+                                 f"scale_ratio={spacing[2] / spacing[1]} dicom_export={dcm_path}")
+
+
+def _sagittal_outputs(ctx, value):
+    return [ctx.path("L3_png", SAGITTAL_INPUT), ctx.path("L3_png", SAGITTAL_CLEAN)]
+
+
+def _vertebra_params(ctx):
+    return {"whole": file_signature(WHOLE_WEIGHTS), "vertebra": file_signature(VERTEBRA_WEIGHTS),
+            "quantize": VERSEG_QUANTIZE}
+
+
+def _run_vertebra(ctx):
+    """
+    2025/10/06
+    更改脊椎推理模型，可以推理出L1~L5，目前只取L3
+    输出： L3_mask/sagittal_midResize.png（与手动上传的 L3 mask 同一位置）
+    """
+    ver_folder = ctx.path("verseg")
+    L3_mask_folder = ctx.path("L3_mask")
+    os.makedirs(L3_mask_folder, exist_ok=True)
+    write_log(ctx.output_folder, "Begin vertebra detection")
+    results = process_spine_and_vertebrae(ctx.path("L3_png", SAGITTAL_INPUT), WHOLE_WEIGHTS, VERTEBRA_WEIGHTS,
+                                          ver_folder)
+    write_log(ctx.output_folder, f"Vertebra detection done keys={list(results.keys()) if results else None}")
+    src_mask = results["L3_mask"]
+    dst_mask = os.path.join(L3_mask_folder, SAGITTAL_CLEAN)
+    if not os.path.exists(src_mask):
+        raise RuntimeError(f"未检测到 L3 mask: {src_mask}")
+    shutil.copy2(src_mask, dst_mask)
+    write_log(ctx.output_folder, f"copy L3 mask {src_mask} -> {dst_mask}")
+
+
+def _vertebra_outputs(ctx, value):
+    return [ctx.path("L3_mask", SAGITTAL_CLEAN)]
+
+
+def _run_l3_clean(ctx):
+    clean_mask_folder(ctx.path("L3_mask"), ctx.path("L3_clean_mask"))
+    overlay_and_save(ctx.path("L3_png"), ctx.path("L3_clean_mask"), ctx.path("L3_overlay"))
+    write_log(ctx.output_folder, "L3 mask cleaned & overlay generated")
+
+
+def _l3_clean_outputs(ctx, value):
+    return [ctx.path("L3_clean_mask", SAGITTAL_CLEAN), ctx.path("L3_overlay", SAGITTAL_CLEAN)]
+
+
+def _run_axial_select(ctx):
+    """按清理后的 L3 mask 找对应的横断面，Axisal 下直接写最终文件名 slice_XXX.png（前端与手动标注使用）"""
+    series = ctx.series("index")
+    n_slices, orig_height, orig_width = series.shape
+    mask = load_mask(ctx.path("L3_clean_mask", SAGITTAL_CLEAN))
+    mask = cv2.resize(mask, (orig_height, n_slices), interpolation=cv2.INTER_NEAREST)
+    write_log(ctx.output_folder, f"L3 mask restored shape={mask.shape} foreground_pixels={int(mask.sum())}")
+
+    z_indices = extract_axial_slices_from_sagittal_mask(series.volume, mask, orig_width // 2, save_images=False)
+    preview = z_indices[:2] + z_indices[-2:] if z_indices else []
+    write_log(ctx.output_folder, f"Axial indices count={len(z_indices)} preview={preview}")
+
+    slice_folder = ctx.path("Axisal")
+    safe_clear_folder(slice_folder, [".png"])
+    names, slices = export_selected_slices_by_z_index(ctx.input_folder, slice_folder, z_indices, series=series)
+    write_log(ctx.output_folder, f"SEG_MEMORY exported slices={len(names)}")
+    if not names:
+        raise RuntimeError("未导出任何横断面切片")
+    path = ctx.path(AXIAL_SELECTION)
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump({"z_indices": z_indices, "names": names}, f, ensure_ascii=False)
+    os.replace(path + ".part", path)
+    return {"z": z_indices, "names": names, "slices": slices}
+
+
+def _axial_select_outputs(ctx, value):
+    return [ctx.path(AXIAL_SELECTION)] + _pngs(ctx.path("Axisal"))
+
+
+def _restore_axial_select(ctx):
+    with open(ctx.path(AXIAL_SELECTION), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    slices = [cv2.imread(ctx.path("Axisal", f"{n}.png"), cv2.IMREAD_GRAYSCALE) for n in meta["names"]]
+    return {"z": meta["z_indices"], "names": meta["names"], "slices": slices}
+
+
+def _seg_stage(name, key, model, folder):
+    """psoas_seg / full_seg：label 仅在 SAVE_SEG_MASKS 时落盘，否则被跳过时重新推理（由分割缓存命中）"""
+
+    def params(ctx):
+        _, checkpoint_path = resolve_checkpoint(*model)
+        profile_name, settings = resolve_profile(ctx.profile)
+        return {"model": model_fingerprint(model[0], checkpoint_path),
+                "variant": inference_variant(profile_name, settings, resolve_backend(model[0], checkpoint_path))}
+
+    def run(ctx):
+        labels = ctx.seg_labels()[key]
+        if SAVE_SEG_MASKS:
+            names = ctx.runner.value("axial_select")["names"]
+            safe_clear_folder(ctx.path(folder), [".png"])
+            save_label_pngs(labels, names, ctx.path(folder))
+            write_log(ctx.output_folder, f"SEG_MEMORY {key} masks saved count={len(names)}")
+        return labels
+
+    def outputs(ctx, value):
+        return _pngs(ctx.path(folder)) if SAVE_SEG_MASKS else []
+
+    def restore(ctx):
+        names = ctx.runner.value("axial_select")["names"]
+        paths = [ctx.path(folder, f"{n}.png") for n in names]
+        if SAVE_SEG_MASKS and all(os.path.isfile(p) for p in paths):
+            return [cv2.imread(p, cv2.IMREAD_UNCHANGED) for p in paths]
+        return ctx.seg_labels()[key]
+
+    return Stage(name, deps=["axial_select"], run=run, params=params, outputs=outputs, restore=restore)
+
+
+def _manual_middle_inputs(output_folder):
+    """当前中间张对应的手动 mask：(原图, psoas mask, combo mask, slice_XXX.png)；没有手动 mask 时返回 None"""
+    csv_path = os.path.join(output_folder, "full_overlay", "hu_statistics_middle_only.csv")
+    if not os.path.isfile(csv_path):
+        return None
+    with open(csv_path, "r", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    if not rows or not rows[0].get("filename"):
+        return None
+    base_name = rows[0]["filename"].replace("_middle.png", ".png")
+    manual_dir = os.path.join(output_folder, "manual_middle_mask")
+    psoas = os.path.join(manual_dir, f"{base_name}_psoas.png")
+    combo = os.path.join(manual_dir, f"{base_name}_combo.png")
+    psoas = psoas if os.path.isfile(psoas) else None
+    combo = combo if os.path.isfile(combo) else None
+    axisal = os.path.join(output_folder, "Axisal", base_name)
+    if (psoas is None and combo is None) or not os.path.isfile(axisal):
+        return None
+    return axisal, psoas, combo, base_name
+
+
+def _apply_manual_middle(output_folder):
+    inputs = _manual_middle_inputs(output_folder)
+    if inputs is None:
+        return None
+    axisal, psoas, combo, base_name = inputs
+    write_log(output_folder, f"MANUAL_MIDDLE apply {base_name} psoas={psoas is not None} combo={combo is not None}")
+    return compute_manual_middle_statistics(axisal, psoas, combo, os.path.join(output_folder, "full_overlay"),
+                                            base_name)
+
+
+def _metrics_params(ctx):
+    return {"manual": hash_files(_pngs(ctx.path("manual_middle_mask"))), "process_all": PROCESS_ALL_PARAMS}
+
+
+def _run_metrics(ctx):
+    """上游有变化（或没有手动 mask 可套用）时完整统计；否则只把手动 mask 重新套到中间张上"""
+    output_folder = ctx.output_folder
+    if ctx.runner.deps_changed("metrics") or _manual_middle_inputs(output_folder) is None:
+        selection = ctx.runner.value("axial_select")
+        psoas_labels = ctx.runner.value("psoas_seg")
+        full_labels = ctx.runner.value("full_seg")
+        full_overlay_folder = ctx.path("full_overlay")
+        safe_clear_folder(full_overlay_folder, [""])
+
+        fnames = [f"{n}.png" for n in selection["names"]]
+        write_log(output_folder, "SEG_MEMORY process_all metrics start")
+        process_all(
+            psoas_mask_dir=ctx.path("major_mask"),
+            full_mask_dir=ctx.path("full_mask"),
+            slice_dir=ctx.path("Axisal"),
+            dicom_dir=ctx.input_folder,
+            overlay_psoas_dir=ctx.path("major_overlay"),
+            overlay_combo_dir=full_overlay_folder,
+            clean_full_mask_dir=ctx.path("clean"),
+            pattern="*.png",
+            slice_images=dict(zip(fnames, selection["slices"])),
+            psoas_masks=dict(zip(fnames, psoas_labels)),
+            full_masks=dict(zip(fnames, full_labels)),
+            slice_hu=ctx.series("index").hu_by_name(selection["z"]),
+            **PROCESS_ALL_PARAMS
+        )
+        write_log(output_folder, "SEG_MEMORY process_all done")
+        write_inference_meta(output_folder, ctx.profile, {"psoas": MAJOR_MODEL[0], "full": FULL_MODEL[0]},
+                             mode="memory", backends=ctx.seg_backends())
+    return _apply_manual_middle(output_folder)
+
+
+def _metrics_outputs(ctx, value):
+    return [ctx.path("full_overlay", "hu_statistics.csv"), ctx.path("full_overlay", "hu_statistics_middle_only.csv")]
+
+
+CASE_GRAPH = PipelineGraph([
+    Stage("load", run=_run_load, params=_load_params, restore=lambda ctx: ctx.series("index")),
+    Stage("sagittal", deps=["load"], run=_run_sagittal, outputs=_sagittal_outputs, restore=lambda ctx: None,
+          params=lambda ctx: {"export_dicom": EXPORT_SAGITTAL_DICOM}),
+    Stage("vertebra", deps=["sagittal"], run=_run_vertebra, params=_vertebra_params, outputs=_vertebra_outputs,
+          restore=lambda ctx: None),
+    Stage("l3_clean", deps=["vertebra", "sagittal"], run=_run_l3_clean, outputs=_l3_clean_outputs,
+          restore=lambda ctx: None),
+    Stage("axial_select", deps=["load", "l3_clean"], run=_run_axial_select, outputs=_axial_select_outputs,
+          restore=_restore_axial_select),
+    _seg_stage("psoas_seg", "psoas", MAJOR_MODEL, "major_mask"),
+    _seg_stage("full_seg", "full", FULL_MODEL, "full_mask"),
+    Stage("metrics", deps=["axial_select", "psoas_seg", "full_seg"], run=_run_metrics, params=_metrics_params,
+          outputs=_metrics_outputs),
+])
+
+
+def run_case_stages(input_folder, output_folder, targets, profile=None, progress=None, force=False, frozen=(),
+                    on_stage=None):
+    """执行 targets 及其上游中需要重算的阶段，返回 StageRunner（executed / skipped 为本次重算 / 跳过的阶段）
+
+    on_stage: 阶段开始 / 完成 / 跳过时的回调，见 pipeline_graph.StageRunner
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    ctx = CaseContext(input_folder, output_folder, profile=profile, progress=progress)
+    runner = StageRunner(CASE_GRAPH, output_folder, ctx, force=force, frozen=frozen, on_stage=on_stage)
+    runner.run(targets)
+    write_log(output_folder, f"STAGES targets={targets} executed={sorted(runner.executed)} skipped={sorted(runner.skipped)}")
+    return runner
+
+
+def main(input_folder, output_folder, profile=None, progress=None, force=False, on_stage=None):
+    log_section(output_folder, f"MAIN START input={input_folder} profile={profile}")
+    if SEG_MODE == "memory":
+        # 阶段图：只重算输入有变化的阶段，force=True 时全部重算
+        run_case_stages(input_folder, output_folder, ["metrics"], profile=profile, progress=progress, force=force,
+                        on_stage=on_stage)
+        log_section(output_folder, "MAIN END")
+        return
+
+    # files 模式：旧的完整流程，不做增量，先作废阶段记录
+    invalidate_stages(output_folder)
     # 输出目录
     # dicom_folder = "1504425"
     # # L3相关
@@ -57,13 +385,14 @@ def main(input_folder, output_folder):
     full_mask_folder = os.path.join(output_folder, "full_mask")
     clean_full_mask_folder = os.path.join(output_folder, "clean")
     full_overlay_folder = os.path.join(output_folder, "full_overlay")
+    safe_clear_folder(full_overlay_folder, [""])
     major_mask_folder = os.path.join(output_folder, "major_mask")
     major_overlay_folder = os.path.join(output_folder, "major_overlay")
 
 
     # 模型路径
-    whole_weights = "outputwhole/model_final.pth"
-    vertebra_weights = "outputnew/model_final.pth"
+    whole_weights = WHOLE_WEIGHTS
+    vertebra_weights = VERTEBRA_WEIGHTS
     full_model_dir="nnUNet_results/Dataset001_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d"
     full_checkpoint="checkpoint_final.pth"
 
@@ -71,32 +400,29 @@ def main(input_folder, output_folder):
     major_checkpoint="checkpoint_final.pth"
 
     # 1. 找中间视角的侧视图
-    # Load 3D volume
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(dicom_folder)
-    reader.SetFileNames(dicom_names)
-    image = reader.Execute()
-
-    volume = sitk.GetArrayFromImage(image)  # [Z, Y, X]
-    spacing = image.GetSpacing()
-    write_log(output_folder, f"DICOM loaded count={len(dicom_names)} volume_shape={volume.shape} spacing={spacing}")
+    # Load 3D volume（整个病例只解码一次，后续切片导出与 HU 统计复用同一个 series；
+    # IDOCTOR_DICOM_LOAD_MODE=stream 时只流式计算矢状面，volume 为 None，横断面之后按需解码）
+    series = open_series(dicom_folder, log_root=output_folder)
+    volume = series.volume  # [Z, Y, X]
+    spacing = series.spacing
+    write_log(output_folder, f"DICOM loaded count={len(series)} volume_shape={series.shape} spacing={spacing}")
 
     spacing_z = spacing[2]  # height direction
     spacing_y = spacing[1]  # width direction
     scale_ratio = spacing_z / spacing_y
 
     # Extract middle sagittal slice
-    x_mid = volume.shape[2] // 2
-    sagittal_slice = volume[:, :, x_mid]
+    x_mid = series.shape[2] // 2
+    sagittal_slice = series.sagittal_mid()
     orig_height, orig_width = sagittal_slice.shape
 
-    # DICOM:Save with resized height and updated metadata
-    dcm_path = resize_and_save_sagittal_as_dicom(sagittal_slice, spacing, dicom_names[len(dicom_names)//2])
-    write_log(output_folder, f"Sagittal DICOM saved path={dcm_path} slice_shape={sagittal_slice.shape}")
-
-    # Convert to png
-    # png_path = dicom_to_balanced_png(dcm_path, f"output7_{dicom_folder}.png", scale_ratio)
-    png_inputs = dicom_to_balanced_png(dcm_path, L3_png_folder, scale_ratio)
+    # 按 spacing 拉伸 + 窗宽归一后直接写 PNG（内存中完成，不再经过工作目录下的中间 DICOM）
+    dcm_path = _sagittal_dicom_export_path(output_folder)
+    png_inputs = sagittal_to_balanced_png(
+        sagittal_slice, spacing, L3_png_folder, base_name=SAGITTAL_BASE,
+        reference_dicom_path=series.reference_path, dicom_export_path=dcm_path
+    )
+    write_log(output_folder, f"Sagittal resized slice_shape={sagittal_slice.shape} scale_ratio={scale_ratio} dicom_export={dcm_path}")
     write_log(output_folder, f"Sagittal PNG generated dir={L3_png_folder} files={os.listdir(L3_png_folder)}")
 
     # 2. 推理L3脊柱
@@ -129,10 +455,12 @@ def main(input_folder, output_folder):
     else:
         preview = []
     write_log(output_folder, f"Axial indices count={len(axial_slices_numbers)} preview={preview}")
+
     convert_selected_slices_by_z_index(
         dicom_folder=dicom_folder,
         output_folder=slice_folder,
-        selected_z_indices=axial_slices_numbers
+        selected_z_indices=axial_slices_numbers,
+        series=series
     )
     
     # selectedNumbers = reversedNumber(volume.shape[0], axial_slices_numbers)
@@ -144,11 +472,13 @@ def main(input_folder, output_folder):
 
     # 4. 腰大肌的识别
     write_log(output_folder, f"Run psoas nnUNet input_dir={slice_folder} output={major_mask_folder}")
-    run_nnunet_predict_and_overlay(slice_folder, major_mask_folder, major_model_dir, major_checkpoint)
+    run_nnunet_predict_and_overlay(slice_folder, major_mask_folder, major_model_dir, major_checkpoint, profile=profile,
+                                   progress=staged(progress, 0, 2), progress_model="psoas")
     write_log(output_folder, f"Psoas nnUNet done outputs={len(os.listdir(major_mask_folder))}")
     # 5. 全肌肉的识别
     write_log(output_folder, f"Run full nnUNet input_dir={slice_folder} output={full_mask_folder}")
-    run_nnunet_predict_and_overlay(slice_folder, full_mask_folder, full_model_dir, full_checkpoint)
+    run_nnunet_predict_and_overlay(slice_folder, full_mask_folder, full_model_dir, full_checkpoint, profile=profile,
+                                   progress=staged(progress, 1, 2), progress_model="full")
     write_log(output_folder, f"Full nnUNet done outputs={len(os.listdir(full_mask_folder))}")
 
     before_rename = [f for f in os.listdir(slice_folder) if f.endswith('_0000.png')]
@@ -177,56 +507,17 @@ def main(input_folder, output_folder):
         area_ratio_thresh=0.05,
         morph_ksize=3,
         morph_iters=1,
-        overlay_alpha=0.5
+        overlay_alpha=0.5,
+        slice_hu=series.hu_by_name(axial_slices_numbers)
     )
     write_log(output_folder, "process_all done")
+    write_inference_meta(output_folder, profile, {"psoas": major_model_dir, "full": full_model_dir}, mode="files")
     log_section(output_folder, "MAIN END")
 
 def l3_detect(input_folder, output_folder):
     write_log(output_folder, f"L3_DETECT START input={input_folder}")
-    L3_png_folder = os.path.join(output_folder, "L3_png")
-    ver_folder = os.path.join(output_folder, "verseg")
-    L3_mask_folder = os.path.join(output_folder, "L3_mask")
-    L3_clean_mask_folder = os.path.join(output_folder, "L3_clean_mask")
-    L3_overlay_folder = os.path.join(output_folder, "L3_overlay")
-    
-    for d in [L3_png_folder, ver_folder, L3_mask_folder, L3_clean_mask_folder, L3_overlay_folder]:
-        os.makedirs(d, exist_ok=True)
-
-    if not os.path.exists(os.path.join(L3_png_folder, SAGITTAL_CLEAN)):
-        generate_sagittal(input_folder, output_folder, force=False)
-
-    whole_weights = "outputwhole/model_final.pth"
-    vertebra_weights = "outputnew/model_final.pth"
-
-    img_path = os.path.join(L3_png_folder, SAGITTAL_INPUT)
-    write_log(output_folder, "L3_DETECT vertebra_infer start")
-    results = process_spine_and_vertebrae(img_path, whole_weights, vertebra_weights, ver_folder)
-    write_log(output_folder, f"L3_DETECT vertebra_infer done keys={list(results.keys()) if results else None}")
-    
-    # 复制结果到原有目录结构
-    import shutil
-    base_name = "sagittal_midResize_0000"
-    
-    # 复制 L3 mask 和 overlay
-    src_mask = os.path.join(ver_folder, f"{base_name}_L3_mask.png")
-    dst_mask = os.path.join(L3_mask_folder, SAGITTAL_CLEAN)
-    if os.path.exists(src_mask):
-        shutil.copy2(src_mask, dst_mask)
-        write_log(output_folder, f"L3_DETECT copy L3 mask -> {dst_mask}")
-    
-    src_overlay = os.path.join(ver_folder, f"{base_name}_L3_overlay.png") 
-    dst_overlay = os.path.join(L3_overlay_folder, SAGITTAL_CLEAN)
-    if os.path.exists(src_overlay):
-        shutil.copy2(src_overlay, dst_overlay)
-        write_log(output_folder, f"L3_DETECT copy L3 overlay -> {dst_overlay}")
-    
-    # 清理和生成最终 overlay
-    from sagit_save import clean_mask_folder, overlay_and_save
-    clean_mask_folder(L3_mask_folder, L3_clean_mask_folder)
-    overlay_and_save(L3_png_folder, L3_clean_mask_folder, L3_overlay_folder)
-    write_log(output_folder, "L3_DETECT cleaned & overlay generated")
-    
+    # 矢状面未变化时不重新生成；L3_mask 被手动覆盖过时重新检测
+    run_case_stages(input_folder, output_folder, ["l3_clean"])
     write_log(output_folder, "L3_DETECT END")
     return {
         "sagittal_png": f"L3_png/{SAGITTAL_CLEAN}",
@@ -235,15 +526,36 @@ def l3_detect(input_folder, output_folder):
         "auto": True
     }
 
-def continue_after_l3(input_folder, output_folder):
-    write_log(output_folder, f"CONT_AFTER_L3 START input={input_folder}")
+def refresh_l3_mask(input_folder, output_folder):
+    """手动上传 L3_mask/sagittal_midResize.png 之后调用：只重跑清理 + overlay，不触发自动检测"""
+    runner = run_case_stages(input_folder, output_folder, ["l3_clean"], frozen=("load", "sagittal", "vertebra"))
+    return {"overlay": f"L3_overlay/{SAGITTAL_CLEAN}", "refreshed": "l3_clean" in runner.executed}
+
+def apply_manual_middle_masks(input_folder, output_folder):
+    """手动上传中间张 mask（manual_middle_mask/）之后调用：上游全部沿用现有产物，只重跑 metrics"""
+    if SEG_MODE != "memory":
+        return _apply_manual_middle(output_folder)
+    runner = run_case_stages(input_folder, output_folder, ["metrics"], force=True,
+                             frozen=("load", "sagittal", "vertebra", "l3_clean", "axial_select", "psoas_seg", "full_seg"))
+    return runner.value("metrics")
+
+def continue_after_l3(input_folder, output_folder, profile=None, progress=None, on_stage=None):
+    write_log(output_folder, f"CONT_AFTER_L3 START input={input_folder} profile={profile}")
     # 只做横断面提取和后续分割
     L3_cleaned_mask_folder = os.path.join(output_folder, "L3_clean_mask")
     mask_path = os.path.join(L3_cleaned_mask_folder, SAGITTAL_CLEAN)
     if not os.path.exists(mask_path):
         write_log(output_folder, "CONT_AFTER_L3 MISSING_L3_MASK abort")
         return {"error": "缺少 L3_clean_mask/sagittal_midResize.png，请先自动或手动上传"}
-    
+
+    if SEG_MODE == "memory":
+        # L3 mask 以磁盘上现有的（自动或手动）为准，不重新检测
+        run_case_stages(input_folder, output_folder, ["metrics"], profile=profile, progress=progress,
+                        frozen=("sagittal", "vertebra", "l3_clean"), on_stage=on_stage)
+        write_log(output_folder, "CONT_AFTER_L3 END")
+        return {"status": "ok", "message": "后续流程已完成", "inference": read_inference_meta(output_folder)}
+
+    invalidate_stages(output_folder)
     slice_folder = os.path.join(output_folder, "Axisal")
     # 清理 Axisal 目录下所有 png 文件
     safe_clear_folder(slice_folder, [".png"])
@@ -259,19 +571,16 @@ def continue_after_l3(input_folder, output_folder):
     major_mask_folder = os.path.join(output_folder, "major_mask")
     major_overlay_folder = os.path.join(output_folder, "major_overlay")
 
-    # 读取 DICOM
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(input_folder)
-    reader.SetFileNames(dicom_names)
-    image = reader.Execute()
-    volume = sitk.GetArrayFromImage(image)
-    orig_height, orig_width = volume.shape[1], volume.shape[2]
-    x_mid = volume.shape[2] // 2
+    # 读取 DICOM：这里只需要尺寸和 L3 范围内的少量切片，只建头信息索引（体数据缓存有效时直接映射）
+    series = index_series(input_folder, log_root=output_folder)
+    volume = series.volume
+    n_slices, orig_height, orig_width = series.shape
+    x_mid = orig_width // 2
 
     # 恢复 mask
     image_path = os.path.join(L3_cleaned_mask_folder, "sagittal_midResize.png")
     mask = load_mask(image_path)
-    mask = cv2.resize(mask, (volume.shape[1], volume.shape[0]), interpolation=cv2.INTER_NEAREST)
+    mask = cv2.resize(mask, (orig_height, n_slices), interpolation=cv2.INTER_NEAREST)
     write_log(output_folder, f"CONT_AFTER_L3 restored_mask shape={mask.shape}")
 
     # 横断面提取
@@ -282,10 +591,15 @@ def continue_after_l3(input_folder, output_folder):
     else:
         preview = []
     write_log(output_folder, f"CONT_AFTER_L3 axial count={len(axial_slices_numbers)} preview={preview}")
+    # 肌肉分割
+    full_model_dir, full_checkpoint = FULL_MODEL
+    major_model_dir, major_checkpoint = MAJOR_MODEL
+
     convert_selected_slices_by_z_index(
         dicom_folder=input_folder,
         output_folder=slice_folder,
-        selected_z_indices=axial_slices_numbers
+        selected_z_indices=axial_slices_numbers,
+        series=series
     )
 
     # selectedNumbers = reversedNumber(volume.shape[0], axial_slices_numbers)
@@ -295,22 +609,18 @@ def continue_after_l3(input_folder, output_folder):
     #     selected_slices=selectedNumbers
     # )
 
-    # 肌肉分割
-    full_model_dir="nnUNet_results/Dataset001_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d"
-    full_checkpoint="checkpoint_final.pth"
-    major_model_dir="nnUNet_results/Dataset002_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d"
-    major_checkpoint="checkpoint_final.pth"
-
     # 只保留*_0000.png 作为 nnUNet 输入
     write_log(output_folder, "CONT_AFTER_L3 clean nnunet inputs")
     clean_nnunet_input_folder(slice_folder)
 
     write_log(output_folder, "CONT_AFTER_L3 psoas nnunet start")
-    run_nnunet_predict_and_overlay(slice_folder, major_mask_folder, major_model_dir, major_checkpoint)
+    run_nnunet_predict_and_overlay(slice_folder, major_mask_folder, major_model_dir, major_checkpoint, profile=profile,
+                                   progress=staged(progress, 0, 2), progress_model="psoas")
     write_log(output_folder, f"CONT_AFTER_L3 psoas nnunet done count={len(os.listdir(major_mask_folder))}")
     
     write_log(output_folder, "CONT_AFTER_L3 full nnunet start")
-    run_nnunet_predict_and_overlay(slice_folder, full_mask_folder, full_model_dir, full_checkpoint)
+    run_nnunet_predict_and_overlay(slice_folder, full_mask_folder, full_model_dir, full_checkpoint, profile=profile,
+                                   progress=staged(progress, 1, 2), progress_model="full")
     write_log(output_folder, f"CONT_AFTER_L3 full nnunet done count={len(os.listdir(full_mask_folder))}")
 
     for filename in os.listdir(slice_folder):
@@ -334,32 +644,49 @@ def continue_after_l3(input_folder, output_folder):
         area_ratio_thresh=0.05,
         morph_ksize=3,
         morph_iters=1,
-        overlay_alpha=0.5
+        overlay_alpha=0.5,
+        slice_hu=series.hu_by_name(axial_slices_numbers)
     )
     write_log(output_folder, "CONT_AFTER_L3 metrics done")
+    write_inference_meta(output_folder, profile, {"psoas": major_model_dir, "full": full_model_dir}, mode="files")
     write_log(output_folder, "CONT_AFTER_L3 END")
-    return {"status": "ok", "message": "后续流程已完成"}
+    return {"status": "ok", "message": "后续流程已完成", "inference": read_inference_meta(output_folder)}
 
 def generate_sagittal(input_folder, output_folder, force=False):
-    L3_png_folder = os.path.join(output_folder, "L3_png")
-    os.makedirs(L3_png_folder, exist_ok=True)
-
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(input_folder)
-    if len(dicom_names) == 0:
-        raise RuntimeError("未找到 DICOM")
-    reader.SetFileNames(dicom_names)
-    image = reader.Execute()
-    vol = sitk.GetArrayFromImage(image)
-    spacing = image.GetSpacing()
-    x_mid = vol.shape[2] // 2
-    sag = vol[:, :, x_mid]
-
-    dcm_path = resize_and_save_sagittal_as_dicom(
-        sag, spacing, dicom_names[len(dicom_names)//2]
-    )
-    dicom_to_balanced_png(dcm_path, L3_png_folder, scale_ratio=1.0, base_name=SAGITTAL_BASE)
-    return {"sagittal_png": f"L3_png/{SAGITTAL_CLEAN}", "regenerated": True}
+    runner = run_case_stages(input_folder, output_folder, ["sagittal"], force=force)
+    return {"sagittal_png": f"L3_png/{SAGITTAL_CLEAN}", "regenerated": "sagittal" in runner.executed}
+
+def write_inference_meta(output_folder, profile, models, mode, backends=None):
+    """把本次分割使用的推理档位写到 output/inference_meta.json（报告/前端据此区分预览与终版）
+
+    backends: {模型: 实际使用的前向后端}，文件模式（nnUNet 命令行推理）固定为 torch
+    """
+    profile_name, settings = resolve_profile(profile)
+    meta = {
+        "profile": profile_name,
+        "settings": settings,
+        "models": models,
+        "seg_mode": mode,
+        "backend": backends or {name: "torch" for name in models},
+        "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    path = os.path.join(output_folder, INFERENCE_META)
+    tmp = path + ".part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    write_log(output_folder, f"INFERENCE_META profile={profile_name} settings={settings} backend={meta['backend']}")
+    return meta
+
+def read_inference_meta(output_folder):
+    path = os.path.join(output_folder, INFERENCE_META)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
 
 def clean_nnunet_input_folder(folder):
     if not os.path.isdir(folder):
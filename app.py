@@ -1,7 +1,7 @@
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, Request, HTTPException
+from fastapi import FastAPI, UploadFile, File, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 
-import shutil, os, time, threading, hashlib, json
+import shutil, os, time, threading, json, asyncio
 import logging
 
 # 配置日志
@@ -61,29 +61,32 @@ if ENABLE_AUTH or ENABLE_QUOTA:
 else:
     logger.info("ℹ️  商业化功能未启用（开发模式）")
 # ==================== 商业化系统集成结束 ====================
-try:
-    import psutil  # optional for memory diagnostics
-except ImportError:  # graceful fallback
-    psutil = None
-import zipfile
-import zipfile
 import os
-import traceback
-from all_new import main 
-from all_new import l3_detect, continue_after_l3, generate_sagittal, SAGITTAL_CLEAN
-from fastapi.responses import FileResponse
-from fastapi import FastAPI, UploadFile, File, Form, Query
+from all_new import generate_sagittal, SAGITTAL_CLEAN, read_inference_meta
+from all_new import refresh_l3_mask, apply_manual_middle_masks
+from inference_profiles import resolve_profile
+from zip_stream import StreamingZipExtractor, extract_zip, UPLOAD_STREAM_UNZIP
+from upload_stream import upload_events
+from starlette.requests import ClientDisconnect
+from series_index import (
+    UploadIndexer, UPLOAD_VALIDATION, summarize_issues,
+    read_series_index, write_series_index, remove_series_index,
+)
+from blob_store import get_blob_store
+from dicom_series import remove_volume_cache
+from pipeline_graph import invalidate_stages
+from job_queue import get_job_queue, job_status, PLAN_WEIGHTS, TERMINAL_STATUSES
+from worker import start_embedded_workers, EMBEDDED_WORKERS, INTERACTIVE_WORKERS
+from admission import estimate_job_cost, get_admission_controller, get_interactive_admission_controller
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import FastAPI, UploadFile, File, Query
 
-from compute import compute_manual_middle_statistics
 
 
 logger.info("Creating FastAPI app...")
 app = FastAPI()
 logger.info("FastAPI app created")
 
-# 全局任务状态字典 (后台计算)
-task_status = {}
-
 # 上传进度状态: {upload_id: {status, received, total, percent, message, folder, filename, started_at}}
 upload_status = {}
 
@@ -92,15 +95,6 @@ _patient_locks = {}
 def _get_patient_lock(key: str):
     return _patient_locks.setdefault(key, threading.Lock())
 
-# 每个任务的锁，防止重复提交
-task_locks = {}
-def _get_task_lock(task_id: str):
-    return task_locks.setdefault(task_id, threading.Lock())
-
-CHUNK_SIZE = 1024 * 512  # 512KB chunk
-
-# Debug flag (enable extra instrumentation)
-DEBUG_ENABLED = os.environ.get("IDOCTOR_DEBUG", "1") not in ("0", "false", "False")
 
 def _patient_root(patient_name: str, study_date: str, user_id: str = None):
     """获取患者数据根目录（支持用户隔离）
@@ -127,55 +121,18 @@ def _patient_root(patient_name: str, study_date: str, user_id: str = None):
 def _output_dir(patient_name: str, study_date: str, user_id: str = None):
     return os.path.join(_patient_root(patient_name, study_date, user_id), "output")
 
+def _task_id(prefix: str, patient_name: str, study_date: str, user_id: str = None):
+    """任务 ID，与 _patient_root 一样按用户隔离：不同用户的同名病例不会共用（或读到）同一个任务"""
+    if user_id and ENABLE_AUTH:
+        return f"{prefix}_{user_id}_{patient_name}_{study_date}"
+    return f"{prefix}_{patient_name}_{study_date}"
+
 def _pipeline_log_path(output_folder: str):
     return os.path.join(output_folder, "pipeline_debug.log")
 
 def _safe_mkdir(path: str):
     os.makedirs(path, exist_ok=True)
 
-def _append_log_line(output_folder: str, line: str):
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    full = f"[{ts}] {line}"
-    print(full, flush=True)
-    if not output_folder:
-        return
-    try:
-        with open(_pipeline_log_path(output_folder), "a", encoding="utf-8") as f:
-            f.write(full + "\n")
-    except Exception:
-        pass
-
-def _hash_input_dir(input_dir: str):
-    files = [f for f in os.listdir(input_dir) if f.lower().endswith((".dcm", ".dcm.pk"))]
-    files.sort()
-    h = hashlib.sha256()
-    sizes = []
-    for f in files:
-        p = os.path.join(input_dir, f)
-        try:
-            st = os.stat(p)
-            h.update(f.encode())
-            h.update(str(st.st_size).encode())
-            sizes.append(st.st_size)
-        except Exception:
-            continue
-    return {
-        "count": len(files),
-        "hash": h.hexdigest(),
-        "total_bytes": sum(sizes)
-    }
-
-def _resource_snapshot():
-    snap = {}
-    if psutil:
-        p = psutil.Process()
-        with p.oneshot():
-            mem = p.memory_info()
-            snap["rss_mb"] = round(mem.rss / 1024 / 1024, 2)
-            snap["cpu_percent"] = p.cpu_percent(interval=None)
-            snap["num_threads"] = p.num_threads()
-            snap["open_files"] = len(p.open_files())
-    return snap
 # 允许的前端来源
 origins = [
     "http://localhost:7500",
@@ -244,6 +201,32 @@ if COMMERCIAL_AVAILABLE and ENABLE_QUOTA:
 
 DATA_ROOT = "data"
 
+# 启动时预热 detectron2 椎体模型（IDOCTOR_WARMUP=1 开启），避免第一次 /l3_detect 付出构建模型的开销
+WARMUP_ENABLED = os.environ.get("IDOCTOR_WARMUP", "0") not in ("0", "false", "False")
+
+@app.on_event("startup")
+def _warmup_models():
+    if not WARMUP_ENABLED:
+        return
+    def _run():
+        try:
+            from verseg import warmup_predictors
+            timings = warmup_predictors()
+            logger.info(f"✅ 椎体检测模型预热完成: {timings}")
+        except Exception as e:
+            logger.warning(f"⚠️ 椎体检测模型预热失败: {e}")
+    threading.Thread(target=_run, name="model-warmup", daemon=True).start()
+
+# 流水线任务由 worker 从持久化队列领取执行（job_queue / worker.py）；
+# IDOCTOR_EMBEDDED_WORKERS > 0 时在 API 进程内启动相应数量的 worker 线程，单独部署 worker 时设为 0
+@app.on_event("startup")
+def _start_embedded_workers():
+    if EMBEDDED_WORKERS <= 0:
+        logger.info("ℹ️  未启动内嵌 worker，任务由独立的 worker.py 进程执行")
+        return
+    start_embedded_workers(EMBEDDED_WORKERS)
+    logger.info(f"✅ 已启动 {EMBEDDED_WORKERS} 个内嵌 worker，{INTERACTIVE_WORKERS} 个交互通道（L3 检测）")
+
 ############################## 健康检查和测试接口 ##############################
 @app.get("/status")
 def get_status(request: Request):
@@ -265,24 +248,63 @@ def get_upload_status(upload_id: str):
     """查询上传进度/状态"""
     return upload_status.get(upload_id, {"status": "not_found"})
 
+def _int_or_none(value):
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"无效的整数: {value}")
+
 @app.post("/upload_dicom_zip")
 async def upload_dicom_zip(
     request: Request,
-    patient_name: str = Form(...),
-    study_date: str = Form(...),
-    file: UploadFile = File(...),
-    file_size: int = Form(None)
+    patient_name: str = Query(None),
+    study_date: str = Query(None),
+    file_size: int = Query(None),
+    filename: str = Query(None)
 ):
     """流式安全上传 + 进度 + 客户端断开清理 + 原子替换 input 目录。
 
+    请求体不经 FastAPI 的表单解析（它会先把整个文件读进临时文件），而是直接读 request.stream()：
+      - multipart/form-data：字段 patient_name / study_date 需在 file 之前（前端 FormData 即如此），
+        file_size 可在 file 之后；
+      - 原始 ZIP 请求体（application/zip 等）：patient_name / study_date / file_size / filename 走查询参数。
     返回: {status, upload_id, folder, message}
     进度查询: GET /upload_status/{upload_id}
     状态说明:
       receiving -> unzip -> done / aborted / error
+    IDOCTOR_UPLOAD_STREAM_UNZIP=1（默认）时网络数据一到就按本地文件头解压（见 zip_stream），
+    解压与传输重叠，不再先写完整 zip 再回读；只有流式无法处理的成员才在接收完成后进入 unzip 阶段。
+    解压的同时解析每个 DICOM 头，生成 <病例>/series_index.json（见 series_index），
+    IDOCTOR_UPLOAD_VALIDATION=reject 时不可用的数据（非横断面、只有定位片、尺寸不一致等）直接拒绝。
+    解压、头信息汇总、去重入库、目录替换等磁盘 / CPU 密集步骤都放到线程中执行，不阻塞事件循环。
     """
     # 获取用户ID
     user_id = getattr(request.state, "user_id", None)
-    
+
+    # 读到 file 部分为止：之前的表单字段决定病例目录
+    events = upload_events(request)
+    fields = {"patient_name": patient_name, "study_date": study_date, "file_size": file_size}
+    upload_name = None
+    try:
+        async for kind, name, value in events:
+            if kind == "field":
+                fields[name] = value
+            elif kind == "file_start" and name == "file":
+                upload_name = os.path.basename(filename or value or "") or "upload.zip"
+                break
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"请求体格式错误: {e}")
+    except ClientDisconnect:
+        return {"status": "aborted", "message": "客户端已断开"}
+    patient_name, study_date = fields["patient_name"], fields["study_date"]
+    if upload_name is None:
+        raise HTTPException(status_code=400, detail="缺少 file")
+    if not patient_name or not study_date:
+        raise HTTPException(status_code=400, detail="patient_name / study_date 需在 file 之前提供（表单字段或查询参数）")
+    file_size = _int_or_none(fields["file_size"])
+    # file_size 可能在文件之后才到，进度先按 Content-Length 估算
+    total = file_size or _int_or_none(request.headers.get("content-length"))
+
     folder_name = f"{patient_name}_{study_date}"
     patient_root = _patient_root(patient_name, study_date, user_id)
     os.makedirs(patient_root, exist_ok=True)
@@ -295,68 +317,130 @@ async def upload_dicom_zip(
     upload_status[upload_id] = {
         "status": "receiving",
         "received": 0,
-        "total": file_size,
+        "total": total,
         "percent": 0.0,
         "message": "正在接收",
         "folder": folder_name,
-        "filename": file.filename,
+        "filename": upload_name,
         "started_at": time.time()
     }
 
-    tmp_zip_path = os.path.join(patient_root, file.filename + ".part")
+    tmp_zip_path = os.path.join(patient_root, upload_name + ".part")
     tmp_input_dir = os.path.join(patient_root, f"input_uploading_{int(time.time())}")
     final_input_dir = os.path.join(patient_root, "input")
     backup_old = None
+    extractor = None
+    indexer = None
+    series_index = None
 
     try:
-        # 1. 流式写入 zip .part
-        with open(tmp_zip_path, "wb") as out_f:
-            while True:
-                if await request.is_disconnected():
-                    raise RuntimeError("客户端已断开")
-                chunk = await file.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                out_f.write(chunk)
-                upload_status[upload_id]["received"] += len(chunk)
-                if file_size:
-                    upload_status[upload_id]["percent"] = round(upload_status[upload_id]["received"] / file_size * 100, 2)
-
+        # 1. 流式接收：边收边解压到临时目录（或旧模式下写入 zip .part）
+        os.makedirs(tmp_input_dir, exist_ok=True)
+        if UPLOAD_VALIDATION != "off":
+            indexer = UploadIndexer(tmp_input_dir)
+        if UPLOAD_STREAM_UNZIP:
+            extractor = StreamingZipExtractor(tmp_input_dir, tmp_zip_path,
+                                              on_member=indexer.add if indexer else None)
+            upload_status[upload_id]["message"] = "正在接收并解压"
+            upload_status[upload_id]["extracted"] = 0
+            sink = extractor.feed
+        else:
+            out_f = open(tmp_zip_path, "wb")
+            sink = out_f.write
+        try:
+            # 客户端断开时 request.stream() 抛 ClientDisconnect
+            async for kind, name, value in events:
+                if kind == "field":
+                    fields[name] = value
+                    continue
+                if kind != "file" or name != "file":
+                    continue
+                try:
+                    await asyncio.to_thread(sink, value)
+                except RuntimeError as e:
+                    raise RuntimeError(f"解压失败: {e}")
+                upload_status[upload_id]["received"] += len(value)
+                if total:
+                    upload_status[upload_id]["percent"] = min(
+                        100.0, round(upload_status[upload_id]["received"] / total * 100, 2))
+                if extractor is not None:
+                    upload_status[upload_id]["extracted"] = len(extractor.members)
+        except ClientDisconnect:
+            raise RuntimeError("客户端已断开")
+        except ValueError as e:
+            raise RuntimeError(f"请求体格式错误: {e}")
+        finally:
+            if extractor is None:
+                out_f.close()
+
+        file_size = _int_or_none(fields["file_size"])
         if file_size and upload_status[upload_id]["received"] != file_size:
             raise RuntimeError("接收字节与 file_size 不一致")
 
-        upload_status[upload_id]["status"] = "unzip"
-        upload_status[upload_id]["message"] = "解压中"
-
-        # 2. 解压到临时目录
-        os.makedirs(tmp_input_dir, exist_ok=True)
+        # 2. 解压剩余部分（流式模式下只有回退的成员；旧模式下为整个 zip）
+        if extractor is None or extractor.mode == "fallback":
+            upload_status[upload_id]["status"] = "unzip"
+            upload_status[upload_id]["message"] = "解压中"
         try:
-            with zipfile.ZipFile(tmp_zip_path, 'r') as zf:
-                for name in zf.namelist():
-                    base = os.path.basename(name)
-                    if not base:
-                        continue
-                    with zf.open(name) as src, open(os.path.join(tmp_input_dir, base), "wb") as dst:
-                        shutil.copyfileobj(src, dst)
+            if extractor is not None:
+                members = await asyncio.to_thread(extractor.finish)
+                upload_status[upload_id]["extracted"] = len(members)
+                upload_status[upload_id]["unzip_mode"] = extractor.mode
+            else:
+                await asyncio.to_thread(extract_zip, tmp_zip_path, tmp_input_dir,
+                                        on_member=indexer.add if indexer else None)
         except Exception as e:
             raise RuntimeError(f"解压失败: {e}")
 
+        # 2.1 头信息索引与校验（在替换 input 之前，拒绝时旧数据保持不变）
+        if indexer is not None:
+            upload_status[upload_id]["message"] = "校验 DICOM"
+            series_index = await asyncio.to_thread(indexer.finish)
+            upload_status[upload_id]["validation"] = {
+                "usable": series_index["usable"], "issues": series_index["issues"]
+            }
+            if not series_index["usable"] and UPLOAD_VALIDATION == "reject":
+                raise RuntimeError(f"DICOM 校验未通过: {summarize_issues(series_index)}")
+
+        # 2.2 内容去重：已存在的切片替换为 data/.blobs 中 blob 的硬链接（见 blob_store）
+        blob_store = get_blob_store()
+        if blob_store is not None:
+            upload_status[upload_id]["message"] = "去重存储"
+            upload_status[upload_id]["dedup"] = await asyncio.to_thread(blob_store.ingest_folder, tmp_input_dir)
+
         # 3. 原子替换 input 目录
-        if os.path.isdir(final_input_dir):
-            backup_old = final_input_dir + "_old"
-            if os.path.isdir(backup_old):
+        def swap_input():
+            nonlocal backup_old
+            if os.path.isdir(final_input_dir):
+                backup_old = final_input_dir + "_old"
+                if os.path.isdir(backup_old):
+                    shutil.rmtree(backup_old, ignore_errors=True)
+                os.replace(final_input_dir, backup_old)
+            os.replace(tmp_input_dir, final_input_dir)
+            if backup_old and os.path.isdir(backup_old):
                 shutil.rmtree(backup_old, ignore_errors=True)
-            os.replace(final_input_dir, backup_old)
-        os.replace(tmp_input_dir, final_input_dir)
-        if backup_old and os.path.isdir(backup_old):
-            shutil.rmtree(backup_old, ignore_errors=True)
+            if series_index is not None:
+                write_series_index(patient_root, series_index)
+            else:
+                remove_series_index(patient_root)
+            # 体数据缓存与阶段记录都属于旧 input，随替换一起删除，下次运行从 load 阶段重新开始
+            remove_volume_cache(final_input_dir)
+            invalidate_stages(os.path.join(patient_root, "output"))
+
+        await asyncio.to_thread(swap_input)
 
         # 4. 完成
         upload_status[upload_id]["status"] = "done"
         upload_status[upload_id]["message"] = "上传并解压成功"
         upload_status[upload_id]["percent"] = 100.0
+        if blob_store is not None:
+            # 被替换掉的旧 input 释放了链接，定期清理无引用的 blob
+            await asyncio.to_thread(blob_store.maybe_gc)
+        if extractor is not None:
+            extractor.close()
         try:
-            os.remove(tmp_zip_path)
+            if os.path.isfile(tmp_zip_path):
+                os.remove(tmp_zip_path)
         except Exception:
             pass
 
@@ -377,11 +461,18 @@ async def upload_dicom_zip(
                 logger.warning(f"⚠️ Failed to sync storage quota: {e}")
                 # 存储同步失败不影响上传
 
-        return {"status": "ok", "upload_id": upload_id, "folder": folder_name, "message": "上传解压完成"}
+        result = {"status": "ok", "upload_id": upload_id, "folder": folder_name, "message": "上传解压完成"}
+        if series_index is not None:
+            result["validation"] = upload_status[upload_id]["validation"]
+        return result
     except Exception as e:
         upload_status[upload_id]["status"] = "aborted"
         upload_status[upload_id]["message"] = f"失败: {e}"
         # 清理临时
+        if extractor is not None:
+            extractor.close()
+        if indexer is not None:
+            await asyncio.to_thread(indexer.close)
         try:
             if os.path.isfile(tmp_zip_path):
                 os.remove(tmp_zip_path)
@@ -389,135 +480,108 @@ async def upload_dicom_zip(
             pass
         try:
             if os.path.isdir(tmp_input_dir):
-                shutil.rmtree(tmp_input_dir, ignore_errors=True)
+                await asyncio.to_thread(shutil.rmtree, tmp_input_dir, ignore_errors=True)
         except Exception:
             pass
         # 回滚旧 input
         if backup_old and not os.path.isdir(final_input_dir) and os.path.isdir(backup_old):
             os.replace(backup_old, final_input_dir)
-        return {"status": "error", "upload_id": upload_id, "message": str(e)}
+        result = {"status": "error", "upload_id": upload_id, "message": str(e)}
+        if "validation" in upload_status[upload_id]:
+            result["validation"] = upload_status[upload_id]["validation"]
+        return result
     finally:
         lock.release()
 
+def _check_series_index(patient_root: str):
+    """上传时已判定不可用的病例直接返回 422，不再启动流水线（旧上传没有索引时不检查）"""
+    index = read_series_index(patient_root)
+    if index is not None and not index.get("usable", True):
+        raise HTTPException(status_code=422, detail={
+            "message": f"DICOM 数据不可用: {summarize_issues(index)}",
+            "issues": index.get("issues", []),
+        })
+
+def _validate_profile(profile):
+    """校验推理档位（fast / balanced / accurate），为空返回服务默认档位"""
+    try:
+        return resolve_profile(profile)[0]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# 用户订阅计划缓存 {user_id: (计划名, 查询时间)}，配置了 IDOCTOR_PLAN_WEIGHTS 时按计划加权排队
+_plan_cache = {}
+PLAN_CACHE_SECONDS = 300
+
+async def _user_plan(user_id):
+    """用户当前有效订阅的计划名（来自支付服务数据库）；未启用配额或未配置计划权重时返回 None"""
+    if not user_id or not PLAN_WEIGHTS or not ENABLE_QUOTA:
+        return None
+    cached = _plan_cache.get(user_id)
+    if cached and time.time() - cached[1] < PLAN_CACHE_SECONDS:
+        return cached[0]
+    import integrations.middleware.quota_middleware as quota_mw
+    if quota_mw.quota_manager is None:
+        return None
+    plan = await quota_mw.quota_manager.get_active_plan(str(user_id))
+    _plan_cache[user_id] = (plan, time.time())
+    return plan
+
+async def _enqueue_job(task_id: str, kind: str, payload: dict, user_id=None, submitted_message: str = "",
+                       priority: str = None):
+    """入队流水线任务；同一 task_id 已在排队 / 运行时返回现有任务，不重复提交
+
+    入队时按上传的序列索引估算内存 / CPU 成本，worker 据此做准入控制（见 admission.py）；
+    领取顺序按优先级类别 + 用户加权公平排队（见 job_queue.py）
+    """
+    queue = get_job_queue()
+    cost = estimate_job_cost(kind, payload["input_folder"])
+    plan = await _user_plan(user_id)
+    job, created = queue.enqueue(task_id, kind, payload, user_id=user_id, cost=cost, priority=priority, plan=plan)
+    position = queue.position(job)
+    if not created:
+        status = job_status(job, position)
+        if job["state"] == "queued":
+            message = f"任务排队中（第 {position} 位），请勿重复提交"
+        else:
+            elapsed = time.time() - (job["started_at"] or time.time())
+            message = f"任务正在处理中(已运行 {int(elapsed)}秒)，请勿重复提交"
+        return {"status": status["status"], "task_id": task_id, "job_id": job["id"], "position": position,
+                "message": message}
+    print(f"[API] 任务已入队: {task_id} job={job['id']} position={position} cost={cost}")
+    return {"status": "submitted", "task_id": task_id, "job_id": job["id"], "position": position, "cost": cost,
+            "message": submitted_message}
+
 @app.post("/process/{patient_name}/{study_date}")
 async def process_case(
     request: Request,
     patient_name: str, 
     study_date: str,
-    background_tasks: BackgroundTasks
+    profile: str = Query(None),
+    force: int = Query(0),
+    priority: str = Query(None)
 ):
     # 获取用户ID（如果启用了认证）
     user_id = getattr(request.state, "user_id", None)
+    profile = _validate_profile(profile)
+    # 批量脚本传 priority=batch，排在交互提交的任务之后
+    if priority not in (None, "pipeline", "batch"):
+        raise HTTPException(status_code=400, detail=f"未知优先级: {priority}（可选: pipeline, batch）")
+    _check_series_index(_patient_root(patient_name, study_date, user_id))
     
-    task_id = f"main_{patient_name}_{study_date}"
-    
-    # 使用锁防止并发提交
-    lock = _get_task_lock(task_id)
-    if not lock.acquire(blocking=False):
-        return {
-            "status": "blocked",
-            "task_id": task_id,
-            "message": "任务正在处理中，请勿重复提交"
-        }
-    
-    try:
-        # 检查是否有正在运行的任务
-        if task_id in task_status:
-            status = task_status[task_id].get("status")
-            # 如果是正在处理中的任务，返回现有状态
-            if status == "processing":
-                started = task_status[task_id].get("started_at", 0)
-                elapsed = time.time() - started
-                # 如果任务已经运行超过10分钟，认为是僵尸任务，允许重新提交
-                if elapsed < 600:  # 10分钟
-                    return {
-                        "status": "processing",
-                        "task_id": task_id,
-                        "message": f"任务正在处理中(已运行 {int(elapsed)}秒)，请勿重复提交"
-                    }
-        
-        # 初始化任务状态
-        task_status[task_id] = {
-            "status": "processing",
-            "progress": 0,
-            "message": "任务已提交",
-            "started_at": time.time(),
-            "submitted_at": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        folder_name = f"{patient_name}_{study_date}"
-        patient_root = _patient_root(patient_name, study_date, user_id)
-        input_folder = os.path.join(patient_root, "input")
-        output_folder = os.path.join(patient_root, "output")
-        os.makedirs(output_folder, exist_ok=True)
-
-        print(f"[API] 提交全流程后台任务: {task_id}")
-        
-        # 提交后台任务
-        background_tasks.add_task(_run_main_process, task_id, input_folder, output_folder)
-        
-        return {
-            "status": "submitted",
-            "task_id": task_id,
-            "message": "全流程任务已提交到后台处理，请轮询 /task_status/{task_id} 查看进度"
-        }
-    finally:
-        lock.release()
+    task_id = _task_id("main", patient_name, study_date, user_id)
+    patient_root = _patient_root(patient_name, study_date, user_id)
+    input_folder = os.path.join(patient_root, "input")
+    output_folder = os.path.join(patient_root, "output")
+    os.makedirs(output_folder, exist_ok=True)
 
-def _run_main_process(task_id: str, input_folder: str, output_folder: str):
-    """后台任务：执行 main 全流程 (加调试日志)"""
-    start = time.time()
-    snap_before = _resource_snapshot() if DEBUG_ENABLED else {}
-    if DEBUG_ENABLED:
-        _append_log_line(output_folder, f"[TASK {task_id}] ===== 开始 main() input={input_folder}")
-        inp_sig = _hash_input_dir(input_folder) if os.path.isdir(input_folder) else {"error": "input_missing"}
-        _append_log_line(output_folder, f"[TASK {task_id}] 输入签名 {json.dumps(inp_sig, ensure_ascii=False)}")
-        _append_log_line(output_folder, f"[TASK {task_id}] 资源快照(before) {snap_before}")
-        # 列出 output 目录现有子目录(第二次运行时最关键)
-        if os.path.isdir(output_folder):
-            existing = os.listdir(output_folder)
-            _append_log_line(output_folder, f"[TASK {task_id}] 现有output子项目: {existing}")
-    try:
-        task_status[task_id]["progress"] = 10
-        task_status[task_id]["message"] = "正在处理..."
-
-        # 彻底清理 full_overlay 目录
-        full_overlay_dir = os.path.join(output_folder, "full_overlay")
-        if os.path.isdir(full_overlay_dir):
-            for f in os.listdir(full_overlay_dir):
-                file_path = os.path.join(full_overlay_dir, f)
-                if os.path.isfile(file_path):
-                    try:
-                        os.remove(file_path)
-                    except Exception:
-                        pass
-
-        main(input_folder, output_folder)
-        elapsed = time.time() - start
-        if DEBUG_ENABLED:
-            snap_after = _resource_snapshot()
-            _append_log_line(output_folder, f"[TASK {task_id}] main() 完成 耗时={elapsed:.2f}s 资源after={snap_after}")
-        task_status[task_id] = {
-            "status": "completed",
-            "progress": 100,
-            "message": "全流程处理完成",
-            "output_dir": output_folder,
-            "started_at": task_status[task_id].get("started_at"),
-            "completed_at": time.time(),
-            "duration": elapsed
-        }
-    except Exception as e:
-        tb = traceback.format_exc()
-        if DEBUG_ENABLED:
-            _append_log_line(output_folder, f"[TASK {task_id}] 异常: {e}\n{tb}")
-        task_status[task_id] = {
-            "status": "failed",
-            "progress": 0,
-            "message": f"处理失败: {str(e)}",
-            "error": str(e),
-            "started_at": task_status[task_id].get("started_at"),
-            "failed_at": time.time()
-        }
+    return await _enqueue_job(
+        task_id, "main",
+        {"input_folder": input_folder, "output_folder": output_folder, "profile": profile, "force": bool(force)},
+        user_id=user_id,
+        submitted_message="全流程任务已提交到后台处理，请轮询 /task_status/{task_id} 查看进度",
+        priority=priority,
+    )
 
 # 返回所有文件夹的 病人-日期 列表
 @app.get("/list_patients")
@@ -572,7 +636,8 @@ def get_key_results(request: Request, patient_name: str, study_date: str):
     # 只返回 middle 图片的文件名
     return {
         "csv_files": csv_contents,      # {文件名: 内容}
-        "middle_images": middle_images  # [文件名, ...]
+        "middle_images": middle_images,  # [文件名, ...]
+        "inference": read_inference_meta(os.path.join(patient_root, "output"))  # 推理档位等元数据
     }
 
 # 直接传输图片文件
@@ -586,136 +651,162 @@ def get_image(request: Request, patient_name: str, study_date: str, filename: st
         return {"error": "图片不存在"}
     return FileResponse(img_path, media_type="image/png")    
 
+# /l3_detect 作为交互类任务入队（优先于全流程与批量任务领取），接口仍同步等待并返回检测结果；
+# 超过该时间仍未完成时返回 504，可用 task_id 继续查询
+L3_DETECT_TIMEOUT = float(os.environ.get("IDOCTOR_L3_DETECT_TIMEOUT", "600"))
+
 @app.post("/l3_detect/{patient_name}/{study_date}")
-def api_l3_detect(request: Request, patient_name: str, study_date: str):
+async def api_l3_detect(request: Request, patient_name: str, study_date: str):
     # 获取用户ID（如果启用了认证）
     user_id = getattr(request.state, "user_id", None)
     
     patient_root = _patient_root(patient_name, study_date, user_id)
+    _check_series_index(patient_root)
     input_folder = os.path.join(patient_root, "input")
     output_folder = os.path.join(patient_root, "output")
     os.makedirs(output_folder, exist_ok=True)
-    result = l3_detect(input_folder, output_folder)
-    return result
+
+    task_id = _task_id("l3", patient_name, study_date, user_id)
+    submitted = await _enqueue_job(
+        task_id, "l3_detect", {"input_folder": input_folder, "output_folder": output_folder},
+        user_id=user_id, submitted_message="L3 检测已提交",
+    )
+    queue = get_job_queue()
+    deadline = time.time() + L3_DETECT_TIMEOUT
+    while True:
+        job = await asyncio.to_thread(queue.get_job, submitted["job_id"])
+        if job["state"] == "completed":
+            return job["result"]
+        if job["state"] == "failed":
+            raise HTTPException(status_code=500, detail=f"L3 检测失败: {job['error']}")
+        # 没有能领取 L3 检测的 worker 在运行（例如 IDOCTOR_EMBEDDED_WORKERS=0 且未启动 worker.py）时立即返回，
+        # 任务保留在队列中，worker 启动后会执行
+        if job["state"] == "queued" and not await asyncio.to_thread(queue.live_workers, "l3_detect"):
+            raise HTTPException(status_code=503, detail={
+                "message": "当前没有可执行 L3 检测的 worker，任务已排队，请稍后通过 /task_status/{task_id} 查询",
+                "task_id": task_id})
+        if time.time() > deadline:
+            raise HTTPException(status_code=504, detail={
+                "message": "L3 检测等待超时，请稍后通过 /task_status/{task_id} 查询", "task_id": task_id})
+        await asyncio.sleep(0.5)
 
 @app.post("/continue_after_l3/{patient_name}/{study_date}")
 async def api_continue_after_l3(
     request: Request,
     patient_name: str, 
     study_date: str,
-    background_tasks: BackgroundTasks
+    profile: str = Query(None)
 ):
     # 获取用户ID（如果启用了认证）
     user_id = getattr(request.state, "user_id", None)
+    profile = _validate_profile(profile)
     
-    task_id = f"cont_{patient_name}_{study_date}"
-    
-    # 使用锁防止并发提交
-    lock = _get_task_lock(task_id)
-    if not lock.acquire(blocking=False):
-        return {
-            "status": "blocked",
-            "task_id": task_id,
-            "message": "任务正在处理中，请勿重复提交"
-        }
-    
-    try:
-        # 检查是否有正在运行的任务
-        if task_id in task_status:
-            status = task_status[task_id].get("status")
-            if status == "processing":
-                started = task_status[task_id].get("started_at", 0)
-                elapsed = time.time() - started
-                if elapsed < 600:  # 10分钟
-                    return {
-                        "status": "processing",
-                        "task_id": task_id,
-                        "message": f"任务正在处理中(已运行 {int(elapsed)}秒)，请勿重复提交"
-                    }
-        
-        # 初始化任务状态
-        task_status[task_id] = {
-            "status": "processing",
-            "progress": 0,
-            "message": "任务已提交",
-            "started_at": time.time(),
-            "submitted_at": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        patient_root = _patient_root(patient_name, study_date, user_id)
-        input_folder = os.path.join(patient_root, "input")
-        output_folder = os.path.join(patient_root, "output")
-        
-        print(f"[API] 提交后台任务: {task_id}")
-        print(f"[API] Input folder: {input_folder}")
-        print(f"[API] Output folder: {output_folder}")
-        
-        # 提交后台任务
-        background_tasks.add_task(_run_continue_after_l3, task_id, input_folder, output_folder)
-        
-        return {
-            "status": "submitted",
-            "task_id": task_id,
-            "message": "任务已提交到后台处理，请轮询 /task_status/{task_id} 查看进度"
-        }
-    finally:
-        lock.release()
+    task_id = _task_id("cont", patient_name, study_date, user_id)
+    patient_root = _patient_root(patient_name, study_date, user_id)
+    input_folder = os.path.join(patient_root, "input")
+    output_folder = os.path.join(patient_root, "output")
 
-def _run_continue_after_l3(task_id: str, input_folder: str, output_folder: str):
-    """后台任务：执行 continue_after_l3"""
-    start = time.time()
-    try:
-        if DEBUG_ENABLED:
-            _append_log_line(output_folder, f"[TASK {task_id}] ===== 开始 continue_after_l3() input={input_folder}")
-            if os.path.isdir(output_folder):
-                _append_log_line(output_folder, f"[TASK {task_id}] output初始: {os.listdir(output_folder)}")
-        print(f"[后台任务 {task_id}] 开始处理...")
-        task_status[task_id]["progress"] = 10
-        task_status[task_id]["message"] = "正在读取 DICOM 和 L3 mask..."
-        result = continue_after_l3(input_folder, output_folder)
-        elapsed = time.time() - start
-        print(f"[后台任务 {task_id}] 处理完成")
-        if DEBUG_ENABLED:
-            _append_log_line(output_folder, f"[TASK {task_id}] continue_after_l3() 完成 耗时={elapsed:.2f}s")
-        task_status[task_id] = {
-            "status": "completed",
-            "progress": 100,
-            "message": "处理完成",
-            "result": result,
-            "started_at": task_status[task_id].get("started_at"),
-            "completed_at": time.time(),
-            "duration": elapsed
-        }
-    except Exception as e:
-        tb = traceback.format_exc()
-        print(f"[后台任务 {task_id}] 处理失败: {e}")
-        if DEBUG_ENABLED:
-            _append_log_line(output_folder, f"[TASK {task_id}] continue_after_l3 异常: {e}\n{tb}")
-        task_status[task_id] = {
-            "status": "failed",
-            "progress": 0,
-            "message": f"处理失败: {str(e)}",
-            "error": str(e),
-            "started_at": task_status[task_id].get("started_at"),
-            "failed_at": time.time()
-        }
+    return await _enqueue_job(
+        task_id, "continue_after_l3",
+        {"input_folder": input_folder, "output_folder": output_folder, "profile": profile},
+        user_id=user_id,
+        submitted_message="任务已提交到后台处理，请轮询 /task_status/{task_id} 查看进度",
+    )
 
 @app.get("/task_status/{task_id}")
-def get_task_status(task_id: str):
-    """查询任务状态"""
-    if task_id not in task_status:
-        return {
-            "status": "not_found",
-            "message": "任务不存在"
-        }
-    return task_status[task_id]
+def get_task_status(request: Request, task_id: str):
+    """查询任务状态（任务记录持久化在队列中，服务重启后仍可查询）；排队中的任务带 position
+
+    启用认证时只能查询自己提交的任务，其他用户的任务返回 404
+    """
+    user_id = getattr(request.state, "user_id", None) if ENABLE_AUTH else None
+    queue = get_job_queue()
+    job = queue.latest(task_id)
+    if job is not None and user_id is not None and job["user_id"] != str(user_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job_status(job, queue.position(job))
+
+# 事件流：服务端轮询事件表的间隔（秒）与空闲时的保活注释间隔（秒）
+EVENT_POLL_SECONDS = float(os.environ.get("IDOCTOR_EVENT_POLL_SECONDS", "0.5"))
+EVENT_KEEPALIVE_SECONDS = 15
+
+def _sse(event_id, data):
+    return f"id: {event_id}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+async def _event_stream(request: Request, task_id=None, user_id=None, last_event_id=None):
+    """把任务事件表转成 SSE：没有 Last-Event-ID 时先推送当前状态快照，之后推送新事件
+
+    单任务流在该任务最近一次提交结束（completed / failed）后关闭
+    """
+    queue = get_job_queue()
+    if last_event_id is None:
+        last_event_id = await asyncio.to_thread(queue.last_event_id)
+        if task_id is not None:
+            job = await asyncio.to_thread(queue.latest, task_id)
+            snapshot = [job] if job is not None and (user_id is None or job["user_id"] == str(user_id)) else []
+        else:
+            snapshot = await asyncio.to_thread(queue.active_jobs, user_id)
+        for job in snapshot:
+            status = job_status(job, await asyncio.to_thread(queue.position, job))
+            yield _sse(last_event_id, {"event": "snapshot", "task_id": job["task_id"], **status})
+        if task_id is not None:
+            if not snapshot:
+                yield _sse(last_event_id, {"event": "snapshot", "task_id": task_id, **job_status(None)})
+                return
+            if job_status(snapshot[0])["status"] in TERMINAL_STATUSES:
+                return
+    idle_since = time.time()
+    while not await request.is_disconnected():
+        events = await asyncio.to_thread(queue.events, last_event_id, task_id, user_id)
+        for event in events:
+            last_event_id = event["id"]
+            yield _sse(event["id"], {"event": event["event"], **event["data"]})
+            if task_id is not None and event["data"]["status"] in TERMINAL_STATUSES:
+                latest = await asyncio.to_thread(queue.latest, task_id)
+                if latest is None or latest["id"] == event["job_id"]:
+                    return
+        if events:
+            idle_since = time.time()
+            continue
+        if time.time() - idle_since > EVENT_KEEPALIVE_SECONDS:
+            idle_since = time.time()
+            yield ": keepalive\n\n"
+        await asyncio.sleep(EVENT_POLL_SECONDS)
+
+def _event_response(request: Request, task_id=None, last_event_id=None):
+    # 浏览器 EventSource 断线重连时自动带 Last-Event-ID 头，脚本也可以用 ?last_event_id= 续传
+    header = request.headers.get("last-event-id")
+    if last_event_id is None and header and header.isdigit():
+        last_event_id = int(header)
+    user_id = getattr(request.state, "user_id", None) if ENABLE_AUTH else None
+    return StreamingResponse(
+        _event_stream(request, task_id=task_id, user_id=user_id, last_event_id=last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/task_events/{task_id}")
+def task_events(request: Request, task_id: str, last_event_id: int = Query(None)):
+    """单个任务的状态推送（SSE）：阶段切换、切片进度、完成 / 失败，替代轮询 /task_status"""
+    return _event_response(request, task_id=task_id, last_event_id=last_event_id)
+
+@app.get("/task_events")
+def user_task_events(request: Request, last_event_id: int = Query(None)):
+    """当前用户所有任务的状态推送（SSE）；未启用认证时为全部任务"""
+    return _event_response(request, last_event_id=last_event_id)
 
 @app.get("/list_tasks")
 def list_tasks():
-    """列出所有任务及其状态"""
+    """列出所有任务（每个 task_id 最近一次提交）及其状态"""
+    queue = get_job_queue()
+    jobs = queue.list_latest()
     return {
-        "tasks": task_status,
-        "count": len(task_status)
+        "tasks": {job["task_id"]: job_status(job, queue.position(job)) for job in jobs},
+        "count": len(jobs),
+        "queue": queue.counts(),
+        # 本进程内嵌 worker 的资源占用（独立 worker 进程各自记账）
+        "admission": get_admission_controller().snapshot() if EMBEDDED_WORKERS > 0 else None,
+        "interactive_admission": get_interactive_admission_controller().snapshot() if INTERACTIVE_WORKERS > 0 else None
     }
 
 @app.get("/debug_log/{patient_name}/{study_date}")
@@ -766,24 +857,21 @@ async def upload_l3_mask(request: Request, patient: str, date: str, file: Upload
     user_id = getattr(request.state, "user_id", None)
     
     patient_root = _patient_root(patient, date, user_id)
+    input_folder = os.path.join(patient_root, "input")
     output_folder = os.path.join(patient_root, "output")
     png_dir = os.path.join(output_folder, "L3_png")
     if not os.path.exists(os.path.join(png_dir, SAGITTAL_CLEAN)):
         return {"error": "请先调用 /generate_sagittal"}
 
     mask_dir = os.path.join(output_folder, "L3_mask")
-    clean_dir = os.path.join(output_folder, "L3_clean_mask")
-    overlay_dir = os.path.join(output_folder, "L3_overlay")
-    for d in [mask_dir, clean_dir, overlay_dir]:
-        os.makedirs(d, exist_ok=True)
+    os.makedirs(mask_dir, exist_ok=True)
 
     save_path = os.path.join(mask_dir, SAGITTAL_CLEAN)
     with open(save_path, "wb") as f:
         f.write(await file.read())
 
-    from sagit_save import clean_mask_folder, overlay_and_save
-    clean_mask_folder(mask_dir, clean_dir)
-    overlay_and_save(png_dir, clean_dir, overlay_dir)
+    # 只重跑 L3 清理 + overlay；之后 /continue_after_l3 从横断面选取开始重算
+    refresh_l3_mask(input_folder, output_folder)
     return {"status": "ok", "message": "手动 L3 mask 已覆盖", "overlay": f"L3_overlay/{SAGITTAL_CLEAN}"}
 
 @app.post("/upload_middle_manual_mask/{patient}/{date}")
@@ -797,6 +885,7 @@ async def upload_middle_manual_mask(
     user_id = getattr(request.state, "user_id", None)
     
     patient_root = _patient_root(patient, date, user_id)
+    input_folder = os.path.join(patient_root, "input")
     output_folder = os.path.join(patient_root, "output")
     full_overlay_dir = os.path.join(output_folder, "full_overlay")
     manual_mask_dir = os.path.join(output_folder, "manual_middle_mask")
@@ -840,8 +929,10 @@ async def upload_middle_manual_mask(
     else:
         combo_mask_path = None
 
-    # 统计并生成 overlay
-    result = compute_manual_middle_statistics(axisal_path, psoas_mask_path, combo_mask_path, full_overlay_dir, base_name)
+    # 统计并生成 overlay：只重跑 metrics 阶段，上游产物沿用
+    result = apply_manual_middle_masks(input_folder, output_folder)
+    if result is None:
+        result = {"status": "ok", "message": "未上传手动 mask，已恢复自动分割结果"}
     
     # 清理 NaN/Inf 值
     import math
@@ -0,0 +1,147 @@
+import os
+import time
+import errno
+import filecmp
+import hashlib
+import threading
+import pydicom
+from dicom_series import list_dicom_files, parallel_map
+from pipeline_logging import write_log
+
+# 上传 DICOM 去重：相同 SOPInstanceUID + 像素数据的文件在各病例 input/ 中硬链接到同一个 blob
+BLOB_STORE_ENABLED = os.environ.get("IDOCTOR_BLOB_STORE", "1") not in ("0", "false", "False")
+BLOB_STORE_DIR = os.environ.get("IDOCTOR_BLOB_DIR", os.path.join("data", ".blobs"))
+# 上传完成后最多每隔多少秒清理一次无引用的 blob
+BLOB_GC_INTERVAL = int(os.environ.get("IDOCTOR_BLOB_GC_INTERVAL", "3600"))
+
+
+def content_key(path):
+    """SOPInstanceUID + 原始 PixelData 字节（不解码）的 sha256；缺少任一项时返回 None（不参与去重）"""
+    ds = pydicom.dcmread(path)
+    uid = str(ds.get("SOPInstanceUID", ""))
+    pixel = ds.get("PixelData")
+    if not uid or pixel is None:
+        return None
+    pixel_hash = hashlib.sha256(pixel).hexdigest()
+    return hashlib.sha256(f"{uid}|{pixel_hash}".encode()).hexdigest()
+
+
+class BlobStore:
+    """内容寻址的 DICOM 存储：<root>/<key[:2]>/<key>.dcm
+
+    病例 input/ 中的文件是 blob 的硬链接，引用计数即文件系统的链接数（st_nlink）：
+    删除 / 替换病例目录只会减少链接数，gc() 删除只剩 store 自身一个链接的 blob。
+    同一 key 但文件字节不同（例如头信息被重新匿名化）时保留病例自己的副本，不做链接。
+    """
+
+    def __init__(self, root=BLOB_STORE_DIR):
+        self.root = root
+        self._gc_lock = threading.Lock()
+        self._last_gc = 0.0
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.dcm")
+
+    def ingest_file(self, path):
+        """把 path 纳入存储，返回 "new"（新建 blob）/ "linked"（替换为已有 blob 的链接）/ "kept"（保留副本）"""
+        key = content_key(path)
+        if key is None:
+            return "kept"
+        blob = self._path(key)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+            return "new"
+        except FileExistsError:
+            pass
+        st_path, st_blob = os.stat(path), os.stat(blob)
+        if st_path.st_ino == st_blob.st_ino and st_path.st_dev == st_blob.st_dev:
+            return "linked"
+        if st_path.st_size != st_blob.st_size or not filecmp.cmp(path, blob, shallow=False):
+            return "kept"
+        tmp_path = path + ".link"
+        os.link(blob, tmp_path)
+        os.replace(tmp_path, path)
+        return "linked"
+
+    def ingest_folder(self, folder, log_root=None):
+        """对 folder 中所有 DICOM 去重（必须在解压写入全部完成之后调用，链接后的文件不可再写）
+
+        单个文件失败（跨文件系统、权限等）只保留原副本。返回各结果的计数。
+        """
+        t0 = time.time()
+        names = list_dicom_files(folder)
+        counts = {"new": 0, "linked": 0, "kept": 0, "error": 0}
+        for name, result, err in parallel_map(lambda n: self.ingest_file(os.path.join(folder, n)), names):
+            if err is None:
+                counts[result] += 1
+                continue
+            counts["error"] += 1
+            if counts["error"] == 1:
+                reason = "不在同一文件系统" if isinstance(err, OSError) and err.errno == errno.EXDEV else err
+                write_log(log_root, f"[BLOB] 去重失败 {name}: {reason}（保留原副本）")
+        write_log(log_root, f"[BLOB] ingest {folder} files={len(names)} {counts} time={time.time()-t0:.2f}s")
+        return counts
+
+    def _entries(self):
+        if not os.path.isdir(self.root):
+            return
+        for sub in os.listdir(self.root):
+            d = os.path.join(self.root, sub)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                if name.endswith(".dcm"):
+                    yield os.path.join(d, name)
+
+    def gc(self):
+        """删除没有任何病例引用（st_nlink == 1）的 blob，返回 (删除个数, 释放字节数)"""
+        removed, freed = 0, 0
+        with self._gc_lock:
+            for p in self._entries():
+                try:
+                    st = os.stat(p)
+                    if st.st_nlink <= 1:
+                        os.remove(p)
+                        removed += 1
+                        freed += st.st_size
+                except OSError:
+                    continue
+            self._last_gc = time.time()
+        return removed, freed
+
+    def maybe_gc(self, interval=BLOB_GC_INTERVAL):
+        """距上次清理超过 interval 秒时在后台线程中执行 gc()"""
+        if time.time() - self._last_gc < interval:
+            return False
+        self._last_gc = time.time()
+        threading.Thread(target=self.gc, name="blob-gc", daemon=True).start()
+        return True
+
+    def stats(self):
+        """物理占用（每个 blob 只算一次）与引用数"""
+        blobs, physical, refs = 0, 0, 0
+        for p in self._entries():
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            blobs += 1
+            physical += st.st_size
+            refs += st.st_nlink - 1
+        return {"root": os.path.abspath(self.root), "blobs": blobs, "bytes": physical, "references": refs}
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_blob_store():
+    """进程级共享的 blob 存储；IDOCTOR_BLOB_STORE=0 时返回 None"""
+    global _STORE
+    if not BLOB_STORE_ENABLED:
+        return None
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = BlobStore()
+        return _STORE
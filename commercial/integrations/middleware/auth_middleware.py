@@ -29,6 +29,11 @@ EXEMPT_PREFIX = [
     "/auth/"
 ]
 
+# 浏览器 EventSource 无法设置请求头，这些路径允许通过 ?access_token= 传递 token
+QUERY_TOKEN_PREFIX = [
+    "/task_events"
+]
+
 
 async def auth_middleware(request: Request, call_next):
     """JWT认证中间件
@@ -57,6 +62,10 @@ async def auth_middleware(request: Request, call_next):
 
     # 提取 Authorization header
     auth_header = request.headers.get("Authorization")
+    if not auth_header and any(path.startswith(p) for p in QUERY_TOKEN_PREFIX):
+        query_token = request.query_params.get("access_token")
+        if query_token:
+            auth_header = f"Bearer {query_token}"
 
     if not auth_header:
         logger.warning(f"Unauthorized request to {path}: No Authorization header")
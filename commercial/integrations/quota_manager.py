@@ -10,6 +10,7 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from uuid import UUID
 import json
+from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
@@ -249,3 +250,29 @@ class QuotaManager:
         except Exception as e:
             logger.error(f"Error getting all quotas: {e}", exc_info=True)
             return {}
+
+    async def get_active_plan(self, user_id: str) -> Optional[str]:
+        """获取用户当前有效订阅的计划名称（有多个时取价格最高的），没有订阅返回 None"""
+        try:
+            async with self.async_session() as session:
+                query = text("""
+                SELECT sp.name
+                FROM user_subscriptions us
+                JOIN subscription_plans sp ON us.plan_id = sp.id
+                WHERE us.user_id = :user_id
+                  AND us.status = 'active'
+                  AND us.current_period_end > :now
+                ORDER BY sp.price DESC
+                LIMIT 1
+                """)
+
+                result = await session.execute(
+                    query,
+                    {"user_id": user_id, "now": datetime.utcnow()}
+                )
+                row = result.fetchone()
+                return row[0] if row else None
+
+        except Exception as e:
+            logger.error(f"Error getting active plan: {e}", exc_info=True)
+            return None
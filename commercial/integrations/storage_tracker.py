@@ -65,6 +65,9 @@ def calculate_user_storage(user_id: str, data_root: str = "data") -> Dict[str, f
         - results_mb: 处理结果大小（MB）
         - total_mb: 总大小（MB）
         - patient_count: 患者病例数
+
+    input/ 中的 DICOM 可能是 data/.blobs 去重存储的硬链接（见 blob_store），
+    这里按每个病例各自的文件大小累加，报告的是用户的逻辑用量，与是否去重无关。
     """
     user_dir = os.path.join(data_root, str(user_id))
 
@@ -8,6 +8,7 @@ from tqdm import tqdm
 import pydicom
 from pydicom.pixel_data_handlers.util import apply_modality_lut
 import SimpleITK as sitk
+from dicom_series import parallel_map
 
 def load_dicom_hu(dicom_path):
     if dicom_path.lower().endswith(".dcm.pk"):
@@ -29,8 +30,9 @@ def load_dicom_hu(dicom_path):
         hu_image = apply_modality_lut(image, ds)
     return hu_image, pixel_size_mm
 
-def compute_mask_hu_statistics(dicom_path, mask_bool):
-    hu_image, pixel_size_mm = load_dicom_hu(dicom_path)
+def compute_mask_hu_statistics(dicom_path, mask_bool, hu=None):
+    """hu: 可选的 (HU 图像, 像素间距 mm)，给定时不再读取 dicom_path"""
+    hu_image, pixel_size_mm = hu if hu is not None else load_dicom_hu(dicom_path)
     # 可以匹配看mask对应的HU值
     if mask_bool.dtype != bool:
         mask_bool = mask_bool.astype(bool)
@@ -88,6 +90,29 @@ def overlay_mask_on_image(image_bgr, mask_uint8, color=(0, 255, 0), alpha=0.5):
     out = cv2.addWeighted(overlay, 1 - alpha, colored, alpha, 0)
     return out
 
+def _match_dicom(fname, dicom_files):
+    match = re.search(r'(\d+)', fname)
+    if not match:
+        return None
+    slice_id = match.group(1).zfill(3)
+    return next((f for f in dicom_files if slice_id in f), None)
+
+
+def _prefetch_slice_hu(img_paths, dicom_dir, dicom_files, workers=None):
+    """按文件名匹配到的 DICOM 多线程并行读取 HU，返回 {文件名: (HU 图像, 像素间距 mm)}
+
+    读取失败的条目不放入结果，之后仍走逐个读取的原逻辑（报错行为不变）。
+    """
+    pairs = []
+    for img_path in img_paths:
+        fname = os.path.basename(img_path)
+        dicom_match = _match_dicom(fname, dicom_files)
+        if dicom_match:
+            pairs.append((fname, os.path.join(dicom_dir, dicom_match)))
+    loaded = parallel_map(lambda pair: load_dicom_hu(pair[1]), pairs, workers)
+    return {fname: hu for (fname, _), hu, err in loaded if err is None}
+
+
 def process_all(
     psoas_mask_dir,
     full_mask_dir,
@@ -101,14 +126,27 @@ def process_all(
     area_ratio_thresh=0.05,
     morph_ksize=3,
     morph_iters=1,
-    overlay_alpha=0.5
+    overlay_alpha=0.5,
+    slice_images=None,
+    psoas_masks=None,
+    full_masks=None,
+    slice_hu=None
 ):
+    """slice_images / psoas_masks / full_masks: 可选的内存数据 {文件名: 数组}
+
+    传入时直接使用内存中的切片与 mask（内存推理路径），不再从目录 cv2.imread 回读。
+    slice_hu: 可选的 {文件名: (HU 图像, 像素间距 mm)}（见 DicomSeries.hu_by_name），
+              给定时直接使用已解码序列中对应 z 的 HU，不再按文件名匹配并重新读取 DICOM。
+    """
     os.makedirs(overlay_psoas_dir, exist_ok=True)
     os.makedirs(overlay_combo_dir, exist_ok=True)
     os.makedirs(clean_full_mask_dir, exist_ok=True)
 
 
-    img_paths = sorted(glob.glob(os.path.join(slice_dir, pattern)))
+    if slice_images is not None:
+        img_paths = [os.path.join(slice_dir, f) for f in sorted(slice_images)]
+    else:
+        img_paths = sorted(glob.glob(os.path.join(slice_dir, pattern)))
     if not img_paths:
         print("[警告] 未在 slice_dir 中找到任何图片：", slice_dir)
         return
@@ -118,7 +156,9 @@ def process_all(
         f for f in os.listdir(dicom_dir)
         if not f.startswith("._") and f.lower().endswith((".dcm", ".dcm.pk"))
     ])
-    
+    if slice_hu is None:
+        slice_hu = _prefetch_slice_hu(img_paths, dicom_dir, dicom_files)
+
     results = []
     valid_items = []
 
@@ -127,17 +167,26 @@ def process_all(
         psoas_path = os.path.join(psoas_mask_dir, fname)
         full_path  = os.path.join(full_mask_dir,  fname)
 
-        if not os.path.exists(psoas_path):
+        if psoas_masks is None and not os.path.exists(psoas_path):
             print(f"[跳过] 缺少腰大肌 mask：{psoas_path}")
             continue
-        if not os.path.exists(full_path):
+        if full_masks is None and not os.path.exists(full_path):
             print(f"[跳过] 缺少全肌肉 mask：{full_path}")
             continue
 
         # 读入
-        img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-        psoas_mask = cv2.imread(psoas_path, cv2.IMREAD_GRAYSCALE)
-        full_mask  = cv2.imread(full_path,  cv2.IMREAD_GRAYSCALE)
+        if slice_images is not None:
+            img = slice_images.get(fname)
+        else:
+            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+        if psoas_masks is not None:
+            psoas_mask = psoas_masks.get(fname)
+        else:
+            psoas_mask = cv2.imread(psoas_path, cv2.IMREAD_GRAYSCALE)
+        if full_masks is not None:
+            full_mask = full_masks.get(fname)
+        else:
+            full_mask  = cv2.imread(full_path,  cv2.IMREAD_GRAYSCALE)
         if img is None or psoas_mask is None or full_mask is None:
             print(f"[跳过] 读取失败：{fname}")
             continue
@@ -171,7 +220,10 @@ def process_all(
 
         # --- DICOM ---
         match = re.search(r'(\d+)', fname)
-        if match:
+        if slice_hu is not None and fname in slice_hu:
+            stat_psoas = compute_mask_hu_statistics(None, psoas_bin == 255, hu=slice_hu[fname])
+            stat_combo = compute_mask_hu_statistics(None, combo_mask == 255, hu=slice_hu[fname])
+        elif match:
             slice_id = match.group(1).zfill(3)
             dicom_match = next((f for f in dicom_files if slice_id in f), None)
             if dicom_match:
@@ -0,0 +1,516 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pydicom
+from model_registry import get_registry
+from pipeline_logging import write_log
+
+DICOM_EXTENSIONS = (".dcm", ".dcm.pk")
+# 进程内最多保留几个已解码的序列（同一病例的 main / 矢状面 / 分割 / 统计共用一次解码）
+SERIES_CACHE_SIZE = int(os.environ.get("IDOCTOR_SERIES_CACHE_SIZE", "2"))
+SERIES_IDLE_SECONDS = int(os.environ.get("IDOCTOR_SERIES_IDLE_SECONDS", "600"))
+# 整序列读取方式：volume = 解码完整体数据（写 volume_cache）；stream = 逐张流式读取，只保留中间矢状面，
+# 峰值内存约为 IDOCTOR_DICOM_WORKERS 张切片，适合一个 worker 同时处理多个大病例
+DICOM_LOAD_MODE = os.environ.get("IDOCTOR_DICOM_LOAD_MODE", "volume")
+# DICOM 读取/解码线程数："auto" = min(8, CPU 核数)，1 = 顺序读取
+DICOM_WORKERS = os.environ.get("IDOCTOR_DICOM_WORKERS", "auto")
+
+# 病例级体数据缓存：<病例目录>/volume_cache/volume.npy（int16/float32，内存映射打开）+ volume_meta.json
+VOLUME_CACHE_ENABLED = os.environ.get("IDOCTOR_VOLUME_CACHE", "1") not in ("0", "false", "False")
+VOLUME_CACHE_DIRNAME = "volume_cache"
+VOLUME_FILE = "volume.npy"
+SAGITTAL_FILE = "sagittal_mid.npy"
+VOLUME_META = "volume_meta.json"
+VOLUME_CACHE_VERSION = 1
+
+_SERIES_REGISTRY = get_registry("dicom_series", max_models=SERIES_CACHE_SIZE, idle_timeout=SERIES_IDLE_SECONDS)
+
+
+def list_dicom_files(folder):
+    """与各处旧代码一致：跳过 ._ 开头的 macOS 元数据文件，只取 .dcm / .dcm.pk"""
+    return sorted(
+        f for f in os.listdir(folder)
+        if not f.startswith("._") and f.lower().endswith(DICOM_EXTENSIONS)
+    )
+
+
+def folder_signature(folder):
+    """(文件名, 大小, mtime) 列表，用于判断进程内缓存是否仍然有效"""
+    sig = []
+    for f in list_dicom_files(folder):
+        try:
+            st = os.stat(os.path.join(folder, f))
+        except OSError:
+            continue
+        sig.append((f, st.st_size, int(st.st_mtime)))
+    return tuple(sig)
+
+
+def input_signature(input_dir):
+    """上传目录签名（文件名 + 大小 + inode + mtime_ns），流水线 load 阶段指纹与体数据缓存失效判断共用
+
+    重新上传同名同大小的文件时，解压 / 去重链接产生的是新文件（inode、mtime 不同），签名随之变化。
+    """
+    files = [f for f in os.listdir(input_dir) if f.lower().endswith(DICOM_EXTENSIONS)]
+    files.sort()
+    h = hashlib.sha256()
+    sizes = []
+    for f in files:
+        p = os.path.join(input_dir, f)
+        try:
+            st = os.stat(p)
+            h.update(f"{f}|{st.st_size}|{st.st_ino}|{st.st_mtime_ns}|".encode())
+            sizes.append(st.st_size)
+        except Exception:
+            continue
+    return {
+        "count": len(files),
+        "hash": h.hexdigest(),
+        "total_bytes": sum(sizes)
+    }
+
+
+# 头信息索引只解析这些标签（stop_before_pixels，不读像素数据）
+HEADER_TAGS = [
+    "SOPInstanceUID", "SeriesInstanceUID", "InstanceNumber",
+    "ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing", "SliceThickness",
+    "RescaleSlope", "RescaleIntercept", "Rows", "Columns",
+]
+
+
+def decode_workers(workers=None):
+    if workers is None:
+        workers = DICOM_WORKERS
+    if workers in ("auto", "", 0):
+        return max(1, min(8, os.cpu_count() or 1))
+    return max(1, int(workers))
+
+
+def parallel_map(fn, items, workers=None):
+    """在有界线程池中对每个文件执行 fn，按输入顺序返回 [(item, result, error)]
+
+    pydicom 读文件与 NumPy / 解压缩解码大部分时间释放 GIL，多线程即可并行；
+    单个文件出错只记录在对应的 error 中，不影响其它文件。
+    """
+    items = list(items)
+
+    def run(item):
+        try:
+            return item, fn(item), None
+        except Exception as e:
+            return item, None, e
+
+    n = min(decode_workers(workers), len(items))
+    if n <= 1:
+        return [run(item) for item in items]
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="dicom-read") as pool:
+        return list(pool.map(run, items))
+
+
+def _float_list(value):
+    try:
+        return [float(v) for v in value]
+    except Exception:
+        return None
+
+
+def read_header(ds, path):
+    """从 Dataset 中取出排序、命名、换算 HU 需要的字段"""
+    pixel_spacing = _float_list(ds.get("PixelSpacing")) or [1.0, 1.0]
+    try:
+        instance_number = int(ds.get("InstanceNumber"))
+    except Exception:
+        instance_number = None
+    return {
+        "path": path,
+        "file": os.path.basename(path),
+        "sop_instance_uid": str(ds.get("SOPInstanceUID", "")),
+        "series_instance_uid": str(ds.get("SeriesInstanceUID", "")),
+        "instance_number": instance_number,
+        "position": _float_list(ds.get("ImagePositionPatient")),
+        "orientation": _float_list(ds.get("ImageOrientationPatient")),
+        "pixel_spacing": pixel_spacing,
+        "slice_thickness": float(ds.get("SliceThickness", 0) or 0),
+        "slope": float(ds.get("RescaleSlope", 1)),
+        "intercept": float(ds.get("RescaleIntercept", 0)),
+        "rows": int(ds.get("Rows", 0)),
+        "columns": int(ds.get("Columns", 0)),
+    }
+
+
+def z_sort_key(header):
+    """ImagePositionPatient[2] 升序，缺失时退回 InstanceNumber（与 extract_slice._read_sorted_series 一致）"""
+    if header["position"] and len(header["position"]) >= 3:
+        return header["position"][2]
+    return float(header["instance_number"] or 0)
+
+
+def slice_name(header, z_idx):
+    """slice_XXX，编号取 InstanceNumber，缺失时用 z 索引"""
+    inst = header["instance_number"]
+    return f"slice_{(z_idx if inst is None else inst):03d}"
+
+
+def _select_series(headers, folder, log_root=None):
+    """目录内混有多个序列时只保留文件数最多的那个"""
+    counts = Counter(h["series_instance_uid"] for h in headers)
+    if len(counts) <= 1:
+        return headers
+    uid, n = counts.most_common(1)[0]
+    write_log(log_root, f"[DICOM] {folder} 含 {len(counts)} 个序列，使用 {uid} ({n} 张)")
+    return [h for h in headers if h["series_instance_uid"] == uid]
+
+
+def _z_spacing(headers):
+    zs = [h["position"][2] for h in headers if h["position"] and len(h["position"]) >= 3]
+    if len(zs) >= 2:
+        diffs = np.abs(np.diff(zs))
+        diffs = diffs[diffs > 1e-6]
+        if len(diffs):
+            return float(np.median(diffs))
+    thickness = headers[0]["slice_thickness"] if headers else 0
+    return float(thickness) if thickness else 1.0
+
+
+def _volume_dtype(headers):
+    """斜率/截距均为整数时用 int16（与 SimpleITK 对常规 CT 的输出一致），否则 float32"""
+    integral = all(float(h["slope"]).is_integer() and float(h["intercept"]).is_integer() for h in headers)
+    return np.int16 if integral else np.float32
+
+
+def to_hu(pixel_array, header):
+    """与 dicom_to_uint8 相同的换算：float32(pixel) * slope + intercept"""
+    return pixel_array.astype(np.float32) * header["slope"] + header["intercept"]
+
+
+def decode_hu(header):
+    """读取并解码单个文件的像素，返回 float32 HU"""
+    return to_hu(pydicom.dcmread(header["path"]).pixel_array, header)
+
+
+def _fits_int16(hu):
+    return hu.min() >= -32768 and hu.max() <= 32767
+
+
+class DicomSeries:
+    """一次解码得到的 DICOM 序列
+
+    volume : [Z, Y, X] HU 数组，Z 按 ImagePositionPatient[2] 升序（与 SimpleITK 读取顺序一致）
+    headers: 与 volume 第 0 维一一对应的头信息（见 read_header）
+    spacing: (x, y, z) 毫米，与 SimpleITK Image.GetSpacing() 的顺序相同
+
+    volume 为 None 时是只有头信息的索引（见 index_series），像素在 hu(z) 时才按需解码。
+    """
+
+    def __init__(self, folder, volume, headers, spacing, sagittal_mid=None, cached=False):
+        self.folder = folder
+        self.volume = volume
+        self.headers = headers
+        self.spacing = spacing
+        self.cached = cached
+        self.dtype = volume.dtype if volume is not None else np.dtype(_volume_dtype(headers))
+        self._sagittal_mid = sagittal_mid
+        self._sagittal_slab = None
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.headers)
+
+    @property
+    def shape(self):
+        if self.volume is not None:
+            return tuple(self.volume.shape)
+        return (len(self.headers), self.headers[0]["rows"], self.headers[0]["columns"])
+
+    def _decode_slice(self, z_idx):
+        hu = decode_hu(self.headers[z_idx])
+        if self.dtype == np.int16 and _fits_int16(hu):
+            return hu.astype(np.int16)
+        return hu
+
+    def preload(self, z_indices, workers=None):
+        """只解码选中的切片（索引模式下使用，多线程并行；已有体数据时什么都不做）"""
+        if self.volume is not None:
+            return
+        todo = [z for z in sorted(set(z_indices)) if 0 <= z < len(self) and z not in self._decoded]
+        for z, hu, err in parallel_map(self._decode_slice, todo, workers):
+            if err is not None:
+                print(f"[跳过] 解码失败 {self.headers[z]['file']}: {err}")
+                continue
+            self._decoded[z] = hu
+
+    def hu(self, z_idx):
+        """第 z 张的 HU 图像"""
+        if self.volume is not None:
+            return self.volume[z_idx]
+        if z_idx not in self._decoded:
+            self._decoded[z_idx] = self._decode_slice(z_idx)
+        return self._decoded[z_idx]
+
+    def sagittal_mid(self):
+        """中间矢状面 volume[:, :, X // 2]；来自缓存时直接读预存的平面，不必逐页访问整个体数据"""
+        if self._sagittal_mid is None:
+            if self.volume is not None:
+                self._sagittal_mid = np.ascontiguousarray(self.volume[:, :, self.shape[2] // 2])
+            else:
+                self.stream()
+        return self._sagittal_mid
+
+    def sagittal_slab(self):
+        """stream(slab=k) 保留的中间矢状面附近 [Z, Y, 2k+1] 列"""
+        return self._sagittal_slab
+
+    def stream(self, slab=0, keep=(), workers=None):
+        """索引模式下按 z 顺序单遍读取整个序列：每张只取中间矢状面附近 ±slab 列，
+        keep 中的 z 整张保留（之后 hu(z) 不再解码），其余像素读完即丢弃。
+
+        每批解码 decode_workers() 张，峰值内存约为一批切片 + 矢状面本身。
+        """
+        n, rows, cols = self.shape
+        x_mid = cols // 2
+        lo, hi = max(0, x_mid - slab), min(cols, x_mid + slab + 1)
+        keep = set(keep)
+        planes = np.empty((n, rows, hi - lo), dtype=self.dtype)
+        batch = decode_workers(workers)
+        for start in range(0, n, batch):
+            zs = range(start, min(n, start + batch))
+            for z, hu, err in parallel_map(self._decode_slice, zs, workers):
+                if err is not None:
+                    raise RuntimeError(f"解码失败 {self.headers[z]['file']}: {err}")
+                if hu.dtype != planes.dtype:
+                    planes = planes.astype(np.float32)
+                planes[z] = hu[:, lo:hi]
+                if z in keep:
+                    self._decoded[z] = hu
+        self._sagittal_slab = planes
+        self._sagittal_mid = np.ascontiguousarray(planes[:, :, x_mid - lo])
+        return self._sagittal_mid
+
+    @property
+    def paths(self):
+        return [h["path"] for h in self.headers]
+
+    @property
+    def reference_path(self):
+        """中间一张的路径（矢状面 DICOM 的元数据模板）"""
+        return self.headers[len(self.headers) // 2]["path"]
+
+    def slice_name(self, z_idx):
+        return slice_name(self.headers[z_idx], z_idx)
+
+    def pixel_size_mm(self, z_idx):
+        return float(self.headers[z_idx]["pixel_spacing"][0])
+
+    def hu_by_name(self, z_indices):
+        """{slice_XXX.png: (HU 切片, 像素间距 mm)}，供 compute.process_all 直接使用"""
+        z_indices = [z for z in sorted(set(z_indices)) if 0 <= z < len(self)]
+        self.preload(z_indices)
+        return {f"{self.slice_name(z)}.png": (self.hu(z), self.pixel_size_mm(z)) for z in z_indices}
+
+
+def _spacing(headers):
+    row_spacing, col_spacing = headers[0]["pixel_spacing"][:2]
+    return (float(col_spacing), float(row_spacing), _z_spacing(headers))
+
+
+def _index_headers(folder, log_root=None):
+    """头信息索引：每个文件只解析 HEADER_TAGS，返回排序、去除其它序列后的头信息列表"""
+    t0 = time.time()
+
+    def read(path):
+        return read_header(pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS), path)
+
+    headers = []
+    paths = [os.path.join(folder, f) for f in list_dicom_files(folder)]
+    for path, header, err in parallel_map(read, paths):
+        if err is not None:
+            print(f"[跳过] 读取失败 {os.path.basename(path)}: {err}")
+            continue
+        headers.append(header)
+    if not headers:
+        raise RuntimeError(f"未找到 DICOM: {folder}")
+    headers = sorted(_select_series(headers, folder, log_root), key=z_sort_key)
+    write_log(log_root, f"[DICOM] indexed {folder} slices={len(headers)} time={time.time()-t0:.2f}s")
+    return headers
+
+
+def _decode_series(folder, log_root=None):
+    """整个序列解码为体数据：先建头信息索引确定 z 顺序，再多线程把每张切片解码进对应的位置"""
+    t0 = time.time()
+    headers = _index_headers(folder, log_root)
+    rows, cols = headers[0]["rows"], headers[0]["columns"]
+    dtype = _volume_dtype(headers)
+    volume = np.empty((len(headers), rows, cols), dtype=dtype)
+    overflow = {}
+
+    def fill(z):
+        hu = decode_hu(headers[z])
+        if hu.shape != (rows, cols):
+            raise RuntimeError(f"切片尺寸不一致: {headers[z]['file']} {hu.shape} != {(rows, cols)}")
+        if dtype == np.int16 and not _fits_int16(hu):
+            overflow[z] = hu
+        else:
+            volume[z] = hu
+
+    for z, _, err in parallel_map(fill, range(len(headers))):
+        if err is not None:
+            raise RuntimeError(f"解码失败 {headers[z]['file']}: {err}")
+    if overflow:
+        volume = volume.astype(np.float32)
+        for z, hu in overflow.items():
+            volume[z] = hu
+
+    spacing = _spacing(headers)
+    write_log(log_root, f"[DICOM] decoded {folder} slices={len(headers)} shape={volume.shape} "
+                        f"dtype={volume.dtype} spacing={spacing} workers={decode_workers()} time={time.time()-t0:.2f}s")
+    return DicomSeries(folder, volume, headers, spacing)
+
+
+def volume_cache_dir(folder):
+    """缓存放在 input/ 旁边：data/<病例>/volume_cache"""
+    return os.path.join(os.path.dirname(os.path.abspath(folder)), VOLUME_CACHE_DIRNAME)
+
+
+def _portable_headers(headers):
+    return [{k: v for k, v in h.items() if k != "path"} for h in headers]
+
+
+def remove_volume_cache(folder):
+    """删除病例的体数据缓存（上传替换 input 后调用，旧体数据不会再被读到）"""
+    shutil.rmtree(volume_cache_dir(folder), ignore_errors=True)
+
+
+def _replace_atomic(cache_dir, name, write, mode="wb"):
+    """在缓存目录内用唯一临时文件写完再原子替换，多个进程同时写同一病例时互不覆盖临时文件"""
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=name + ".", suffix=".part")
+    try:
+        with os.fdopen(fd, mode, encoding=None if "b" in mode else "utf-8") as f:
+            write(f)
+        os.replace(tmp_path, os.path.join(cache_dir, name))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_volume_cache(series, signature=None):
+    """把解码后的体数据写成 .npy（先写临时 .part 再原子替换），最后写 meta；meta 存在即代表缓存完整"""
+    cache_dir = volume_cache_dir(series.folder)
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, VOLUME_META)
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+    for name, arr in ((VOLUME_FILE, series.volume), (SAGITTAL_FILE, series.sagittal_mid())):
+        _replace_atomic(cache_dir, name, lambda f, arr=arr: np.save(f, np.ascontiguousarray(arr)))
+    meta = {
+        "version": VOLUME_CACHE_VERSION,
+        "signature": signature or input_signature(series.folder),
+        "shape": list(series.volume.shape),
+        "dtype": str(series.volume.dtype),
+        "spacing": list(series.spacing),
+        "orientation": series.headers[0]["orientation"],
+        "headers": _portable_headers(series.headers),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    _replace_atomic(cache_dir, VOLUME_META, lambda f: json.dump(meta, f, ensure_ascii=False), mode="w")
+    return cache_dir
+
+
+def open_volume_cache(folder, signature=None):
+    """签名一致时以只读内存映射打开缓存，返回 DicomSeries；缓存缺失或过期返回 None"""
+    cache_dir = volume_cache_dir(folder)
+    meta_path = os.path.join(cache_dir, VOLUME_META)
+    if not os.path.isfile(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != VOLUME_CACHE_VERSION:
+            return None
+        if meta.get("signature") != (signature or input_signature(folder)):
+            return None
+        volume = np.load(os.path.join(cache_dir, VOLUME_FILE), mmap_mode="r")
+        if list(volume.shape) != meta["shape"]:
+            return None
+        sagittal_path = os.path.join(cache_dir, SAGITTAL_FILE)
+        sagittal = np.load(sagittal_path) if os.path.isfile(sagittal_path) else None
+    except Exception as e:
+        print(f"[volume_cache] 读取失败，重新解码: {e}")
+        return None
+    headers = [dict(h, path=os.path.join(folder, h["file"])) for h in meta["headers"]]
+    return DicomSeries(folder, volume, headers, tuple(meta["spacing"]), sagittal_mid=sagittal, cached=True)
+
+
+def _load_or_decode(folder, log_root=None):
+    if not VOLUME_CACHE_ENABLED:
+        return _decode_series(folder, log_root)
+    t0 = time.time()
+    signature = input_signature(folder)
+    series = open_volume_cache(folder, signature)
+    if series is not None:
+        write_log(log_root, f"[DICOM] volume_cache hit {volume_cache_dir(folder)} shape={series.shape} time={time.time()-t0:.3f}s")
+        return series
+    series = _decode_series(folder, log_root)
+    try:
+        cache_dir = write_volume_cache(series, signature)
+        write_log(log_root, f"[DICOM] volume_cache written {cache_dir}")
+    except Exception as e:
+        write_log(log_root, f"[DICOM] volume_cache write failed: {e}")
+    return series
+
+
+def load_series(folder, log_root=None):
+    """读取整个序列；同一目录内容不变时，进程内各阶段复用同一个 DicomSeries
+
+    进程外（重启、其它 worker、之后的请求）通过 volume_cache 以内存映射方式复用，
+    只有第一次才真正解码 DICOM。
+    """
+    folder = os.path.abspath(folder)
+    key = (folder, folder_signature(folder))
+    return _SERIES_REGISTRY.get(key, lambda: _load_or_decode(folder, log_root))
+
+
+def index_series(folder, log_root=None):
+    """只需要少量切片时使用：体数据缓存有效则直接内存映射打开，否则只建头信息索引
+
+    返回的 DicomSeries 在索引模式下 volume 为 None，hu(z) / preload() 只解码选中的切片。
+    """
+    folder = os.path.abspath(folder)
+    key = ("index", folder, folder_signature(folder))
+
+    def loader():
+        if VOLUME_CACHE_ENABLED:
+            series = open_volume_cache(folder)
+            if series is not None:
+                write_log(log_root, f"[DICOM] volume_cache hit {volume_cache_dir(folder)} shape={series.shape}")
+                return series
+        headers = _index_headers(folder, log_root)
+        return DicomSeries(folder, None, headers, _spacing(headers))
+
+    return _SERIES_REGISTRY.get(key, loader)
+
+
+def stream_series(folder, log_root=None, slab=0, keep=()):
+    """流式读取：头信息索引 + 单遍计算中间矢状面（体数据缓存有效时直接映射，不再读取 DICOM）"""
+    series = index_series(folder, log_root)
+    if series.volume is None and series._sagittal_mid is None:
+        t0 = time.time()
+        series.stream(slab=slab, keep=keep)
+        write_log(log_root, f"[DICOM] streamed {folder} slices={len(series)} slab={slab} keep={len(set(keep))} "
+                            f"workers={decode_workers()} time={time.time()-t0:.2f}s")
+    return series
+
+
+def open_series(folder, log_root=None):
+    """需要中间矢状面的阶段（main / generate_sagittal）按 IDOCTOR_DICOM_LOAD_MODE 选择读取方式"""
+    if DICOM_LOAD_MODE == "stream":
+        return stream_series(folder, log_root)
+    return load_series(folder, log_root)
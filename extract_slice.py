@@ -4,16 +4,24 @@ import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 import os
+from dicom_series import index_series, parallel_map
+from windowing import HU_WINDOW, apply_window, apply_window_stack, dataset_to_uint8
 
 # === Step 1: Load DICOM Series into Volume ===
 def load_dicom_series(folder_path):
-    dicom_files = [
-        pydicom.dcmread(os.path.join(folder_path, f))
-        for f in os.listdir(folder_path) if f.lower().endswith((".dcm", ".dcm.pk"))
-    ]
-    dicom_files.sort(key=lambda ds: float(ds.ImagePositionPatient[2]))  # sort by Z
-
-    volume = np.stack([apply_modality_lut(ds.pixel_array, ds) for ds in dicom_files])
+    def read(path):
+        ds = pydicom.dcmread(path)
+        return ds, apply_modality_lut(ds.pixel_array, ds)
+
+    paths = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith((".dcm", ".dcm.pk"))]
+    loaded = parallel_map(read, paths)  # 多线程读取，结果保持输入顺序
+    for _, _, err in loaded:
+        if err is not None:
+            raise err
+    pairs = sorted((r for _, r, _ in loaded), key=lambda r: float(r[0].ImagePositionPatient[2]))  # sort by Z
+    dicom_files = [ds for ds, _ in pairs]
+
+    volume = np.stack([hu for _, hu in pairs])
     return volume, dicom_files
 
 # === Step 2: Create or Load a Binary Mask on a Sagittal Slice ===
@@ -40,11 +48,12 @@ def extract_axial_slices_from_sagittal_mask(volume, mask, x_idx, save_images=Fal
     for z in range(mask.shape[0]):  # loop over Z (slices)
         for y in range(mask.shape[1]):  # loop over Y (rows)
             if mask[z, y]:  # if mask is active
-                axial_slice = volume[z, :, :]
+                # volume 可以为 None（只需要 z 索引时不必解码体数据）
+                axial_slice = volume[z, :, :] if volume is not None else None
                 axial_slices.append((z, y, axial_slice))
                 axial_slice_numbers.append(z)
 
-                if save_images:
+                if save_images and axial_slice is not None:
                     plt.imshow(axial_slice, cmap='bone')
                     plt.scatter([x_idx], [y], color='red', s=30)
                     plt.title(f"Axial Slice Z={z}, Y={y}, X={x_idx}")
@@ -69,12 +78,8 @@ def reversedNumber (total_length, sliceNumbers):
     return reversed_sub_list
 
 #Convert slices of Axis corresponding to Sagittal to png
-def dicom_to_png(ds, output_path, default_center=None, default_width=None):
-    # Step 1: Read and convert to HU using RescaleSlope and RescaleIntercept
-    pixel_array = ds.pixel_array.astype(np.float32)
-    slope = float(ds.get("RescaleSlope", 1))
-    intercept = float(ds.get("RescaleIntercept", 0))
-    hu = pixel_array * slope + intercept
+def dicom_to_uint8(ds, default_center=None, default_width=None):
+    # Step 1: RescaleSlope / RescaleIntercept 与窗口合并为一张查找表，直接对存储值查表（见 windowing）
 
     # Step 2: Get or define window center/width
     # wc_raw = ds.get("WindowCenter", np.mean(hu))
@@ -86,17 +91,19 @@ def dicom_to_png(ds, output_path, default_center=None, default_width=None):
     # Step 3: Clip values to window range
     # min_val = center - width / 2
     # max_val = center + width / 2
+    return dataset_to_uint8(ds, window=HU_WINDOW)
+
+
+def hu_to_uint8(hu):
     """
     2025/10/04
-    使用 HU 值的 0 到 100 范围进行线性归一
+    使用 HU 值的 -100 到 200 范围进行线性归一（int16 HU 查表，浮点 HU 逐像素计算，结果一致）
     """
-    min_val = -100
-    max_val = 200
-    hu_clipped = np.clip(hu, min_val, max_val)
+    return apply_window(hu, window=HU_WINDOW)
+
 
-    # Step 4: Normalize to 0-255
-    hu_norm = ((hu_clipped - min_val) / (max_val - min_val)) * 255.0
-    hu_uint8 = np.clip(hu_norm, 0, 255).astype(np.uint8)
+def dicom_to_png(ds, output_path, default_center=None, default_width=None):
+    hu_uint8 = dicom_to_uint8(ds, default_center=default_center, default_width=default_width)
 
     # Step 5: Save image
     Image.fromarray(hu_uint8).save(output_path)
@@ -105,76 +112,75 @@ def dicom_to_png(ds, output_path, default_center=None, default_width=None):
 
 
 def convert_selected_slices(dicom_folder, output_folder, selected_slices):
+    """按 InstanceNumber 导出切片：先只读头信息挑出选中的文件，再只解码这些文件"""
     os.makedirs(output_folder, exist_ok=True)
+    series = index_series(dicom_folder)
+    selected = set(selected_slices)
+    z_indices = [z for z, h in enumerate(series.headers) if h["instance_number"] in selected]
 
-    for filename in sorted(os.listdir(dicom_folder)):
-        if filename.startswith("._"):
-            continue
-
-        if not filename.lower().endswith((".dcm", ".dcm.pk")):
-            continue
-
-        dicom_path = os.path.join(dicom_folder, filename)
+    for z_idx in z_indices:
+        header = series.headers[z_idx]
         try:
-            ds = pydicom.dcmread(dicom_path)
-            instance_number = int(ds.get("InstanceNumber", -1))
-
-            if instance_number in selected_slices:
-                output_filename = f"slice_{instance_number:03d}_0000.png"
-                output_path = os.path.join(output_folder, output_filename)
-                dicom_to_png(ds, output_path)
-
+            output_filename = f"slice_{header['instance_number']:03d}_0000.png"
+            output_path = os.path.join(output_folder, output_filename)
+            hu_uint8 = hu_to_uint8(series.hu(z_idx))
+            Image.fromarray(hu_uint8).save(output_path)
+            print("imageShape:", hu_uint8.shape)
+            print(f"Saved PNG: {output_path}")
         except Exception as e:
-            print(f"Error processing {filename}: {e}")
+            print(f"Error processing {header['file']}: {e}")
 
 
 def convert_selected_slices_by_z_index(dicom_folder, output_folder, selected_z_indices,
-                                       default_center=None, default_width=None):
+                                       default_center=None, default_width=None, series=None):
     """
     根据构建 volume 时的物理顺序 (ImagePositionPatient[2] -> 排序) 用 z 索引导出对应切片。
     selected_z_indices: 直接来自 extract_axial_slices_from_sagittal_mask 返回的 z list
+    series: DicomSeries（见 dicom_series），为空时只建头信息索引，仅解码选中的切片
     """
     os.makedirs(output_folder, exist_ok=True)
-    # 读取并收集
-    ds_list = []
-    for f in os.listdir(dicom_folder):
-        if f.startswith("._"):
-            continue
-        if not f.lower().endswith((".dcm", ".dcm.pk")):
-            continue
-        path = os.path.join(dicom_folder, f)
-        try:
-            ds = pydicom.dcmread(path)
-            ds_list.append(ds)
-        except Exception as e:
-            print(f"[跳过] 读取失败 {f}: {e}")
-    if not ds_list:
-        print("[警告] 没有可用 DICOM")
-        return
-
-    # 排序（与 SimpleITK 读取顺序对齐）
-    def z_key(ds):
-        try:
-            return float(ds.ImagePositionPatient[2])
-        except Exception:
-            return float(ds.get("InstanceNumber", 0))
-    ds_list.sort(key=z_key)
+    if series is None:
+        series = index_series(dicom_folder)
 
     sel_set = set(selected_z_indices)
     print(f"[INFO] 选中 z 索引数量: {len(sel_set)}  原始列表长度: {len(selected_z_indices)}")
+    series.preload(sel_set)
 
-    for z_idx, ds in enumerate(ds_list):
-        if z_idx in sel_set:
-            inst = ds.get("InstanceNumber", z_idx)
-            try:
-                inst_int = int(inst)
-            except:
-                inst_int = z_idx
-            out_name = f"slice_{inst_int:03d}_0000.png"
-            out_path = os.path.join(output_folder, out_name)
-            dicom_to_png(ds, out_path, default_center=default_center, default_width=default_width)
-            # 调试输出
-            ipp = getattr(ds, "ImagePositionPatient", ["?", "?", "?"])
-            print(f"[导出] z_idx={z_idx} -> {out_name}  InstanceNumber={inst}  Z={ipp[2] if len(ipp)>=3 else '?'}")            
-
-
+    for z_idx in sorted(sel_set):
+        if not 0 <= z_idx < len(series):
+            continue
+        header = series.headers[z_idx]
+        out_name = f"{series.slice_name(z_idx)}_0000.png"
+        out_path = os.path.join(output_folder, out_name)
+        Image.fromarray(hu_to_uint8(series.hu(z_idx))).save(out_path)
+        # 调试输出
+        ipp = header["position"] or ["?", "?", "?"]
+        print(f"[导出] z_idx={z_idx} -> {out_name}  InstanceNumber={header['instance_number']}  Z={ipp[2] if len(ipp)>=3 else '?'}")
+
+
+def export_selected_slices_by_z_index(dicom_folder, output_folder, selected_z_indices, write_png=True,
+                                      series=None):
+    """内存推理用：按 z 索引导出切片，返回 (names, uint8 数组列表)
+
+    names 形如 slice_105（不带 _0000），PNG 直接以最终文件名 slice_105.png 写出，
+    不再需要 nnUNet 推理后的重命名步骤。
+    series: DicomSeries，为空时只建头信息索引，仅解码选中的切片
+    """
+    if series is None:
+        series = index_series(dicom_folder)
+    if write_png:
+        os.makedirs(output_folder, exist_ok=True)
+    series.preload(selected_z_indices)
+
+    z_indices = [z for z in sorted(set(selected_z_indices)) if 0 <= z < len(series)]
+    # 整叠切片一次加窗，写入同一块 [N, H, W] 缓冲区
+    stack = apply_window_stack([series.hu(z) for z in z_indices], window=HU_WINDOW)
+    names, arrays = [], []
+    for z_idx, hu_uint8 in zip(z_indices, stack):
+        name = series.slice_name(z_idx)
+        if write_png:
+            Image.fromarray(hu_uint8).save(os.path.join(output_folder, f"{name}.png"))
+        names.append(name)
+        arrays.append(hu_uint8)
+    print(f"[导出] 内存切片 {len(names)} 张 -> {output_folder}")
+    return names, arrays
@@ -0,0 +1,49 @@
+import os
+
+# 推理质量档位
+#   use_mirroring : 测试时镜像增强（2D 模型 3 次额外前向）
+#   tile_step_size: 滑窗步长（相对 patch 大小，1.0 = 不重叠）
+#   use_gaussian  : 重叠区域高斯加权
+#   max_folds     : 最多集成几个 fold（None = 全部）
+PROFILES = {
+    "fast": {
+        "use_mirroring": False,
+        "tile_step_size": 1.0,
+        "use_gaussian": True,
+        "max_folds": 1,
+    },
+    "balanced": {
+        "use_mirroring": False,
+        "tile_step_size": 0.5,
+        "use_gaussian": True,
+        "max_folds": None,
+    },
+    "accurate": {
+        "use_mirroring": True,
+        "tile_step_size": 0.5,
+        "use_gaussian": True,
+        "max_folds": None,
+    },
+}
+
+# 服务默认档位；accurate 与改造前 seg.py 的硬编码参数一致
+DEFAULT_PROFILE = os.environ.get("IDOCTOR_INFERENCE_PROFILE", "accurate")
+
+
+def resolve_profile(name=None):
+    """返回 (profile_name, settings)；name 为空时使用服务默认档位，未知名称抛 ValueError"""
+    name = (name or DEFAULT_PROFILE).strip().lower()
+    if name not in PROFILES:
+        raise ValueError(f"未知推理档位: {name}，可选 {sorted(PROFILES)}")
+    return name, dict(PROFILES[name])
+
+
+def apply_profile(predictor, settings):
+    """把档位参数写到 predictor 上，返回应参与集成的 fold 权重列表"""
+    predictor.use_mirroring = settings["use_mirroring"]
+    predictor.tile_step_size = settings["tile_step_size"]
+    predictor.use_gaussian = settings["use_gaussian"]
+    params = predictor.list_of_parameters
+    if settings.get("max_folds"):
+        params = params[:settings["max_folds"]]
+    return params
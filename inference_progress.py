@@ -0,0 +1,96 @@
+import threading
+import time
+from pipeline_logging import write_log
+from pipeline_graph import PipelineAborted
+
+# 两次进度事件之间的最短间隔（秒），最后一张切片完成时总会发出
+MIN_EMIT_INTERVAL = 1.0
+
+
+class InferenceProgress:
+    """分割推理进度：由推理循环直接上报，按切片汇总并计算吞吐量与 ETA
+
+    total: 需要完成的切片数（多模型时为 切片数 x 模型数）
+    callback: 每次发出事件时调用 callback(event)，event 见 snapshot()
+    多个模型在线程池中并行推理时可以同时上报，内部加锁。
+    """
+
+    def __init__(self, total, log_root=None, callback=None, tag="nnUNet", min_interval=MIN_EMIT_INTERVAL):
+        self.total = int(total)
+        self.log_root = log_root
+        self.callback = callback
+        self.tag = tag
+        self.min_interval = min_interval
+        self._done = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last_emit = 0.0
+
+    def task(self, key, n_slices):
+        """返回某个模型 / 切片组的回调 on_tiles(done, total)：tile 进度按比例折算为已完成切片数"""
+        def on_tiles(done, total):
+            slices_done = n_slices if total <= 0 else n_slices * done // total
+            self.update(key, slices_done)
+        return on_tiles
+
+    def update(self, key, slices_done):
+        with self._lock:
+            if self._done.get(key) == slices_done:
+                return
+            self._done[key] = slices_done
+            now = time.time()
+            finished = self.done >= self.total
+            if not finished and now - self._last_emit < self.min_interval:
+                return
+            self._last_emit = now
+            event = self.snapshot(key)
+        write_log(self.log_root, f"[{self.tag}] PROGRESS model={key[0] if isinstance(key, tuple) else key} "
+                                 f"slices={event['slices_done']}/{event['slices_total']} "
+                                 f"throughput={event['throughput']}/s eta={event['eta_seconds']}s")
+        if self.callback is not None:
+            try:
+                self.callback(event)
+            except PipelineAborted:
+                raise
+            except Exception as e:
+                write_log(self.log_root, f"[{self.tag}] PROGRESS_CALLBACK_ERR {e}")
+
+    @property
+    def done(self):
+        return min(self.total, sum(self._done.values()))
+
+    def snapshot(self, key=None):
+        elapsed = time.time() - self._start
+        done = self.done
+        throughput = done / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - done
+        eta = remaining / throughput if throughput > 0 else None
+        return {
+            "model": key[0] if isinstance(key, tuple) else key,
+            "slices_done": done,
+            "slices_total": self.total,
+            "fraction": round(done / self.total, 4) if self.total else 1.0,
+            "throughput": round(throughput, 2),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "elapsed": round(elapsed, 1),
+        }
+
+
+def staged(callback, index, count):
+    """把第 index 个（共 count 个、切片数相同的）顺序推理阶段的事件折算为整体进度
+
+    文件模式下腰大肌、全肌肉两个模型依次推理，各自上报 0..N，折算后整体为 0..2N。
+    """
+    if callback is None:
+        return None
+
+    def wrapped(event):
+        per_stage = event["slices_total"]
+        done = index * per_stage + event["slices_done"]
+        total = count * per_stage
+        throughput = event["throughput"]
+        event = dict(event, slices_done=done, slices_total=total,
+                     fraction=round(done / total, 4) if total else 1.0,
+                     eta_seconds=round((total - done) / throughput, 1) if throughput > 0 else None)
+        callback(event)
+    return wrapped
@@ -0,0 +1,474 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# 持久化任务队列：API 只负责入队与查询，worker 进程（worker.py，或 API 进程内嵌的 worker 线程）领取执行
+JOB_BACKEND = os.environ.get("IDOCTOR_JOB_BACKEND", "sqlite")
+JOB_DB_PATH = os.environ.get("IDOCTOR_JOB_DB", os.path.join("data", ".jobs.sqlite"))
+# worker 领取任务后持有的租约时长（秒），需在到期前续约；租约过期视为 worker 已崩溃
+JOB_LEASE_SECONDS = float(os.environ.get("IDOCTOR_JOB_LEASE_SECONDS", "60"))
+# 租约过期后最多执行几次（含第一次），超过则标记为失败
+JOB_MAX_ATTEMPTS = int(os.environ.get("IDOCTOR_JOB_MAX_ATTEMPTS", "2"))
+# 任务事件（/task_events 推送、断线后按 Last-Event-ID 续传）保留时长（秒）
+JOB_EVENTS_KEEP_SECONDS = float(os.environ.get("IDOCTOR_JOB_EVENTS_KEEP_SECONDS", "86400"))
+
+
+def _parse_plan_weights(text):
+    """"免费版:1,专业版:2" 或 JSON 对象 → {计划名: 权重}"""
+    text = text.strip()
+    if not text:
+        return {}
+    if text.startswith("{"):
+        return {str(k): float(v) for k, v in json.loads(text).items()}
+    weights = {}
+    for item in text.split(","):
+        if ":" in item:
+            name, value = item.rsplit(":", 1)
+            weights[name.strip()] = float(value)
+    return weights
+
+
+# 优先级类别：交互式 L3 检测 > 流水线（/process、/continue_after_l3）> 批量提交；数值小的类别先领取
+PRIORITY_CLASSES = {"interactive": 0, "pipeline": 1, "batch": 2}
+_PRIORITY_NAMES = {v: k for k, v in PRIORITY_CLASSES.items()}
+# 各任务类型默认所属的类别，入队时可显式降为 batch
+KIND_PRIORITY = {"l3_detect": "interactive", "main": "pipeline", "continue_after_l3": "pipeline"}
+# 同一类别内按用户加权公平排队，权重按订阅计划名配置（例如 "免费版:1,专业版:2,企业版:4"），
+# 未配置的计划与匿名用户权重为 default（默认 1）
+PLAN_WEIGHTS = _parse_plan_weights(os.environ.get("IDOCTOR_PLAN_WEIGHTS", ""))
+
+
+def plan_weight(plan):
+    weight = PLAN_WEIGHTS.get(plan, PLAN_WEIGHTS.get("default", 1.0)) if plan else PLAN_WEIGHTS.get("default", 1.0)
+    return weight if weight > 0 else 1.0
+
+# queued → running → completed / failed；running 租约过期后回到 queued 或直接 failed
+ACTIVE_STATES = ("queued", "running")
+# 对外的 status 与旧的 task_status 保持一致（前端轮询按 processing / completed / failed 判断）
+_PUBLIC_STATUS = {"queued": "queued", "running": "processing", "completed": "completed", "failed": "failed"}
+TERMINAL_STATUSES = ("completed", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    user_id TEXT,
+    state TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    stage TEXT,
+    extra TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    cost TEXT,
+    priority INTEGER NOT NULL DEFAULT 1,
+    plan TEXT,
+    weight REAL NOT NULL DEFAULT 1,
+    vstart REAL NOT NULL DEFAULT 0,
+    vfinish REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_task ON jobs (task_id, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id);
+-- 任务状态变化的事件流：每次入队 / 领取 / 进度更新 / 结束 / 重新排队各写一条，data 为当时的 job_status
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    task_id TEXT NOT NULL,
+    user_id TEXT,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_job_events_task ON job_events (task_id, id);
+CREATE INDEX IF NOT EXISTS idx_job_events_user ON job_events (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_job_events_time ON job_events (created_at);
+-- worker 存活记录：空闲轮询与执行任务续约时更新，API 据此判断排队的任务是否有 worker 能领取
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    kinds TEXT,
+    seen_at REAL NOT NULL
+);
+"""
+# 依赖后加列的索引，补列之后再建
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_jobs_sched ON jobs (state, priority, vstart, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, priority, vfinish);
+"""
+
+_JSON_COLUMNS = ("payload", "extra", "result", "cost")
+# 旧数据库缺少的列在打开时补上
+_ADDED_COLUMNS = (
+    ("cost", "TEXT"),
+    ("priority", "INTEGER NOT NULL DEFAULT 1"),
+    ("plan", "TEXT"),
+    ("weight", "REAL NOT NULL DEFAULT 1"),
+    ("vstart", "REAL NOT NULL DEFAULT 0"),
+    ("vfinish", "REAL NOT NULL DEFAULT 0"),
+)
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    for col in _JSON_COLUMNS:
+        job[col] = json.loads(job[col]) if job[col] else None
+    return job
+
+
+class SqliteJobQueue:
+    """SQLite 实现（WAL），同一台机器上的多个 API / worker 进程共享一个数据库文件
+
+    每次操作单独打开连接，写操作用 BEGIN IMMEDIATE 串行化；领取任务时顺带回收租约过期的任务。
+    """
+
+    def __init__(self, path=JOB_DB_PATH, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            for name, decl in _ADDED_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+            conn.executescript(_INDEXES)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Connection(conn)
+
+    # ---------- API 侧 ----------
+    def enqueue(self, task_id, kind, payload, user_id=None, max_attempts=None, cost=None, priority=None, plan=None):
+        """入队；同一 task_id 已有排队 / 运行中的任务时不重复入队。返回 (job, created)
+
+        cost: 估算的资源成本（见 admission.estimate_job_cost），供 worker 做准入判断
+        priority: 优先级类别（PRIORITY_CLASSES），默认按任务类型取 KIND_PRIORITY
+        plan: 用户的订阅计划，决定其在类别内公平排队的权重（PLAN_WEIGHTS）
+        """
+        now = time.time()
+        priority = PRIORITY_CLASSES[priority or KIND_PRIORITY.get(kind, "pipeline")]
+        user_id = None if user_id is None else str(user_id)
+        weight = plan_weight(plan)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT * FROM jobs WHERE task_id = ? AND state IN ({','.join('?' * len(ACTIVE_STATES))}) "
+                "ORDER BY id DESC LIMIT 1", (task_id, *ACTIVE_STATES)).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return _row_to_job(row), False
+            vstart, vfinish = self._fair_tags(conn, priority, user_id, weight)
+            cur = conn.execute(
+                "INSERT INTO jobs (task_id, kind, payload, user_id, state, message, max_attempts, created_at, cost, "
+                "priority, plan, weight, vstart, vfinish) "
+                "VALUES (?, ?, ?, ?, 'queued', '任务已提交', ?, ?, ?, ?, ?, ?, ?, ?)",
+                (task_id, kind, json.dumps(payload, ensure_ascii=False), user_id,
+                 max_attempts or self.max_attempts, now, json.dumps(cost) if cost else None,
+                 priority, plan, weight, vstart, vfinish))
+            job_id = cur.lastrowid
+            self._record(conn, job_id, "queued")
+            conn.execute("DELETE FROM job_events WHERE created_at < ?", (now - JOB_EVENTS_KEEP_SECONDS,))
+            conn.execute("COMMIT")
+        return self.get_job(job_id), True
+
+    def _fair_tags(self, conn, priority, user_id, weight):
+        """类别内按用户做加权公平排队（start-time fair queueing），返回新任务的 (vstart, vfinish)
+
+        类别的虚拟时间取排队任务中最小的 vstart（没有排队任务时取最近领取的任务）；
+        新任务 vstart = max(虚拟时间, 该用户上一个任务的 vfinish)，vfinish = vstart + 1 / weight。
+        领取按 vstart 排序：积压时权重为 2 的用户领取次数是权重 1 的两倍，
+        新来的用户也不必排在别人一长串积压任务之后。
+        """
+        virtual = conn.execute("SELECT MIN(vstart) FROM jobs WHERE state = 'queued' AND priority = ?",
+                               (priority,)).fetchone()[0]
+        if virtual is None:
+            virtual = conn.execute("SELECT MAX(vstart) FROM jobs WHERE state != 'queued' AND priority = ?",
+                                   (priority,)).fetchone()[0] or 0.0
+        last = conn.execute("SELECT MAX(vfinish) FROM jobs WHERE user_id IS ? AND priority = ?",
+                            (user_id, priority)).fetchone()[0] or 0.0
+        vstart = max(virtual, last)
+        return vstart, vstart + 1.0 / weight
+
+    def get_job(self, job_id):
+        with self._connect() as conn:
+            return _row_to_job(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def latest(self, task_id):
+        """task_id 最近一次提交的任务"""
+        with self._connect() as conn:
+            return _row_to_job(conn.execute(
+                "SELECT * FROM jobs WHERE task_id = ? ORDER BY id DESC LIMIT 1", (task_id,)).fetchone())
+
+    def position(self, job):
+        """排队中的任务当前在领取顺序中的位置（从 1 开始），不在排队时返回 None
+
+        更高优先级或虚拟时间更早的任务之后仍可能插到前面，位置只反映当前时刻
+        """
+        if job is None or job["state"] != "queued":
+            return None
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority < ? OR (priority = ? AND "
+                "(vstart < ? OR (vstart = ? AND id <= ?))))",
+                (job["priority"], job["priority"], job["vstart"], job["vstart"], job["id"])).fetchone()[0]
+
+    def annotate(self, job_id, message):
+        """更新排队中任务的提示（例如等待资源的原因）"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute("UPDATE jobs SET message = ? WHERE id = ? AND state = 'queued'", (message, job_id))
+            if cur.rowcount == 1:
+                self._record(conn, job_id, "queued")
+            conn.execute("COMMIT")
+
+    def list_latest(self, limit=200):
+        """每个 task_id 最近一次提交的任务（按提交时间倒序）"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE id IN (SELECT MAX(id) FROM jobs GROUP BY task_id) "
+                "ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [_row_to_job(r) for r in rows]
+
+    # ---------- 事件流 ----------
+    def _record(self, conn, job_id, event):
+        """在当前事务内追加一条事件，data 为变更后的 job_status"""
+        job = _row_to_job(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+        data = job_status(job)
+        data["task_id"] = job["task_id"]
+        conn.execute(
+            "INSERT INTO job_events (job_id, task_id, user_id, event, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, job["task_id"], job["user_id"], event, json.dumps(data, ensure_ascii=False, default=str),
+             time.time()))
+
+    def events(self, after_id=0, task_id=None, user_id=None, limit=200):
+        """id 大于 after_id 的事件（按 id 升序），可按 task_id / user_id 过滤"""
+        sql, args = "SELECT * FROM job_events WHERE id > ?", [after_id or 0]
+        if task_id is not None:
+            sql += " AND task_id = ?"
+            args.append(task_id)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            args.append(str(user_id))
+        with self._connect() as conn:
+            rows = conn.execute(sql + " ORDER BY id LIMIT ?", (*args, limit)).fetchall()
+        return [{"id": r["id"], "job_id": r["job_id"], "task_id": r["task_id"], "event": r["event"],
+                 "data": json.loads(r["data"]), "created_at": r["created_at"]} for r in rows]
+
+    def last_event_id(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM job_events").fetchone()[0]
+
+    def active_jobs(self, user_id=None):
+        """排队 / 运行中的任务（用户级事件流连接时的初始快照）"""
+        sql, args = f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(ACTIVE_STATES))})", list(ACTIVE_STATES)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            args.append(str(user_id))
+        with self._connect() as conn:
+            return [_row_to_job(r) for r in conn.execute(sql + " ORDER BY id", args).fetchall()]
+
+    # ---------- worker 侧 ----------
+    def _reclaim_expired(self, conn, now):
+        expired = conn.execute(
+            "SELECT id, attempts, max_attempts FROM jobs WHERE state = 'running' AND lease_until < ?", (now,)).fetchall()
+        for row in expired:
+            if row["attempts"] < row["max_attempts"]:
+                conn.execute("UPDATE jobs SET state = 'queued', worker = NULL, lease_until = NULL, "
+                             "message = '执行任务的 worker 失去响应，重新排队' WHERE id = ?", (row["id"],))
+                self._record(conn, row["id"], "requeued")
+            else:
+                conn.execute("UPDATE jobs SET state = 'failed', worker = NULL, lease_until = NULL, finished_at = ?, "
+                             "error = '执行任务的 worker 失去响应（租约过期）', message = '处理失败: worker 失去响应' "
+                             "WHERE id = ?", (now, row["id"]))
+                self._record(conn, row["id"], "failed")
+        return len(expired)
+
+    def claim(self, worker_id, kinds=None, admission=None):
+        """按优先级类别、类别内公平排队的虚拟时间领取任务并加租约，没有任务时返回 None
+
+        admission: 可选的准入控制（admission.AdmissionController）。队首任务未被放行时返回 None，
+                   不越过它领取后面的小任务，避免大任务一直等不到资源。
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._reclaim_expired(conn, now)
+            sql, args = "SELECT * FROM jobs WHERE state = 'queued'", []
+            if kinds:
+                sql += f" AND kind IN ({','.join('?' * len(kinds))})"
+                args += list(kinds)
+            row = conn.execute(sql + " ORDER BY priority, vstart, id LIMIT 1", args).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if admission is not None and not admission.try_admit(_row_to_job(row)):
+                conn.execute("COMMIT")
+                return None
+            try:
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, lease_until = ?, "
+                    "heartbeat_at = ?, started_at = ?, progress = 0, message = '正在处理...', error = NULL WHERE id = ?",
+                    (worker_id, now + self.lease_seconds, now, now, row["id"]))
+                self._record(conn, row["id"], "started")
+                conn.execute("COMMIT")
+            except Exception:
+                if admission is not None:
+                    admission.release(row["id"])
+                raise
+        return self.get_job(row["id"])
+
+    def heartbeat(self, job_id, worker_id, progress=None, message=None, stage=None, extra=None):
+        """续约并更新进度；任务已不属于该 worker（租约过期被回收）时返回 False
+
+        只续约（没有进度字段）时不写事件
+        """
+        now = time.time()
+        sets, args = ["lease_until = ?", "heartbeat_at = ?"], [now + self.lease_seconds, now]
+        for col, value in (("progress", progress), ("message", message), ("stage", stage)):
+            if value is not None:
+                sets.append(f"{col} = ?")
+                args.append(value)
+        if extra is not None:
+            sets.append("extra = ?")
+            args.append(json.dumps(extra, ensure_ascii=False))
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(f"UPDATE jobs SET {', '.join(sets)} WHERE id = ? AND worker = ? AND state = 'running'",
+                               (*args, job_id, worker_id))
+            ok = cur.rowcount == 1
+            if ok and len(sets) > 2:
+                self._record(conn, job_id, "progress")
+            conn.execute("COMMIT")
+            return ok
+
+    def worker_seen(self, worker_id, kinds=None):
+        """记录 worker 仍然存活；kinds 为它领取的任务类型，为空表示全部"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (worker_id, kinds, seen_at) VALUES (?, ?, ?)",
+                         (worker_id, json.dumps(list(kinds)) if kinds else None, time.time()))
+
+    def live_workers(self, kind=None, within=None):
+        """最近 within 秒（默认一个租约时长）内报告过存活、且能领取 kind 类任务的 worker 数"""
+        since = time.time() - (within or self.lease_seconds)
+        with self._connect() as conn:
+            rows = conn.execute("SELECT kinds FROM workers WHERE seen_at >= ?", (since,)).fetchall()
+        return sum(1 for r in rows if kind is None or r["kinds"] is None or kind in json.loads(r["kinds"]))
+
+    def complete(self, job_id, worker_id, result=None, message="处理完成"):
+        return self._finish(job_id, worker_id, "completed", progress=100, message=message,
+                            result=json.dumps(result, ensure_ascii=False, default=str), error=None)
+
+    def fail(self, job_id, worker_id, error):
+        return self._finish(job_id, worker_id, "failed", progress=0, message=f"处理失败: {error}",
+                            result=None, error=str(error))
+
+    def _finish(self, job_id, worker_id, state, progress, message, result, error):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(
+                "UPDATE jobs SET state = ?, progress = ?, message = ?, result = ?, error = ?, finished_at = ?, "
+                "lease_until = NULL WHERE id = ? AND worker = ? AND state = 'running'",
+                (state, progress, message, result, error, time.time(), job_id, worker_id))
+            ok = cur.rowcount == 1
+            if ok:
+                self._record(conn, job_id, state)
+            conn.execute("COMMIT")
+            return ok
+
+    def counts(self):
+        with self._connect() as conn:
+            return {r["state"]: r["n"] for r in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")}
+
+
+class _Connection:
+    """sqlite3 连接的 with 包装：退出时回滚未提交的事务并关闭连接"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        self.conn.close()
+
+
+def job_status(job, position=None):
+    """任务记录 → /task_status 返回格式（兼容旧的 task_status 字典字段）
+
+    position: 排队位置（见 SqliteJobQueue.position），给定时提示为 “排队中（第 N 位）”
+    """
+    if job is None:
+        return {"status": "not_found", "message": "任务不存在"}
+    status = {
+        "status": _PUBLIC_STATUS.get(job["state"], job["state"]),
+        "progress": job["progress"],
+        "message": job["message"],
+        "stage": job["stage"],
+        "profile": (job["payload"] or {}).get("profile"),
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "priority": _PRIORITY_NAMES.get(job["priority"], job["priority"]),
+        "plan": job["plan"],
+        "attempts": job["attempts"],
+        "worker": job["worker"],
+        "submitted_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["created_at"])),
+        "started_at": job["started_at"],
+    }
+    status.update(job["extra"] or {})
+    if job["cost"]:
+        status["cost"] = job["cost"]
+    if position is not None:
+        status["position"] = position
+        note = job["message"] if job["message"] and job["message"] != "任务已提交" else ""
+        status["message"] = f"排队中（第 {position} 位）" + (f"，{note}" if note else "")
+    if job["state"] == "completed":
+        status.update(job["result"] or {})
+        status["completed_at"] = job["finished_at"]
+        status["duration"] = job["finished_at"] - (job["started_at"] or job["finished_at"])
+    elif job["state"] == "failed":
+        status["error"] = job["error"]
+        status["failed_at"] = job["finished_at"]
+    return status
+
+
+# 队列后端注册表：IDOCTOR_JOB_BACKEND 选择，新后端实现与 SqliteJobQueue 相同的方法后 register_job_backend 注册
+_BACKENDS = {"sqlite": SqliteJobQueue}
+
+
+def register_job_backend(name, factory):
+    _BACKENDS[name] = factory
+
+
+_QUEUE = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_job_queue():
+    """进程级共享的任务队列"""
+    global _QUEUE
+    with _QUEUE_LOCK:
+        if _QUEUE is None:
+            if JOB_BACKEND not in _BACKENDS:
+                raise ValueError(f"未知任务队列后端: {JOB_BACKEND}（可选: {', '.join(sorted(_BACKENDS))}）")
+            _QUEUE = _BACKENDS[JOB_BACKEND]()
+        return _QUEUE
@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class _Entry:
+    __slots__ = ("model", "lock", "loaded_at", "last_used", "in_use")
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.in_use = 0
+
+
+class ModelRegistry:
+    """进程内常驻模型注册表（LRU + 空闲超时淘汰）
+
+    - 每个 key 只加载一次，之后复用同一个实例
+    - 超过 max_models 时淘汰最久未使用且未被占用的模型
+    - 空闲超过 idle_timeout 秒的模型在下一次 acquire/sweep 时释放
+    - acquire() 期间持有该模型的独占锁（predictor 本身不是线程安全的）
+    """
+
+    def __init__(self, name, max_models=4, idle_timeout=1800, on_evict=None):
+        self.name = name
+        self.max_models = max(1, int(max_models))
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _get_or_load(self, key, loader):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.in_use += 1
+                    return entry, False
+                event = self._loading.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._loading[key] = event
+                    break
+            # 其它线程正在加载同一个模型，等待其完成后重试
+            event.wait()
+
+        try:
+            model = loader()
+        except Exception:
+            with self._lock:
+                self._loading.pop(key, None)
+            event.set()
+            raise
+
+        with self._lock:
+            entry = _Entry(model)
+            entry.in_use = 1
+            self._entries[key] = entry
+            self._loading.pop(key, None)
+        event.set()
+        self.sweep()
+        return entry, True
+
+    @contextmanager
+    def acquire(self, key, loader):
+        """取出已加载的模型（必要时调用 loader() 加载），并在 with 块内独占使用"""
+        entry, _ = self._get_or_load(key, loader)
+        try:
+            with entry.lock:
+                yield entry.model
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+
+    def get(self, key, loader):
+        """只取模型不加锁（调用方自行保证不会并发使用同一实例）"""
+        entry, _ = self._get_or_load(key, loader)
+        with self._lock:
+            entry.in_use -= 1
+            entry.last_used = time.time()
+        return entry.model
+
+    def sweep(self):
+        """按空闲超时与容量淘汰模型，返回被淘汰的 key 列表"""
+        evicted = []
+        now = time.time()
+        with self._lock:
+            if self.idle_timeout:
+                for key, entry in list(self._entries.items()):
+                    if entry.in_use == 0 and now - entry.last_used > self.idle_timeout:
+                        evicted.append((key, self._entries.pop(key)))
+            while len(self._entries) > self.max_models:
+                victim = next((k for k, e in self._entries.items() if e.in_use == 0), None)
+                if victim is None:
+                    break
+                evicted.append((victim, self._entries.pop(victim)))
+        for key, entry in evicted:
+            self._release(key, entry)
+        return [k for k, _ in evicted]
+
+    def evict(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.in_use:
+                return False
+            self._entries.pop(key)
+        self._release(key, entry)
+        return True
+
+    def clear(self):
+        with self._lock:
+            items = [(k, e) for k, e in self._entries.items() if e.in_use == 0]
+            for k, _ in items:
+                self._entries.pop(k)
+        for key, entry in items:
+            self._release(key, entry)
+
+    def _release(self, key, entry):
+        if self.on_evict:
+            try:
+                self.on_evict(key, entry.model)
+            except Exception:
+                pass
+        entry.model = None
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "name": self.name,
+                "max_models": self.max_models,
+                "idle_timeout": self.idle_timeout,
+                "models": [
+                    {
+                        "key": [str(k) for k in (key if isinstance(key, tuple) else (key,))],
+                        "in_use": e.in_use,
+                        "age_s": round(now - e.loaded_at, 1),
+                        "idle_s": round(now - e.last_used, 1),
+                    }
+                    for key, e in self._entries.items()
+                ],
+            }
+
+
+def _start_sweeper(interval=60):
+    def loop():
+        while True:
+            time.sleep(interval)
+            for reg in list(_REGISTRIES.values()):
+                try:
+                    reg.sweep()
+                except Exception:
+                    pass
+    t = threading.Thread(target=loop, name="model-registry-sweeper", daemon=True)
+    t.start()
+    return t
+
+
+_REGISTRIES = {}
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def get_registry(name, max_models=None, idle_timeout=None, on_evict=None):
+    """获取（或创建）进程级命名注册表
+
+    max_models / idle_timeout 默认取环境变量
+      IDOCTOR_MODEL_CACHE_SIZE   (默认 4)
+      IDOCTOR_MODEL_IDLE_SECONDS (默认 1800，0 表示不按空闲淘汰)
+    """
+    global _sweeper
+    with _sweeper_lock:
+        reg = _REGISTRIES.get(name)
+        if reg is None:
+            if max_models is None:
+                max_models = int(os.environ.get("IDOCTOR_MODEL_CACHE_SIZE", "4"))
+            if idle_timeout is None:
+                idle_timeout = float(os.environ.get("IDOCTOR_MODEL_IDLE_SECONDS", "1800"))
+            reg = ModelRegistry(name, max_models=max_models, idle_timeout=idle_timeout, on_evict=on_evict)
+            _REGISTRIES[name] = reg
+        if _sweeper is None:
+            _sweeper = _start_sweeper()
+    return reg
+
+
+def registry_stats():
+    return {name: reg.stats() for name, reg in _REGISTRIES.items()}
@@ -0,0 +1,113 @@
+import os
+import itertools
+import numpy as np
+import torch
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+
+try:
+    import psutil  # optional, 用于按可用内存自动选择 batch size
+except ImportError:
+    psutil = None
+
+# 每次前向送入的 tile 数量："auto" 按可用内存估算，或直接填整数
+SEG_BATCH_SIZE = os.environ.get("IDOCTOR_SEG_BATCH_SIZE", "auto")
+# 自动估算时允许推理占用的可用内存比例
+SEG_BATCH_MEM_FRACTION = float(os.environ.get("IDOCTOR_SEG_BATCH_MEM_FRACTION", "0.25"))
+MAX_AUTO_BATCH = 32
+# 粗略估算：2D U-Net 推理时每个 tile 的激活内存约为输入 float32 的若干百倍
+_ACTIVATION_FACTOR = 160
+
+
+def auto_batch_size(patch_size, num_channels=1, mem_fraction=None):
+    """根据可用内存估算 batch size（至少 1，至多 MAX_AUTO_BATCH）"""
+    if psutil is None:
+        return 4
+    if mem_fraction is None:
+        mem_fraction = SEG_BATCH_MEM_FRACTION
+    per_tile = int(np.prod(patch_size)) * 4 * max(1, num_channels) * _ACTIVATION_FACTOR
+    budget = psutil.virtual_memory().available * mem_fraction
+    return int(max(1, min(MAX_AUTO_BATCH, budget // max(per_tile, 1))))
+
+
+def resolve_batch_size(predictor, batch_size=None):
+    if batch_size is None:
+        batch_size = SEG_BATCH_SIZE
+    if batch_size in ("auto", "", 0):
+        num_channels = len(predictor.dataset_json.get("channel_names", {"0": ""}))
+        return auto_batch_size(predictor.configuration_manager.patch_size, num_channels)
+    return max(1, int(batch_size))
+
+
+def mirror_and_predict(forward, x, mirror_axes=None):
+    """与 nnUNetPredictor._internal_maybe_mirror_and_predict 相同的 TTA，但 forward 可替换"""
+    prediction = forward(x)
+    if mirror_axes:
+        axes = [m + 2 for m in mirror_axes]
+        combos = [c for i in range(len(axes)) for c in itertools.combinations(axes, i + 1)]
+        for flip_axes in combos:
+            prediction += torch.flip(forward(torch.flip(x, flip_axes)), flip_axes)
+        prediction /= (len(combos) + 1)
+    return prediction
+
+
+def _load_parameters(network, params):
+    target = getattr(network, "_orig_mod", network)
+    target.load_state_dict(params)
+
+
+def predict_logits_batched(predictor, data, batch_size=None, forward=None, parameters=None, progress=None):
+    """批量滑窗推理：把多个 tile（2D 模型即多张切片）堆成一个 batch 前向
+
+    data: 预处理后的 (C, N, H, W) tensor
+    forward: 可替换的网络前向函数（或每个 fold 一个的列表，如 ONNX / TorchScript 后端），默认 predictor.network
+    parameters: 参与集成的 fold 权重列表，默认 predictor.list_of_parameters（forward 给定时忽略）
+    progress: 每个 batch 前向完成后调用 progress(done_tiles, total_tiles)，total 含所有 fold
+    返回: (num_heads, N, H, W) 的 logits（CPU tensor），与 nnUNet 逐 tile 推理等价（累加用 float32）
+    """
+    batch_size = resolve_batch_size(predictor, batch_size)
+    patch_size = predictor.configuration_manager.patch_size
+    num_heads = predictor.label_manager.num_segmentation_heads
+    device = predictor.device
+    mirror_axes = predictor.allowed_mirroring_axes if predictor.use_mirroring else None
+    if forward is not None:
+        members = [(None, f) for f in (forward if isinstance(forward, (list, tuple)) else [forward])]
+    else:
+        members = [(p, None) for p in (predictor.list_of_parameters if parameters is None else parameters)]
+
+    data, revert_padding = pad_nd_image(data, patch_size, 'constant', {'value': 0}, True, None)
+    slicers = predictor._internal_get_sliding_window_slicers(data.shape[1:])
+    if predictor.use_gaussian:
+        gaussian = compute_gaussian(tuple(patch_size), sigma_scale=1. / 8, value_scaling_factor=10,
+                                    dtype=torch.float32, device=device)
+    else:
+        gaussian = torch.ones(tuple(patch_size), device=device)
+
+    total = None
+    n_tiles = len(slicers) * len(members)
+    tiles_done = 0
+    with torch.no_grad():
+        for params, run in members:
+            if run is None:
+                _load_parameters(predictor.network, params)
+                predictor.network.eval()
+                run = predictor.network
+
+            logits = torch.zeros((num_heads, *data.shape[1:]), dtype=torch.float32, device=device)
+            n_predictions = torch.zeros(data.shape[1:], dtype=torch.float32, device=device)
+            for start in range(0, len(slicers), batch_size):
+                batch_slicers = slicers[start:start + batch_size]
+                x = torch.stack([data[sl] for sl in batch_slicers]).to(device)
+                pred = mirror_and_predict(run, x, mirror_axes).to(device).float()
+                for b, sl in enumerate(batch_slicers):
+                    logits[sl] += pred[b] * gaussian
+                    n_predictions[sl[1:]] += gaussian
+                tiles_done += len(batch_slicers)
+                if progress is not None:
+                    progress(tiles_done, n_tiles)
+            logits /= n_predictions
+            logits = logits.cpu()
+            total = logits if total is None else total + logits
+    if len(members) > 1:
+        total /= len(members)
+    return total[(slice(None), *revert_padding[1:])]
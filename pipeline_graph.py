@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from pipeline_logging import write_log
+
+# 每个病例 output/ 下记录各阶段的输入指纹与产物：{stage: {input_fp, deps_fp, output_fp, outputs, ...}}
+STAGES_FILE = ".stages.json"
+
+_FILE_LOCK = threading.Lock()
+
+
+class PipelineAborted(Exception):
+    """由回调抛出以中止整条流水线（例如任务租约已失效）；runner 与进度上报不会把它当作回调错误吞掉"""
+
+
+def hash_value(obj):
+    """可 JSON 序列化对象的稳定哈希"""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def hash_files(paths):
+    """按路径顺序对文件内容求哈希；文件缺失时返回 None"""
+    h = hashlib.sha256()
+    for p in paths:
+        if not os.path.isfile(p):
+            return None
+        h.update(os.path.basename(p).encode())
+        with open(p, "rb") as f:
+            while True:
+                buf = f.read(1 << 20)
+                if not buf:
+                    break
+                h.update(buf)
+    return h.hexdigest()
+
+
+def file_signature(path):
+    """(大小, mtime)，用于权重等大文件；不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, int(st.st_mtime)]
+
+
+def stages_path(output_folder):
+    return os.path.join(output_folder, STAGES_FILE)
+
+
+def read_stages(output_folder):
+    path = stages_path(output_folder)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _write_stages(output_folder, records):
+    path = stages_path(output_folder)
+    tmp = path + ".part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def invalidate_stages(output_folder, names=None):
+    """删除指定阶段（默认全部）的记录，下次运行时这些阶段一定重新执行"""
+    with _FILE_LOCK:
+        if names is None:
+            try:
+                os.remove(stages_path(output_folder))
+            except OSError:
+                pass
+            return
+        records = read_stages(output_folder)
+        for name in names:
+            records.pop(name, None)
+        _write_stages(output_folder, records)
+
+
+class Stage:
+    """流水线中的一个阶段
+
+    deps   : 上游阶段名
+    run    : run(ctx) -> value，执行阶段并写出产物
+    params : params(ctx) -> dict，除上游产物之外影响结果的输入（权重签名、档位、手动文件哈希等）
+    outputs: outputs(ctx, value) -> [文件路径]，阶段写出的持久化产物；为空时产物指纹等于输入指纹
+    restore: restore(ctx) -> value，阶段被跳过而下游需要它的结果时从产物恢复；为空时重新执行 run
+    version: 阶段实现有不兼容修改时加一，使旧记录失效
+    """
+
+    def __init__(self, name, deps=(), run=None, params=None, outputs=None, restore=None, version=1):
+        self.name = name
+        self.deps = tuple(deps)
+        self.run = run
+        self.params = params or (lambda ctx: {})
+        self.outputs = outputs or (lambda ctx, value: [])
+        self.restore = restore
+        self.version = version
+
+
+class PipelineGraph:
+    def __init__(self, stages):
+        self.stages = {s.name: s for s in stages}
+        for s in stages:
+            for d in s.deps:
+                if d not in self.stages:
+                    raise ValueError(f"阶段 {s.name} 依赖未知阶段 {d}")
+
+    def upstream(self, targets):
+        """targets 及其全部上游，按拓扑顺序返回"""
+        order, seen = [], set()
+
+        def visit(name, stack=()):
+            if name in seen:
+                return
+            if name in stack:
+                raise ValueError(f"阶段依赖成环: {' -> '.join(stack + (name,))}")
+            for d in self.stages[name].deps:
+                visit(d, stack + (name,))
+            seen.add(name)
+            order.append(name)
+
+        for t in targets:
+            visit(t)
+        return order
+
+
+class StageRunner:
+    """按指纹增量执行：阶段的输入指纹 = 上游产物指纹 + params + version
+
+    记录存在、输入指纹一致且记录的产物文件内容未变时跳过该阶段；被跳过阶段的结果在下游真正需要时才恢复。
+    force: 需要的阶段全部重新执行（frozen 除外）
+    frozen: 不执行、直接采用磁盘上现有产物的阶段（例如手动上传的 L3 mask 不应被自动检测覆盖）
+    ctx: 传给各阶段函数的上下文对象，runner 会设置 ctx.runner
+    on_stage: 可选回调 on_stage(阶段名, "run" / "done" / "skip")，例如写入任务队列的阶段进度
+    """
+
+    def __init__(self, graph, output_folder, ctx, force=False, frozen=(), log_root=None, on_stage=None):
+        self.graph = graph
+        self.output_folder = output_folder
+        self.ctx = ctx
+        self.force = force
+        self.frozen = set(frozen)
+        self.log_root = log_root if log_root is not None else output_folder
+        self.on_stage = on_stage
+        self.records = read_stages(output_folder)
+        self.executed = set()
+        self.skipped = set()
+        self._values = {}
+        self._output_fps = {}
+        self._deps_fps = {}
+        ctx.runner = self
+
+    def _rel(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.output_folder))
+
+    def _abs(self, rel):
+        return os.path.join(self.output_folder, rel)
+
+    def _is_current(self, name, input_fp):
+        rec = self.records.get(name)
+        if not rec or rec.get("input_fp") != input_fp:
+            return False
+        outputs = [self._abs(p) for p in rec.get("outputs", [])]
+        return not outputs or hash_files(outputs) == rec.get("output_fp")
+
+    def _save_record(self, name, record):
+        with _FILE_LOCK:
+            records = read_stages(self.output_folder)
+            records[name] = record
+            _write_stages(self.output_folder, records)
+        self.records[name] = record
+
+    # ---------- 供阶段函数调用 ----------
+    def value(self, name):
+        """上游阶段的结果；被跳过的阶段在这里才恢复（restore 或重新执行）"""
+        if name not in self._values:
+            stage = self.graph.stages[name]
+            if stage.restore is not None:
+                self._values[name] = stage.restore(self.ctx)
+            else:
+                write_log(self.log_root, f"[STAGE] {name} 无法从产物恢复，重新执行")
+                self._values[name] = stage.run(self.ctx)
+        return self._values[name]
+
+    def deps_changed(self, name):
+        """本次运行中上游是否有阶段重新执行，或上游产物与上次记录不同（没有记录且上游都未执行时视为未变）"""
+        stage = self.graph.stages[name]
+        if any(d in self.executed for d in stage.deps):
+            return True
+        rec = self.records.get(name)
+        return rec is not None and rec.get("deps_fp") != self._deps_fps.get(name)
+
+    def record(self, name):
+        return self.records.get(name)
+
+    # ---------- 执行 ----------
+    def _notify(self, name, state):
+        if self.on_stage is None:
+            return
+        try:
+            self.on_stage(name, state)
+        except PipelineAborted:
+            raise
+        except Exception as e:
+            write_log(self.log_root, f"[STAGE] on_stage 回调异常: {e}")
+
+    def run(self, targets):
+        for name in self.graph.upstream(targets):
+            self._run_stage(name)
+        return self.ctx
+
+    def _run_stage(self, name):
+        stage = self.graph.stages[name]
+        deps_fp = hash_value([self._output_fps[d] for d in stage.deps])
+        self._deps_fps[name] = deps_fp
+        input_fp = hash_value({"stage": name, "version": stage.version, "deps": deps_fp,
+                               "params": stage.params(self.ctx)})
+
+        if name in self.frozen:
+            rec = self.records.get(name) or {}
+            # 没有记录（旧病例）或产物不全时退回记录的指纹 / 输入指纹，下游按现有文件继续
+            outputs = [self._abs(p) for p in rec.get("outputs", [])] or stage.outputs(self.ctx, None)
+            output_fp = (hash_files(outputs) if outputs else None) or rec.get("output_fp") or input_fp
+            self._output_fps[name] = output_fp
+            self.skipped.add(name)
+            write_log(self.log_root, f"[STAGE] {name} frozen output_fp={output_fp[:12]}")
+            self._notify(name, "skip")
+            return
+
+        if not self.force and self._is_current(name, input_fp):
+            self._output_fps[name] = self.records[name]["output_fp"]
+            self.skipped.add(name)
+            write_log(self.log_root, f"[STAGE] {name} up-to-date, skip")
+            self._notify(name, "skip")
+            return
+
+        t0 = time.time()
+        write_log(self.log_root, f"[STAGE] {name} run")
+        self._notify(name, "run")
+        value = stage.run(self.ctx)
+        self._values[name] = value
+        outputs = stage.outputs(self.ctx, value)
+        output_fp = (hash_files(outputs) if outputs else None) or input_fp
+        self._output_fps[name] = output_fp
+        self.executed.add(name)
+        self._save_record(name, {
+            "input_fp": input_fp,
+            "deps_fp": deps_fp,
+            "output_fp": output_fp,
+            "outputs": [self._rel(p) for p in outputs],
+            "seconds": round(time.time() - t0, 3),
+            "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        write_log(self.log_root, f"[STAGE] {name} done time={time.time()-t0:.2f}s outputs={len(outputs)}")
+        self._notify(name, "done")
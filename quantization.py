@@ -0,0 +1,233 @@
+import os
+import csv
+import json
+import time
+import glob
+import cv2
+import numpy as np
+import torch
+
+try:
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static,
+    )
+except ImportError:  # optional, 仅 nnUNet INT8 量化需要
+    CalibrationDataReader = object
+    quantize_dynamic = quantize_static = None
+
+from seg_backends import (
+    OnnxForward, artifact_path, checkpoint_signature, export_predictor,
+    update_export_meta, artifacts_current,
+)
+
+INT8_BACKEND = "onnx_int8"
+MAX_CALIBRATION_TILES = 64
+
+
+def load_sample_slices(sample_dir, limit=None):
+    """读取校准/评估用的切片 PNG（与 Axisal 下 nnUNet 输入一致的 uint8 灰度图）"""
+    paths = sorted(glob.glob(os.path.join(sample_dir, "*.png")))
+    if limit:
+        paths = paths[:limit]
+    names, slices = [], []
+    for p in paths:
+        img = cv2.imread(p, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            print(f"[跳过] 读取失败: {p}")
+            continue
+        names.append(os.path.splitext(os.path.basename(p))[0])
+        slices.append(img)
+    return names, slices
+
+
+def dice(a, b, label):
+    a = a == label
+    b = b == label
+    denom = int(a.sum()) + int(b.sum())
+    if denom == 0:
+        return 1.0
+    return 2.0 * int(np.logical_and(a, b).sum()) / denom
+
+
+############################## nnUNet 肌肉分割（ONNX Runtime INT8） ##############################
+
+class _TileReader(CalibrationDataReader):
+    def __init__(self, input_name, tiles):
+        self._items = iter([{input_name: t[None].astype(np.float32)} for t in tiles])
+
+    def get_next(self):
+        return next(self._items, None)
+
+
+def _preprocessed_groups(predictor, slices):
+    """与线上推理相同的逐张预处理，按预处理后的尺寸分组，返回 [(idx, data, [properties])]"""
+    from seg import _group_by_shape, _preprocess_slices
+    cases = _preprocess_slices(predictor, slices)
+    return [(idx, torch.cat([cases[i][0] for i in idx], dim=1), [cases[i][1] for i in idx])
+            for idx in _group_by_shape(cases).values()]
+
+
+def _calibration_tiles(predictor, groups, max_tiles=MAX_CALIBRATION_TILES):
+    from acvl_utils.cropping_and_padding.padding import pad_nd_image
+    patch_size = predictor.configuration_manager.patch_size
+    tiles = []
+    for _, data, _ in groups:
+        padded, _ = pad_nd_image(data, patch_size, 'constant', {'value': 0}, True, None)
+        for sl in predictor._internal_get_sliding_window_slicers(padded.shape[1:]):
+            tiles.append(padded[sl].numpy())
+    if len(tiles) > max_tiles:
+        keep = np.linspace(0, len(tiles) - 1, max_tiles).astype(int)
+        tiles = [tiles[i] for i in keep]
+    return tiles
+
+
+def quantize_nnunet_model(predictor, model_dir, checkpoint_path, sample_dir, mode="static",
+                          max_samples=None):
+    """把 predictor 的每个 fold 量化为 INT8 ONNX（fold_i.int8.onnx）
+
+    mode="static": 在 sample_dir 的切片上做激活校准（QDQ，权重按通道量化）
+    mode="dynamic": 仅量化权重，激活运行时动态量化，不需要校准数据
+    """
+    if quantize_static is None:
+        raise RuntimeError("未安装 onnxruntime，无法进行 INT8 量化")
+    n_folds = len(predictor.list_of_parameters)
+    ok, _ = artifacts_current(model_dir, "onnx", checkpoint_path, n_folds)
+    if not ok:
+        export_predictor(predictor, model_dir, checkpoint_path, fmt="onnx")
+
+    tiles = []
+    if mode == "static":
+        _, slices = load_sample_slices(sample_dir, max_samples)
+        if not slices:
+            raise RuntimeError(f"校准目录中没有可用切片: {sample_dir}")
+        tiles = _calibration_tiles(predictor, _preprocessed_groups(predictor, slices))
+
+    paths = []
+    for i in range(n_folds):
+        fp32_path = artifact_path(model_dir, "onnx", i)
+        int8_path = artifact_path(model_dir, INT8_BACKEND, i)
+        tmp_path = int8_path + ".part"
+        if mode == "static":
+            quantize_static(
+                fp32_path, tmp_path, _TileReader("input", tiles),
+                quant_format=QuantFormat.QDQ, per_channel=True,
+                activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+            )
+        elif mode == "dynamic":
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QUInt8)
+        else:
+            raise ValueError(f"未知量化模式: {mode}")
+        os.replace(tmp_path, int8_path)
+        paths.append(int8_path)
+
+    update_export_meta(model_dir, INT8_BACKEND, {
+        "checkpoint": checkpoint_signature(checkpoint_path),
+        "folds": n_folds,
+        "mode": mode,
+        "calibration_dir": os.path.abspath(sample_dir) if mode == "static" else None,
+        "calibration_tiles": len(tiles),
+    })
+    return paths
+
+
+def compare_nnunet_int8(predictor, model_dir, sample_dir, max_samples=None):
+    """FP32 ONNX 与 INT8 ONNX 在样本切片上的逐张 Dice 对比"""
+    from seg import _predict_preprocessed
+    names, slices = load_sample_slices(sample_dir, max_samples)
+    n_folds = len(predictor.list_of_parameters)
+    fp32 = [OnnxForward(artifact_path(model_dir, "onnx", i)) for i in range(n_folds)]
+    int8 = [OnnxForward(artifact_path(model_dir, INT8_BACKEND, i)) for i in range(n_folds)]
+    labels = [l for l in predictor.label_manager.all_labels if l != 0]
+
+    rows = []
+    timings = {"fp32": 0.0, "int8": 0.0}
+    for idx, data, properties in _preprocessed_groups(predictor, slices):
+        outputs = {}
+        for tag, forwards in (("fp32", fp32), ("int8", int8)):
+            t0 = time.time()
+            outputs[tag] = _predict_preprocessed(predictor, data, [dict(p) for p in properties], forwards=forwards)
+            timings[tag] += time.time() - t0
+        for j, i in enumerate(idx):
+            row = {"slice": names[i]}
+            for label in labels:
+                row[f"dice_label{label}"] = round(dice(outputs["fp32"][j], outputs["int8"][j], label), 4)
+            rows.append(row)
+    return _summarize(rows, timings, len(slices))
+
+
+############################## detectron2 椎体检测（动态量化） ##############################
+
+def quantize_detectron2_model(model):
+    """对 Mask R-CNN 的全连接层（box head / predictor）做动态 INT8 量化，仅适用于 CPU"""
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _spine_and_l3_masks(whole_predictor, vertebra_predictor, im):
+    """与线上 verseg.process_spine_and_vertebrae 相同的脊柱裁剪 + L3 选择"""
+    from verseg import spine_mask, sort_vertebrae, select_l3_mask
+    spine = spine_mask(whole_predictor(im)["instances"].to("cpu"))
+    if spine is None:
+        return None, None
+    crop = cv2.bitwise_and(im, im, mask=spine)
+    vert = vertebra_predictor(crop)["instances"].to("cpu")
+    return spine, select_l3_mask(sort_vertebrae(vert))
+
+
+def compare_verseg_int8(sample_dir, whole_weights, vertebra_weights, max_samples=None):
+    """FP32 与动态量化 INT8 的脊柱 / L3 mask Dice 对比（样本为矢状面 PNG）"""
+    from verseg import get_predictor, CONFIG_FILE, NUM_CLASSES, SCORE_THRESH
+    paths = sorted(glob.glob(os.path.join(sample_dir, "*.png")))[:max_samples or None]
+    models = {
+        "fp32": [get_predictor(CONFIG_FILE, w, NUM_CLASSES, SCORE_THRESH) for w in (whole_weights, vertebra_weights)],
+        "int8": [get_predictor(CONFIG_FILE, w, NUM_CLASSES, SCORE_THRESH, quantize=True) for w in (whole_weights, vertebra_weights)],
+    }
+    rows = []
+    timings = {"fp32": 0.0, "int8": 0.0}
+    for p in paths:
+        im = cv2.imread(p)
+        if im is None:
+            continue
+        out = {}
+        for tag, (whole, vert) in models.items():
+            t0 = time.time()
+            out[tag] = _spine_and_l3_masks(whole, vert, im)
+            timings[tag] += time.time() - t0
+        row = {"slice": os.path.basename(p)}
+        for k, name in enumerate(("spine", "L3")):
+            a, b = out["fp32"][k], out["int8"][k]
+            if a is None or b is None:
+                row[f"dice_{name}"] = 1.0 if a is None and b is None else 0.0
+            else:
+                row[f"dice_{name}"] = round(dice(a, b, 1), 4)
+        rows.append(row)
+    return _summarize(rows, timings, len(rows))
+
+
+############################## 报告 ##############################
+
+def _summarize(rows, timings, n):
+    keys = [k for k in (rows[0] if rows else {}) if k.startswith("dice_")]
+    summary = {
+        "samples": n,
+        "mean_dice": {k: round(float(np.mean([r[k] for r in rows])), 4) for k in keys},
+        "min_dice": {k: round(float(np.min([r[k] for r in rows])), 4) for k in keys},
+        "seconds": {k: round(v, 3) for k, v in timings.items()},
+        "speedup": round(timings["fp32"] / timings["int8"], 2) if timings["int8"] else None,
+    }
+    return {"summary": summary, "rows": rows}
+
+
+def write_report(report, out_dir, name):
+    """写 <name>.json（汇总 + 明细）和 <name>.csv（逐张 Dice）"""
+    os.makedirs(out_dir, exist_ok=True)
+    json_path = os.path.join(out_dir, f"{name}.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    csv_path = os.path.join(out_dir, f"{name}.csv")
+    rows = report["rows"]
+    if rows:
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    return json_path, csv_path
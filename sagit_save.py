@@ -5,11 +5,10 @@ import pydicom
 from pydicom.uid import generate_uid
 from PIL import Image
 import cv2
+from windowing import HU_WINDOW, apply_window
 
-# 函数：resize and save 中间切片为DICOM
-def resize_and_save_sagittal_as_dicom(
-    sagittal_slice, spacing, reference_dicom_path, output_path="sagittal_midResize.dcm"
-):
+# 函数：按 spacing 比例拉伸中间矢状面（内存中完成，不经过中间 DICOM 文件）
+def resize_sagittal(sagittal_slice, spacing):
     # Step 1: Compute spacing ratio
     spacing_z = spacing[2]  # height (Z)
     spacing_y = spacing[1]  # width  (Y)
@@ -24,7 +23,13 @@ def resize_and_save_sagittal_as_dicom(
     new_height = int(orig_height * scale_ratio)
 
     pil_resized = pil_img.resize((orig_width, new_height), resample=Image.BILINEAR)
-    resized_array = np.array(pil_resized).astype(np.int16)
+    return np.array(pil_resized).astype(np.int16)
+
+
+def save_sagittal_dicom(resized_array, spacing, reference_dicom_path, output_path):
+    """以参考 DICOM 为模板写出拉伸后的矢状面（仅作为可选导出）"""
+    spacing_z = spacing[2]
+    spacing_y = spacing[1]
 
     # Step 3: Load reference DICOM for metadata
     ds = pydicom.dcmread(reference_dicom_path)
@@ -45,55 +50,33 @@ def resize_and_save_sagittal_as_dicom(
     ds.SeriesDescription = "Resized Sagittal"
 
     # Step 5: Save
-    ds.save_as(output_path)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = output_path + ".part"
+    ds.save_as(tmp_path)
+    os.replace(tmp_path, output_path)
     return output_path
 
 
-def dicom_to_balanced_png(
-    dicom_path,
-    out_dir,
-    scale_ratio,                    # 现在暂时不用，可留作兼容
-    base_name="sagittal_midResize",
-    default_center=None,
-    default_width=None
+# 函数：resize and save 中间切片为DICOM（旧接口，保留兼容）
+def resize_and_save_sagittal_as_dicom(
+    sagittal_slice, spacing, reference_dicom_path, output_path="sagittal_midResize.dcm"
 ):
-    """
-    新增：
-      生成两份：
-        base_name_0000.png  (模型输入)
-        base_name.png       (前端/手动标注)
-    返回 (input_png_path, clean_png_path)
+    resized_array = resize_sagittal(sagittal_slice, spacing)
+    return save_sagittal_dicom(resized_array, spacing, reference_dicom_path, output_path)
+
 
+def balanced_uint8(pixel_array):
+    """
     2025/10/04
-    使用 HU 值的 -100 到 200 范围进行线性归一
+    使用 HU 值的 -100 到 200 范围进行线性归一（像素先减 100，0 值映射为 255）
+    int16 像素一次查表完成，见 windowing.apply_window
     """
-    os.makedirs(out_dir, exist_ok=True)
-
-    ds = pydicom.dcmread(dicom_path)
-    pixel_array = ds.pixel_array.astype(np.float32)
-
-    pixel_array = pixel_array * 1 - 100
-
-    # center_val = ds.get("WindowCenter", np.mean(pixel_array))
-    # width_val = ds.get("WindowWidth", np.max(pixel_array) - np.min(pixel_array))
-    # if isinstance(center_val, pydicom.multival.MultiValue):
-    #     center_val = center_val[0]
-    # if isinstance(width_val, pydicom.multival.MultiValue):
-    #     width_val = width_val[0]
-
-    # center = float(default_center) if default_center is not None else float(center_val)
-    # width = float(default_width) if default_width is not None else float(width_val)
-    # if width < 1:
-    #     width = np.max(pixel_array) - np.min(pixel_array) + 1e-5
+    return apply_window(pixel_array, slope=1.0, intercept=-100.0, window=HU_WINDOW, zero_to=255)
 
-    min_val = -100
-    max_val = 200
-    hu_clipped = np.clip(pixel_array, min_val, max_val)
-
-    hu_normalized = ((hu_clipped - min_val) / (max_val - min_val)) * 255.0
-    hu_uint8 = hu_normalized.astype(np.uint8)
-    hu_uint8[hu_uint8 == 0] = 255  
 
+def save_balanced_pngs(hu_uint8, out_dir, base_name="sagittal_midResize"):
+    """写 base_name_0000.png（模型输入）和 base_name.png（前端/手动标注），先写临时文件再原子替换"""
+    os.makedirs(out_dir, exist_ok=True)
     img = Image.fromarray(hu_uint8)
 
     input_name = f"{base_name}_0000.png"
@@ -111,6 +94,46 @@ def dicom_to_balanced_png(
 
     return input_path, clean_path
 
+
+def dicom_to_balanced_png(
+    dicom_path,
+    out_dir,
+    scale_ratio,                    # 现在暂时不用，可留作兼容
+    base_name="sagittal_midResize",
+    default_center=None,
+    default_width=None
+):
+    """
+    新增：
+      生成两份：
+        base_name_0000.png  (模型输入)
+        base_name.png       (前端/手动标注)
+    返回 (input_png_path, clean_png_path)
+    """
+    ds = pydicom.dcmread(dicom_path)
+    return save_balanced_pngs(balanced_uint8(ds.pixel_array), out_dir, base_name)
+
+
+def sagittal_to_balanced_png(
+    sagittal_slice,
+    spacing,
+    out_dir,
+    base_name="sagittal_midResize",
+    reference_dicom_path=None,
+    dicom_export_path=None
+):
+    """矢状面重建全部在内存中完成：按 spacing 拉伸 → 窗宽归一 → 写两份 PNG
+
+    结果与 resize_and_save_sagittal_as_dicom + dicom_to_balanced_png 逐像素一致，
+    但不再在进程工作目录写共享的 sagittal_midResize.dcm 再读回。
+    dicom_export_path 给定时（需同时给 reference_dicom_path）额外导出拉伸后的 DICOM，应放在病例目录下。
+    返回 (input_png_path, clean_png_path)
+    """
+    resized_array = resize_sagittal(sagittal_slice, spacing)
+    if dicom_export_path and reference_dicom_path:
+        save_sagittal_dicom(resized_array, spacing, reference_dicom_path, dicom_export_path)
+    return save_balanced_pngs(balanced_uint8(resized_array), out_dir, base_name)
+
 def overlay_and_save(img_dir, mask_dir, out_dir):
     os.makedirs(out_dir, exist_ok=True)
 
@@ -1,4 +1,5 @@
 import os
+import json
 import requests
 import time
 
@@ -6,24 +7,37 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_ROOT = os.path.join(PROJECT_ROOT, "data")
 BASE_URL = "http://localhost:4200"
 
-def wait_for_task(task_id, interval=5, timeout=3600):
-    """轮询任务状态直到完成或超时"""
-    url = f"{BASE_URL}/task_status/{task_id}"
+def wait_for_task(task_id, timeout=3600):
+    """订阅任务事件流（SSE）直到完成或超时；连接断开时带上最后的事件 id 续传"""
+    url = f"{BASE_URL}/task_events/{task_id}"
     start = time.time()
-    while True:
+    last_event_id = None
+    last_stage = None
+    while time.time() - start < timeout:
+        params = {"last_event_id": last_event_id} if last_event_id is not None else {}
         try:
-            resp = requests.get(url, timeout=10)
-            data = resp.json()
-            status = data.get("status", "")
-            print(f"    [状态] {task_id}: {status}")
-            if status in ("completed", "failed", "error"):
-                return status
+            with requests.get(url, params=params, stream=True, timeout=(10, 60)) as resp:
+                resp.raise_for_status()
+                event_id = None
+                for line in resp.iter_lines(decode_unicode=True):
+                    if line.startswith("id:"):
+                        event_id = int(line[3:].strip())
+                    elif line.startswith("data:"):
+                        last_event_id = event_id
+                        data = json.loads(line[5:])
+                        status = data.get("status", "")
+                        if data.get("stage") != last_stage or status in ("completed", "failed", "not_found"):
+                            last_stage = data.get("stage")
+                            print(f"    [状态] {task_id}: {status} {data.get('progress', 0)}% {data.get('message', '')}")
+                        if status in ("completed", "failed", "not_found"):
+                            return status
+                    if time.time() - start > timeout:
+                        break
         except Exception as e:
-            print(f"    [查询异常] {e}")
-        if time.time() - start > timeout:
-            print(f"    [超时] {task_id}")
-            return "timeout"
-        time.sleep(interval)
+            print(f"    [连接异常] {e}")
+            time.sleep(5)
+    print(f"    [超时] {task_id}")
+    return "timeout"
 
 def trigger_all_process(sleep_sec=4):
     for name in os.listdir(DATA_ROOT):
@@ -37,7 +51,8 @@ def trigger_all_process(sleep_sec=4):
         url = f"{BASE_URL}/process/{patient_name}/{study_date}"
         print(f"[提交] {url}")
         try:
-            resp = requests.post(url, timeout=60)
+            # 批量任务排在交互提交的任务之后，不挤占在线用户
+            resp = requests.post(url, params={"priority": "batch"}, timeout=60)
             resp_json = resp.json()
             print(f"  状态: {resp.status_code} {resp_json}")
             task_id = resp_json.get("task_id")
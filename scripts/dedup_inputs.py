@@ -0,0 +1,39 @@
+import os
+import sys
+import argparse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from blob_store import BlobStore, BLOB_STORE_DIR
+
+
+def find_input_dirs(data_root):
+    """data/<病例>/input 与 data/<用户>/<病例>/input（跳过 . 开头的内部目录）"""
+    for dirpath, dirnames, _ in os.walk(data_root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        if os.path.basename(dirpath) == "input":
+            dirnames[:] = []
+            yield dirpath
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把已有病例的 input/ 纳入去重存储，并清理无引用的 blob")
+    parser.add_argument("--data-root", default="data")
+    parser.add_argument("--blob-dir", default=BLOB_STORE_DIR)
+    parser.add_argument("--gc-only", action="store_true", help="只清理无引用的 blob")
+    args = parser.parse_args()
+
+    store = BlobStore(args.blob_dir)
+    if not args.gc_only:
+        for input_dir in find_input_dirs(args.data_root):
+            counts = store.ingest_folder(input_dir)
+            print(f"[去重] {input_dir} {counts}")
+    removed, freed = store.gc()
+    print(f"[清理] 删除 blob {removed} 个，释放 {freed / 1024 / 1024:.1f} MB")
+    print(f"[统计] {store.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import argparse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from seg import nnunet_predictor, resolve_checkpoint
+from seg_backends import export_predictor, export_dir
+
+DEFAULT_MODEL_DIRS = [
+    "nnUNet_results/Dataset001_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d",
+    "nnUNet_results/Dataset002_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d",
+]
+
+
+def export_models(model_dirs, checkpoint="checkpoint_final.pth", formats=("onnx",)):
+    for model_dir in model_dirs:
+        use_folds, checkpoint_path = resolve_checkpoint(model_dir, checkpoint)
+        with nnunet_predictor(model_dir, checkpoint, use_folds) as predictor:
+            for fmt in formats:
+                paths = export_predictor(predictor, model_dir, checkpoint_path, fmt=fmt)
+                print(f"[导出] {model_dir} -> {fmt} x{len(paths)}: {paths}")
+        print(f"[完成] 产物目录: {export_dir(model_dir)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把 nnUNet 2D 肌肉分割网络导出为 ONNX / TorchScript")
+    parser.add_argument("--model-dir", action="append", help="nnUNet 训练输出目录，可多次指定（默认 Dataset001 + Dataset002）")
+    parser.add_argument("--checkpoint", default="checkpoint_final.pth")
+    parser.add_argument("--format", choices=["onnx", "torchscript", "both"], default="onnx")
+    args = parser.parse_args()
+    os.chdir(PROJECT_ROOT)
+    formats = ("onnx", "torchscript") if args.format == "both" else (args.format,)
+    export_models(args.model_dir or DEFAULT_MODEL_DIRS, args.checkpoint, formats)
+    print("设置 IDOCTOR_SEG_BACKEND=onnx 或 torchscript 后重启服务即可使用导出的网络")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import argparse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from seg import nnunet_predictor, resolve_checkpoint
+from seg_backends import export_dir
+from quantization import (
+    quantize_nnunet_model, compare_nnunet_int8, compare_verseg_int8, write_report,
+)
+from verseg import WHOLE_WEIGHTS, VERTEBRA_WEIGHTS
+
+DEFAULT_MODEL_DIRS = [
+    "nnUNet_results/Dataset001_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d",
+    "nnUNet_results/Dataset002_MyPNGTask/nnUNetTrainer__nnUNetPlans__2d",
+]
+
+
+def _print_summary(title, report):
+    summary = report["summary"]
+    print(f"[{title}] 样本 {summary['samples']}，平均 Dice {summary['mean_dice']}，"
+          f"最低 Dice {summary['min_dice']}，耗时 {summary['seconds']}，加速 {summary['speedup']}x")
+
+
+def quantize_nnunet(model_dirs, samples, mode, checkpoint="checkpoint_final.pth", max_samples=None):
+    for model_dir in model_dirs:
+        use_folds, checkpoint_path = resolve_checkpoint(model_dir, checkpoint)
+        with nnunet_predictor(model_dir, checkpoint, use_folds) as predictor:
+            paths = quantize_nnunet_model(predictor, model_dir, checkpoint_path, samples,
+                                          mode=mode, max_samples=max_samples)
+            print(f"[量化] {model_dir} -> onnx_int8 x{len(paths)}: {paths}")
+            report = compare_nnunet_int8(predictor, model_dir, samples, max_samples)
+        report["summary"]["mode"] = mode
+        json_path, csv_path = write_report(report, export_dir(model_dir), "quant_report")
+        _print_summary(os.path.basename(os.path.dirname(model_dir)), report)
+        print(f"[报告] {json_path} / {csv_path}")
+
+
+def compare_verseg(samples, out_dir, max_samples=None):
+    report = compare_verseg_int8(samples, WHOLE_WEIGHTS, VERTEBRA_WEIGHTS, max_samples)
+    json_path, csv_path = write_report(report, out_dir, "verseg_quant_report")
+    _print_summary("verseg", report)
+    print(f"[报告] {json_path} / {csv_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="nnUNet / detectron2 模型 INT8 量化与 FP32 Dice 对比")
+    parser.add_argument("--samples", help="nnUNet 校准/评估切片目录（Axisal 下的 slice_*.png）")
+    parser.add_argument("--mode", choices=["static", "dynamic"], default="static",
+                        help="static: 用 --samples 校准激活；dynamic: 仅量化权重")
+    parser.add_argument("--model-dir", action="append", help="nnUNet 训练输出目录，可多次指定（默认 Dataset001 + Dataset002）")
+    parser.add_argument("--checkpoint", default="checkpoint_final.pth")
+    parser.add_argument("--max-samples", type=int, default=None)
+    parser.add_argument("--verseg-samples", help="矢状面 PNG 目录，对椎体检测模型做 FP32 / INT8 对比")
+    parser.add_argument("--report-dir", default="quant_reports", help="verseg 报告输出目录")
+    args = parser.parse_args()
+    if not args.samples and not args.verseg_samples:
+        parser.error("至少指定 --samples 或 --verseg-samples")
+    samples = os.path.abspath(args.samples) if args.samples else None
+    verseg_samples = os.path.abspath(args.verseg_samples) if args.verseg_samples else None
+    report_dir = os.path.abspath(args.report_dir)
+    os.chdir(PROJECT_ROOT)
+
+    if samples:
+        quantize_nnunet(args.model_dir or DEFAULT_MODEL_DIRS, samples, args.mode,
+                        args.checkpoint, args.max_samples)
+        print("设置 IDOCTOR_SEG_BACKEND=onnx_int8 后重启服务即可使用量化后的肌肉分割网络")
+    if verseg_samples:
+        compare_verseg(verseg_samples, report_dir, args.max_samples)
+        print("设置 IDOCTOR_VERSEG_QUANTIZE=1 后重启服务即可在 CPU 上使用量化后的椎体检测模型")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,18 @@
-import os, time, glob, hashlib, threading, traceback, cv2, torch, gc
+import os, time, hashlib, traceback, cv2, torch, gc
+import json, copy
+import numpy as np
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
 from pipeline_logging import write_log
+from model_registry import get_registry
+from nnunet_batch import predict_logits_batched
+from inference_profiles import resolve_profile, apply_profile
+from seg_backends import load_backend_forwards, resolve_backend
+from inference_progress import InferenceProgress
+from pipeline_graph import PipelineAborted
+from seg_cache import get_seg_cache, slice_digest, model_fingerprint, inference_variant
 
 def _file_md5(path):
     try:
@@ -10,11 +22,302 @@ def _file_md5(path):
     except Exception:
         return "NA"
 
+def _release_predictor(key, predictor):
+    del predictor
+    gc.collect()
+    if torch.cuda.is_available():
+        try:
+            torch.cuda.empty_cache()
+        except Exception:
+            pass
+
+
+_NNUNET_REGISTRY = get_registry("nnunet", on_evict=_release_predictor)
+
+
+def resolve_checkpoint(model_dir: str, checkpoint: str = "checkpoint_final.pth"):
+    """检查权重文件位置：优先 fold_all，其次根目录。返回 (use_folds, checkpoint_path)"""
+    fold_all_weight = os.path.join(model_dir, 'fold_all', checkpoint)
+    root_weight = os.path.join(model_dir, checkpoint)
+    if os.path.isfile(fold_all_weight):
+        return 'all', fold_all_weight
+    if os.path.isfile(root_weight):
+        return None, root_weight
+    raise RuntimeError(f"权重文件不存在: {fold_all_weight} 或 {root_weight}")
+
+
+def _load_predictor(model_dir, checkpoint, use_folds):
+    predictor = nnUNetPredictor(
+        tile_step_size=0.5,
+        use_gaussian=True,
+        use_mirroring=True,
+        perform_everything_on_device=True,
+        device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'),
+        verbose=False,
+        verbose_preprocessing=False,
+        allow_tqdm=False,
+    )
+    predictor.initialize_from_trained_model_folder(
+        model_dir,
+        use_folds=use_folds,
+        checkpoint_name=checkpoint,
+    )
+    return predictor
+
+
+@contextmanager
+def nnunet_predictor(model_dir: str, checkpoint: str = "checkpoint_final.pth", use_folds="auto"):
+    """从进程级注册表中取出已初始化的 nnUNetPredictor（首次调用时加载）
+
+    同一个 (model_dir, checkpoint, folds) 只加载一次；with 块内独占该 predictor。
+    use_folds="auto" 时按 resolve_checkpoint 的规则选择 fold_all / 根目录权重。
+    """
+    if use_folds == "auto":
+        use_folds, _ = resolve_checkpoint(model_dir, checkpoint)
+    folds_key = use_folds if use_folds is None or isinstance(use_folds, str) else tuple(use_folds)
+    key = (os.path.abspath(model_dir), checkpoint, folds_key)
+    with _NNUNET_REGISTRY.acquire(key, lambda: _load_predictor(model_dir, checkpoint, use_folds)) as predictor:
+        yield predictor
+
+
+def _group_by_shape(cases):
+    """按预处理后的空间尺寸分组，同组切片可以拼成一个 batch 前向"""
+    groups = {}
+    for i, (data, _) in enumerate(cases):
+        groups.setdefault(tuple(data.shape[2:]), []).append(i)
+    return groups
+
+
+# 多模型并行推理：auto = CPU 核数 >= 4 时两个网络各用一个线程同时跑
+SEG_PARALLEL = os.environ.get("IDOCTOR_SEG_PARALLEL", "auto")
+
+
+def _preprocess_signature(predictor):
+    """决定预处理结果能否在模型间共享的 plans 字段（归一化、spacing、重采样、转置）"""
+    conf = predictor.configuration_manager.configuration
+    plans = predictor.plans_manager.plans
+    return json.dumps({
+        "normalization_schemes": conf.get("normalization_schemes"),
+        "use_mask_for_norm": conf.get("use_mask_for_norm"),
+        "spacing": conf.get("spacing"),
+        "resampling_fn_data": conf.get("resampling_fn_data"),
+        "resampling_fn_data_kwargs": conf.get("resampling_fn_data_kwargs"),
+        "preprocessor_name": conf.get("preprocessor_name"),
+        "transpose_forward": plans.get("transpose_forward"),
+        "intensity": plans.get("foreground_intensity_properties_per_channel"),
+    }, sort_keys=True, default=str)
+
+
+def _preprocess_case(predictor, data, properties):
+    """对一个 (C, 1, H, W) case 执行 nnUNet 预处理，properties 会被原地补充裁剪/形状信息"""
+    preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+    out = preprocessor.run_case_npy(data, None, properties, predictor.plans_manager,
+                                    predictor.configuration_manager, predictor.dataset_json)
+    return torch.from_numpy(np.ascontiguousarray(out[0])).float()
+
+
+def _preprocess_slices(predictor, slices):
+    """每张切片单独作为一个 (1, 1, H, W) case 预处理，返回 [(data, properties)]
+
+    归一化统计与 crop_to_nonzero 只看本切片，label 只取决于切片本身（与逐张推理一致），
+    spacing 与 NaturalImage2DIO 一致 (999, 1, 1)
+    """
+    cases = []
+    for sl in slices:
+        properties = {"spacing": [999.0, 1.0, 1.0]}
+        data = _preprocess_case(predictor, np.asarray(sl, dtype=np.float32)[None, None], properties)
+        cases.append((data, properties))
+    return cases
+
+
+def _predict_preprocessed(predictor, data, properties_list, parameters=None, forwards=None, progress=None):
+    """data: 同尺寸切片拼成的 (C, n, h, w)；返回每张切片还原到原始尺寸的 (H, W) label"""
+    # 批量滑窗：多张切片的 tile 堆成一个 batch 前向，batch size 见 IDOCTOR_SEG_BATCH_SIZE；
+    # 滑窗逐切片进行，batch 组成不影响单张切片的结果
+    # forwards 非空时使用 ONNX / TorchScript 导出的网络（每个 fold 一个）
+    # progress: 滑窗循环每个 batch 完成后回调 progress(done_tiles, total_tiles)
+    logits = predict_logits_batched(predictor, data, parameters=parameters, forward=forwards, progress=progress)
+    return [np.asarray(convert_predicted_logits_to_segmentation_with_correct_shape(
+        logits[:, j:j + 1], predictor.plans_manager, predictor.configuration_manager,
+        predictor.label_manager, properties, return_probabilities=False,
+    ))[0] for j, properties in enumerate(properties_list)]
+
+
+def _use_parallel(n_models):
+    if n_models < 2:
+        return False
+    if SEG_PARALLEL == "auto":
+        return (os.cpu_count() or 1) >= 4
+    return SEG_PARALLEL not in ("0", "false", "False")
+
+
+def predict_slice_stack_multi(slices, models: dict, log_root: str = None, profile: str = None, progress=None,
+                              use_cache: bool = True, backends: dict = None):
+    """多模型内存推理：同一切片栈只预处理一次，再分别送入各个网络
+
+    slices: (N, H, W) uint8 数组，或 N 个 (H, W) 数组的列表（与写出的 *_0000.png 像素一致）
+    models: {名称: (model_dir, checkpoint)}
+    返回: {名称: 与输入一一对应的 (H, W) uint8 label 列表}
+
+    每张切片单独预处理（与逐张推理等价，结果只取决于切片像素），只把网络前向按 batch 合并。
+    只有预处理相关的 plans 字段完全一致的模型才共享预处理结果，否则各自预处理。
+    profile: 推理档位（fast / balanced / accurate），为空时使用服务默认档位
+    progress: 进度回调 progress(event)，event 含 slices_done / slices_total / throughput / eta_seconds，
+              由滑窗推理循环直接上报（见 inference_progress.InferenceProgress），同时写入 pipeline.log
+    use_cache: 按 (切片像素, 模型指纹, 档位/后端) 复用已缓存的 label（见 seg_cache），只推理未命中的切片
+    backends: 传入 dict 时填入各模型实际使用的前向后端（导出产物不可用而回退 torch 时为 "torch"）
+    """
+    profile_name, settings = resolve_profile(profile)
+    slices = [np.asarray(sl) for sl in slices]
+    results = {name: [None] * len(slices) for name in models}
+    if not slices:
+        return results
+
+    cache = get_seg_cache() if use_cache else None
+    # 缓存 key 使用实际会运行的后端，ONNX / TorchScript 回退 torch 时不会记在导出后端名下
+    resolved, fingerprints, digests = {}, {}, []
+    for name, (model_dir, checkpoint) in models.items():
+        _, checkpoint_path = resolve_checkpoint(model_dir, checkpoint)
+        resolved[name] = resolve_backend(model_dir, checkpoint_path)
+        if cache is not None:
+            fingerprints[name] = model_fingerprint(model_dir, checkpoint_path)
+
+    def cache_keys(name, backend):
+        variant = inference_variant(profile_name, settings, backend)
+        return [cache.key(d, fingerprints[name], variant) for d in digests]
+
+    if cache is not None:
+        t0 = time.time()
+        digests = [slice_digest(sl) for sl in slices]
+        for name in models:
+            for i, key in enumerate(cache_keys(name, resolved[name])):
+                label = cache.get(key)
+                if label is not None and label.shape == slices[i].shape[:2]:
+                    results[name][i] = label
+        hits = {name: sum(r is not None for r in labels) for name, labels in results.items()}
+        write_log(log_root, f"[nnUNet] CACHE hits={hits} slices={len(slices)} backends={resolved} lookup_time={time.time()-t0:.2f}s")
+
+    pending = {name: [i for i, r in enumerate(labels) if r is None] for name, labels in results.items()}
+    todo = sorted(set(i for idx in pending.values() for i in idx))
+    if todo:
+        todo_models = {name: models[name] for name in models if pending[name]}
+        computed, used = _predict_stack([slices[i] for i in todo], todo_models, log_root,
+                                        profile_name, settings, progress)
+        resolved.update(used)
+        for name, labels in computed.items():
+            keys = cache_keys(name, used[name]) if cache is not None else None
+            for j, i in enumerate(todo):
+                if results[name][i] is None:
+                    results[name][i] = labels[j]
+                    if cache is not None:
+                        cache.put(keys[i], labels[j])
+    if backends is not None:
+        backends.update(resolved)
+    return results
+
+
+def _predict_stack(slices, models, log_root, profile_name, settings, progress=None):
+    """predict_slice_stack_multi 的推理部分（不经过缓存），返回 (结果, {名称: 实际使用的后端})"""
+    results = {name: [None] * len(slices) for name in models}
+    t0 = time.time()
+    parallel = _use_parallel(len(models))
+    tracker = InferenceProgress(len(slices) * len(models), log_root=log_root, callback=progress)
+
+    # 按 key 排序后依次占用 predictor，避免与其它请求交叉加锁
+    ordered = sorted(models.items(), key=lambda kv: os.path.abspath(kv[1][0]))
+    with ExitStack() as stack:
+        predictors = {}
+        fold_params = {}
+        forwards = {}
+        backends = {}
+        for name, (model_dir, checkpoint) in ordered:
+            use_folds, checkpoint_path = resolve_checkpoint(model_dir, checkpoint)
+            predictors[name] = stack.enter_context(nnunet_predictor(model_dir, checkpoint, use_folds))
+            # predictor 在注册表中共享，每次占用后都要重新写入档位参数
+            fold_params[name] = apply_profile(predictors[name], settings)
+            backends[name], fwd = load_backend_forwards(
+                model_dir, checkpoint_path, len(predictors[name].list_of_parameters))
+            forwards[name] = fwd[:len(fold_params[name])] if fwd else None
+
+        share_groups = {}
+        for name, predictor in predictors.items():
+            share_groups.setdefault(_preprocess_signature(predictor), []).append(name)
+        write_log(log_root, f"[nnUNet] MULTI models={list(models)} profile={profile_name} backends={backends} preprocess_groups={list(share_groups.values())} parallel={parallel}")
+
+        jobs = []
+        for names in share_groups.values():
+            pp_t0 = time.time()
+            cases = _preprocess_slices(predictors[names[0]], slices)
+            groups = _group_by_shape(cases)
+            write_log(log_root, f"[nnUNet] PREPROCESS shared_by={names} slices={len(cases)} shapes={list(groups)} time={time.time()-pp_t0:.2f}s")
+            for group, idx in enumerate(groups.values()):
+                data = torch.cat([cases[i][0] for i in idx], dim=1)
+                for name in names:
+                    jobs.append((name, group, idx, data, [copy.deepcopy(cases[i][1]) for i in idx]))
+
+        # 同一模型的各尺寸组在一个线程内依次推理（predictor 不能并发使用），不同模型之间可并行
+        tasks = {}
+        for name, group, idx, data, props in jobs:
+            tasks.setdefault(name, []).append((idx, (predictors[name], data, props, fold_params[name], forwards[name],
+                                                     tracker.task((name, group), len(idx)))))
+
+        def run_model(model_tasks):
+            return [(idx, _predict_preprocessed(*a)) for idx, a in model_tasks]
+
+        pool = ThreadPoolExecutor(max_workers=len(models)) if parallel else None
+        try:
+            if pool is not None:
+                futures = {name: pool.submit(run_model, t) for name, t in tasks.items()}
+                outputs = {name: f.result() for name, f in futures.items()}
+            else:
+                outputs = {name: run_model(t) for name, t in tasks.items()}
+
+            for name, done in outputs.items():
+                for idx, segs in done:
+                    for j, i in enumerate(idx):
+                        results[name][i] = segs[j].astype(np.uint8)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+    write_log(log_root, f"[nnUNet] STACK_DONE models={list(models)} slices={len(slices)} infer_time={time.time()-t0:.2f}s")
+    return results, backends
+
+
+def predict_slice_stack(slices,
+                        model_dir: str,
+                        checkpoint: str = "checkpoint_final.pth",
+                        log_root: str = None,
+                        profile: str = None,
+                        progress=None):
+    """单模型内存推理，见 predict_slice_stack_multi"""
+    return predict_slice_stack_multi(slices, {"model": (model_dir, checkpoint)},
+                                     log_root=log_root, profile=profile, progress=progress)["model"]
+
+
+def save_label_pngs(labels, names, output_dir: str):
+    """按 nnUNet PNG 导出格式（原始 label 值）保存 <name>.png，仅在需要落盘产物时调用"""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, lab in zip(names, labels):
+        path = os.path.join(output_dir, f"{name}.png")
+        cv2.imwrite(path, lab)
+        paths.append(path)
+    return paths
+
+
 def run_nnunet_predict_and_overlay(input_dir: str,
                                    output_dir: str,
                                    model_dir: str,
-                                   checkpoint: str = "checkpoint_final.pth"):
-    """增加详细日志和进度 watchdog"""
+                                   checkpoint: str = "checkpoint_final.pth",
+                                   profile: str = None,
+                                   progress=None,
+                                   progress_model: str = None):
+    """文件模式推理（*_0000.png → output_dir），增加详细日志
+
+    progress: 进度回调，每推理完一个 case（即一张切片）由推理循环上报一次，见 predict_slice_stack_multi
+    progress_model: 进度事件中的模型名，默认 output_dir 目录名
+    """
     for k in ['nnUNet_raw', 'nnUNet_preprocessed', 'nnUNet_results']:
         if k not in os.environ:
             os.environ[k] = os.getcwd()
@@ -61,66 +364,11 @@ def run_nnunet_predict_and_overlay(input_dir: str,
     old_num_threads = os.environ.get('OMP_NUM_THREADS')
     os.environ['OMP_NUM_THREADS'] = '1'
 
-    predictor = None
     start_time = time.time()
-    done_flag = {"v": False}
-    timeout_seconds = 180
-
-    def watchdog():
-        last_report = -1
-        while not done_flag["v"]:
-            elapsed = time.time() - start_time
-            nii_count = len(glob.glob(os.path.join(output_dir, '*.nii.gz')))
-            if nii_count != last_report or int(elapsed) % 30 == 0:
-                gpu_mem = 0.0
-                if torch.cuda.is_available():
-                    try:
-                        gpu_mem = torch.cuda.memory_allocated()/1024**3
-                    except Exception:
-                        pass
-                write_log(log_root, f"[nnUNet] PROGRESS elapsed={elapsed:.1f}s nii={nii_count} gpu_mem={gpu_mem:.2f}GB")
-                last_report = nii_count
-            if elapsed > timeout_seconds and not done_flag['v']:
-                write_log(log_root, f"[nnUNet] WATCHDOG_TIMEOUT elapsed={elapsed:.1f}s (>={timeout_seconds}s)")
-            time.sleep(5)
-
-    wd = threading.Thread(target=watchdog, daemon=True)
-    wd.start()
 
     try:
-        # 检查权重文件位置：优先 fold_all，其次根目录
-        fold_all_weight = os.path.join(model_dir, 'fold_all', checkpoint)
-        root_weight = os.path.join(model_dir, checkpoint)
-        
-        if os.path.isfile(fold_all_weight):
-            use_folds = 'all'
-            checkpoint_path = fold_all_weight
-            write_log(log_root, f"[nnUNet] checkpoint_found={fold_all_weight} (fold_all)")
-        elif os.path.isfile(root_weight):
-            use_folds = None
-            checkpoint_path = root_weight
-            write_log(log_root, f"[nnUNet] checkpoint_found={root_weight} (root)")
-        else:
-            raise RuntimeError(f"权重文件不存在: {fold_all_weight} 或 {root_weight}")
-
-        predictor = nnUNetPredictor(
-            tile_step_size=0.5,
-            use_gaussian=True,
-            use_mirroring=True,
-            perform_everything_on_device=True,
-            device=torch.device('cuda' if torch.cuda.is_available() else 'cpu'),
-            verbose=True,
-            verbose_preprocessing=True,
-        )
-        write_log(log_root, "[nnUNet] predictor_created")
-        
-        predictor.initialize_from_trained_model_folder(
-            model_dir,
-            use_folds=use_folds,
-            checkpoint_name=checkpoint,
-        )
-        write_log(log_root, "[nnUNet] model_initialized begin_predict")
-        write_log(log_root, f"[nnUNet] PREDICT_CALL input_type={type(input_dir)} is_dir={os.path.isdir(input_dir)}")
+        use_folds, checkpoint_path = resolve_checkpoint(model_dir, checkpoint)
+        write_log(log_root, f"[nnUNet] checkpoint_found={checkpoint_path} ({'fold_all' if use_folds == 'all' else 'root'})")
 
         # 2. 构造 list-of-lists cases (单模态) 而不是传目录字符串
         cases = [[os.path.join(input_dir, f)] for f in sorted(os.listdir(input_dir)) if f.endswith('_0000.png')]
@@ -128,30 +376,52 @@ def run_nnunet_predict_and_overlay(input_dir: str,
         if not cases:
             raise RuntimeError("未找到 *_0000.png 作为 nnUNet 输入")
 
-        # 3. 推理  
-        infer_t0 = time.time()
-        predictor.predict_from_files(
-            cases,
-            output_dir,
-            save_probabilities=False,
-            num_processes_preprocessing=1,
-            num_processes_segmentation_export=1,
-        )
-        infer_t1 = time.time()
-
-        # 4. 等待最多 60s 收集输出文件（支持 .nii.gz 或 .png）
-        deadline = time.time() + 60
-        output_files = []
-        while time.time() < deadline:
-            # 检查 nii.gz 或 png 输出
-            nii_files = [f for f in os.listdir(output_dir) if f.endswith('.nii.gz')]
-            png_files = [f for f in os.listdir(output_dir) if f.endswith('.png') and not f.endswith('_0000.png')]
-            output_files = nii_files if nii_files else png_files
-            
-            if len(output_files) >= len(cases):
-                break
-            time.sleep(1)
-            
+        acquire_t0 = time.time()
+        with nnunet_predictor(model_dir, checkpoint, use_folds) as predictor:
+            # 模型来自进程级注册表，首次调用才会真正加载权重
+            write_log(log_root, f"[nnUNet] predictor_ready acquire_time={time.time()-acquire_t0:.2f}s")
+            write_log(log_root, f"[nnUNet] PREDICT_CALL input_type={type(input_dir)} is_dir={os.path.isdir(input_dir)}")
+
+            profile_name, settings = resolve_profile(profile)
+            all_params = predictor.list_of_parameters
+            predictor.list_of_parameters = apply_profile(predictor, settings)
+            write_log(log_root, f"[nnUNet] profile={profile_name} settings={settings}")
+
+            # predict_from_files 每个 case 调用一次 predict_logits_from_preprocessed_data，
+            # 在这里上报进度（predictor 已被独占，结束后恢复原方法）
+            tracker = InferenceProgress(len(cases), log_root=log_root, callback=progress)
+            model_key = progress_model or os.path.basename(os.path.normpath(output_dir))
+            cases_done = {"n": 0}
+            original_predict = predictor.predict_logits_from_preprocessed_data
+
+            def predict_with_progress(data):
+                logits = original_predict(data)
+                cases_done["n"] += 1
+                tracker.update(model_key, cases_done["n"])
+                return logits
+
+            predictor.predict_logits_from_preprocessed_data = predict_with_progress
+
+            # 3. 推理（返回前 nnUNet 已等待所有导出任务完成，输出文件此时都已写出）
+            infer_t0 = time.time()
+            try:
+                predictor.predict_from_files(
+                    cases,
+                    output_dir,
+                    save_probabilities=False,
+                    num_processes_preprocessing=1,
+                    num_processes_segmentation_export=1,
+                )
+            finally:
+                predictor.list_of_parameters = all_params
+                del predictor.predict_logits_from_preprocessed_data
+            infer_t1 = time.time()
+
+        # 4. 收集输出文件（支持 .nii.gz 或 .png）
+        nii_files = [f for f in os.listdir(output_dir) if f.endswith('.nii.gz')]
+        png_files = [f for f in os.listdir(output_dir) if f.endswith('.png') and not f.endswith('_0000.png')]
+        output_files = nii_files if nii_files else png_files
+
         dur = time.time() - start_time
         out_files = sorted(os.listdir(output_dir))
         output_format = '.nii.gz' if any(f.endswith('.nii.gz') for f in output_files) else '.png'
@@ -159,14 +429,12 @@ def run_nnunet_predict_and_overlay(input_dir: str,
         
         if len(output_files) == 0:
             raise RuntimeError("推理完成但未生成输出文件 (检查权重/输入尺寸/模型配置)")
+    except PipelineAborted:
+        raise
     except Exception as e:
         write_log(log_root, f"[nnUNet] EXCEPTION {e}")
         traceback.print_exc()
     finally:
-        done_flag['v'] = True
-        wd.join(timeout=1)
-        if predictor is not None:
-            del predictor
         gc.collect()
         if torch.cuda.is_available():
             try:
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import torch
+from model_registry import get_registry
+
+try:
+    import onnxruntime as ort  # optional, 仅 onnx 后端需要
+except ImportError:
+    ort = None
+
+# 肌肉分割网络的前向后端：torch（默认，eager PyTorch）/ onnx（ONNX Runtime）/ torchscript
+#                        / onnx_int8（INT8 量化后的 ONNX，见 quantization.py）
+SEG_BACKEND = os.environ.get("IDOCTOR_SEG_BACKEND", "torch")
+# 后端推理线程数，0 = 由运行时自行决定
+SEG_BACKEND_THREADS = int(os.environ.get("IDOCTOR_SEG_BACKEND_THREADS", "0"))
+
+EXPORT_DIRNAME = "export"
+EXPORT_META = "export_meta.json"
+_EXTENSIONS = {"onnx": ".onnx", "torchscript": ".pt", "onnx_int8": ".int8.onnx"}
+
+_BACKEND_REGISTRY = get_registry("seg_backends")
+
+
+def export_dir(model_dir):
+    return os.path.join(model_dir, EXPORT_DIRNAME)
+
+
+def artifact_path(model_dir, fmt, fold_index):
+    return os.path.join(export_dir(model_dir), f"fold_{fold_index}{_EXTENSIONS[fmt]}")
+
+
+def checkpoint_signature(checkpoint_path):
+    st = os.stat(checkpoint_path)
+    return {"path": os.path.abspath(checkpoint_path), "size": st.st_size, "mtime": int(st.st_mtime)}
+
+
+def export_network(network, patch_size, num_input_channels, out_path, fmt="onnx", opset=17):
+    """把单个 fold 的网络导出为 ONNX / TorchScript（batch 维动态，空间维为 patch 大小）"""
+    network = getattr(network, "_orig_mod", network)
+    network = network.cpu().eval()
+    example = torch.randn(1, num_input_channels, *patch_size)
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp_path = out_path + ".part"
+    with torch.no_grad():
+        if fmt == "onnx":
+            torch.onnx.export(
+                network, example, tmp_path,
+                input_names=["input"], output_names=["logits"],
+                dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=opset, do_constant_folding=True,
+            )
+        elif fmt == "torchscript":
+            traced = torch.jit.trace(network, example)
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+            traced.save(tmp_path)
+        else:
+            raise ValueError(f"未知导出格式: {fmt}")
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def export_predictor(predictor, model_dir, checkpoint_path, fmt="onnx"):
+    """导出 predictor 中每个 fold 的权重，并写 export_meta.json 记录对应的 checkpoint"""
+    from nnunet_batch import _load_parameters
+    patch_size = list(predictor.configuration_manager.patch_size)
+    num_input_channels = len(predictor.dataset_json["channel_names"])
+    paths = []
+    for i, params in enumerate(predictor.list_of_parameters):
+        _load_parameters(predictor.network, params)
+        paths.append(export_network(predictor.network, patch_size, num_input_channels,
+                                    artifact_path(model_dir, fmt, i), fmt=fmt))
+
+    update_export_meta(model_dir, fmt, {
+        "checkpoint": checkpoint_signature(checkpoint_path),
+        "folds": len(paths),
+        "patch_size": patch_size,
+        "num_input_channels": num_input_channels,
+    })
+    return paths
+
+
+def update_export_meta(model_dir, fmt, entry):
+    meta_path = os.path.join(export_dir(model_dir), EXPORT_META)
+    meta = {}
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    entry = dict(entry)
+    entry["exported_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    meta[fmt] = entry
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+class OnnxForward:
+    """ONNX Runtime 前向：输入输出都是 torch.Tensor，可直接替换 predictor.network"""
+
+    def __init__(self, path, num_threads=None, providers=None):
+        if ort is None:
+            raise RuntimeError("未安装 onnxruntime，无法使用 onnx 后端")
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        num_threads = SEG_BACKEND_THREADS if num_threads is None else num_threads
+        if num_threads:
+            opts.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=opts,
+                                            providers=providers or ["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        out = self.session.run(None, {self.input_name: x.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(out)
+
+
+class TorchScriptForward:
+    """TorchScript（freeze + optimize_for_inference）前向"""
+
+    def __init__(self, path, num_threads=None):
+        num_threads = SEG_BACKEND_THREADS if num_threads is None else num_threads
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.path = path
+        self.module = torch.jit.load(path, map_location="cpu").eval()
+
+    def __call__(self, x):
+        with torch.no_grad():
+            return self.module(x.cpu().float())
+
+
+_FORWARD_CLASSES = {"onnx": OnnxForward, "torchscript": TorchScriptForward, "onnx_int8": OnnxForward}
+
+
+def artifacts_current(model_dir, fmt, checkpoint_path, n_folds=None):
+    """导出产物是否与当前 checkpoint 对应；n_folds 为空时不校验 fold 数，按导出记录检查文件"""
+    meta_path = os.path.join(export_dir(model_dir), EXPORT_META)
+    if not os.path.isfile(meta_path):
+        return False, "export_meta.json 不存在"
+    with open(meta_path, "r", encoding="utf-8") as f:
+        entry = json.load(f).get(fmt)
+    if not entry:
+        return False, f"未导出 {fmt}"
+    if entry.get("checkpoint") != checkpoint_signature(checkpoint_path):
+        return False, "checkpoint 已变化，需要重新导出"
+    if n_folds is not None and entry.get("folds") != n_folds:
+        return False, "fold 数量不一致"
+    for i in range(entry.get("folds") or 0):
+        if not os.path.isfile(artifact_path(model_dir, fmt, i)):
+            return False, f"缺少 {artifact_path(model_dir, fmt, i)}"
+    return True, ""
+
+
+def resolve_backend(model_dir, checkpoint_path, n_folds=None, backend=None):
+    """实际会使用的前向后端名（导出产物不可用时为 "torch"），不加载网络；用于缓存 key 与推理元数据"""
+    backend = backend or SEG_BACKEND
+    if backend == "torch":
+        return "torch"
+    if backend not in _FORWARD_CLASSES:
+        raise ValueError(f"未知分割后端: {backend}")
+    ok, _ = artifacts_current(model_dir, backend, checkpoint_path, n_folds)
+    return backend if ok else "torch"
+
+
+def load_backend_forwards(model_dir, checkpoint_path, n_folds, backend=None):
+    """返回 (backend_name, [每个 fold 的前向函数])；torch 后端或导出产物不可用时返回 ("torch", None)"""
+    backend = backend or SEG_BACKEND
+    if backend == "torch":
+        return "torch", None
+    if backend not in _FORWARD_CLASSES:
+        raise ValueError(f"未知分割后端: {backend}")
+    ok, reason = artifacts_current(model_dir, backend, checkpoint_path, n_folds)
+    if not ok:
+        print(f"[seg_backends] {backend} 不可用，回退 torch: {reason}")
+        return "torch", None
+    key = (backend, os.path.abspath(model_dir), tuple(sorted(checkpoint_signature(checkpoint_path).items())))
+    forwards = _BACKEND_REGISTRY.get(
+        key, lambda: [_FORWARD_CLASSES[backend](artifact_path(model_dir, backend, i)) for i in range(n_folds)]
+    )
+    return backend, forwards
@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+import threading
+import cv2
+import numpy as np
+
+# 分割结果缓存：key = (切片像素哈希, 模型指纹, 推理档位/后端)，value = PNG 压缩的 label mask
+SEG_CACHE_ENABLED = os.environ.get("IDOCTOR_SEG_CACHE", "1") not in ("0", "false", "False")
+SEG_CACHE_DIR = os.environ.get("IDOCTOR_SEG_CACHE_DIR", os.path.join("data", ".seg_cache"))
+# 磁盘占用上限，超出后按最近使用时间（LRU）淘汰到上限的 90%
+SEG_CACHE_MAX_MB = int(os.environ.get("IDOCTOR_SEG_CACHE_MAX_MB", "512"))
+
+_FINGERPRINTS = {}
+_FINGERPRINT_LOCK = threading.Lock()
+
+
+def slice_digest(arr):
+    """切片像素内容哈希（含尺寸与 dtype）"""
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha256()
+    h.update(f"{arr.shape}|{arr.dtype.str}|".encode())
+    h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def _hash_file(path, h, chunk=1 << 20):
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(chunk)
+            if not buf:
+                break
+            h.update(buf)
+
+
+def model_fingerprint(model_dir, checkpoint_path):
+    """checkpoint + plans.json + dataset.json 的内容哈希；按 (路径, inode, 大小, mtime_ns) 在进程内记忆，权重不变时不重复读取
+
+    用纳秒 mtime 与 inode：同一秒内原地覆盖或替换成同样大小的新权重也会重新计算指纹。
+    """
+    files = [checkpoint_path] + [os.path.join(model_dir, n) for n in ("plans.json", "dataset.json")]
+    files = [p for p in files if p and os.path.isfile(p)]
+    stat_key = []
+    for p in files:
+        st = os.stat(p)
+        stat_key.append((os.path.abspath(p), st.st_ino, st.st_size, st.st_mtime_ns))
+    stat_key = tuple(stat_key)
+    with _FINGERPRINT_LOCK:
+        if stat_key in _FINGERPRINTS:
+            return _FINGERPRINTS[stat_key]
+    h = hashlib.sha256()
+    for p in files:
+        h.update(os.path.basename(p).encode())
+        _hash_file(p, h)
+    fp = h.hexdigest()
+    with _FINGERPRINT_LOCK:
+        _FINGERPRINTS[stat_key] = fp
+    return fp
+
+
+# 预处理方式变化时递增，使旧 label 失效（2: 逐张切片预处理，此前整栈预处理的结果依赖同批其它切片）
+PREPROCESS_VERSION = 2
+
+
+def inference_variant(profile_name, settings, backend):
+    """影响分割结果的推理参数（档位参数 + 前向后端 + 预处理版本）"""
+    return json.dumps({"profile": profile_name, "settings": settings, "backend": backend,
+                       "preprocess": PREPROCESS_VERSION}, sort_keys=True)
+
+
+class SegCache:
+    """磁盘上的内容寻址 label 缓存，<root>/<key[:2]>/<key>.png
+
+    命中时刷新文件 mtime，淘汰时按 mtime 从旧到新删除；写入先写临时文件再原子替换，
+    多个进程共享同一目录时最多出现重复计算，不会读到半个文件。
+    """
+
+    def __init__(self, root=SEG_CACHE_DIR, max_bytes=SEG_CACHE_MAX_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(digest, fingerprint, variant):
+        return hashlib.sha256(f"{digest}|{fingerprint}|{variant}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.png")
+
+    def get(self, key):
+        path = self._path(key)
+        label = cv2.imread(path, cv2.IMREAD_UNCHANGED) if os.path.isfile(path) else None
+        with self._lock:
+            if label is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return label
+
+    def put(self, key, label):
+        path = self._path(key)
+        ok, buf = cv2.imencode(".png", np.ascontiguousarray(label, dtype=np.uint8))
+        if not ok:
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(buf.tobytes())
+        existed = os.path.isfile(path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            elif not existed:
+                self._size += len(buf)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+        return True
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for sub in os.listdir(self.root):
+            d = os.path.join(self.root, sub)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                if not name.endswith(".png"):
+                    continue
+                p = os.path.join(d, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target_bytes=None):
+        """按 LRU 删除到 target_bytes（默认上限的 90%），返回删除的条目数"""
+        if target_bytes is None:
+            target_bytes = int(self.max_bytes * 0.9)
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, p in entries:
+                if total <= target_bytes:
+                    break
+                try:
+                    os.remove(p)
+                    total -= size
+                    removed += 1
+                except OSError:
+                    pass
+            self._size = total
+        return removed
+
+    def stats(self):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            return {
+                "root": os.path.abspath(self.root),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_seg_cache():
+    """进程级共享的分割缓存；IDOCTOR_SEG_CACHE=0 时返回 None"""
+    global _CACHE
+    if not SEG_CACHE_ENABLED:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = SegCache()
+        return _CACHE
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+import pydicom
+from dicom_series import DICOM_EXTENSIONS, HEADER_TAGS, decode_workers, read_header, z_sort_key
+
+# 上传时的 DICOM 头信息校验：reject = 有错误项时直接拒绝上传（保留旧 input），
+# flag = 接受上传但在 series_index.json 中标记不可用（/process 会直接返回 422），off = 不建索引
+UPLOAD_VALIDATION = os.environ.get("IDOCTOR_UPLOAD_VALIDATION", "reject")
+# 主序列少于该张数时视为不可用（矢状面无法覆盖腰椎）
+UPLOAD_MIN_SLICES = int(os.environ.get("IDOCTOR_UPLOAD_MIN_SLICES", "10"))
+
+SERIES_INDEX_FILE = "series_index.json"
+SERIES_INDEX_VERSION = 1
+INDEX_TAGS = HEADER_TAGS + ["ImageType", "Modality", "SeriesDescription", "SeriesNumber"]
+
+# 相邻切片间距超过中位间距的该倍数时记为缺片
+GAP_FACTOR = 1.5
+# 切片法向与 Z 轴夹角余弦低于该值时视为非横断面
+AXIAL_MIN_COSINE = 0.9
+
+
+def is_dicom_name(name):
+    """与 dicom_series.list_dicom_files 相同的过滤规则"""
+    return not name.startswith("._") and name.lower().endswith(DICOM_EXTENSIONS)
+
+
+def read_upload_header(path):
+    """只解析 INDEX_TAGS（不读像素），在 read_header 的基础上补充定位片/模态信息"""
+    ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+    header = read_header(ds, path)
+    image_type = ds.get("ImageType")
+    header["image_type"] = [str(v).upper() for v in image_type] if image_type else []
+    header["modality"] = str(ds.get("Modality", ""))
+    header["series_description"] = str(ds.get("SeriesDescription", ""))
+    try:
+        header["series_number"] = int(ds.get("SeriesNumber"))
+    except Exception:
+        header["series_number"] = None
+    return header
+
+
+class UploadIndexer:
+    """解压时每写出一个成员就在线程池中解析它的头信息，finish() 汇总为序列索引"""
+
+    def __init__(self, folder, workers=None):
+        self.folder = folder
+        self._pool = ThreadPoolExecutor(max_workers=decode_workers(workers), thread_name_prefix="upload-index")
+        self._futures = {}
+        self.ignored = []
+
+    def add(self, name):
+        if name in self._futures:
+            # 同名成员被覆盖，重新解析
+            self._futures[name].cancel()
+        if not is_dicom_name(name):
+            self.ignored.append(name)
+            return
+        self._futures[name] = self._pool.submit(read_upload_header, os.path.join(self.folder, name))
+
+    def finish(self):
+        headers, unreadable = [], []
+        for name, fut in sorted(self._futures.items()):
+            try:
+                headers.append(fut.result())
+            except Exception as e:
+                unreadable.append({"file": name, "error": str(e)})
+        self.close()
+        return build_series_index(headers, unreadable, sorted(set(self.ignored)))
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def index_folder(folder):
+    """对已有的 input 目录建索引（旧上传没有 series_index.json 时使用）"""
+    indexer = UploadIndexer(folder)
+    for name in sorted(os.listdir(folder)):
+        indexer.add(name)
+    return indexer.finish()
+
+
+def _is_localizer(header):
+    return "LOCALIZER" in header["image_type"]
+
+
+def _is_axial(orientation):
+    if not orientation or len(orientation) < 6:
+        return None
+    r, c = orientation[:3], orientation[3:6]
+    normal_z = r[0] * c[1] - r[1] * c[0]
+    return abs(normal_z) >= AXIAL_MIN_COSINE
+
+
+def _z_gaps(zs):
+    """返回 (中位间距, 缺片列表, 重复位置数)"""
+    diffs = [b - a for a, b in zip(zs, zs[1:])]
+    steps = [d for d in diffs if d > 1e-3]
+    if not steps:
+        return None, [], len(diffs)
+    step = statistics.median(steps)
+    gaps = []
+    for i, d in enumerate(diffs):
+        if d > step * GAP_FACTOR:
+            gaps.append({"after_z": round(zs[i], 3), "before_z": round(zs[i + 1], 3),
+                         "missing": max(1, int(round(d / step)) - 1)})
+    return step, gaps, len(diffs) - len(steps)
+
+
+def _series_summary(uid, headers):
+    first = headers[0]
+    zs = sorted(h["position"][2] for h in headers if h["position"] and len(h["position"]) >= 3)
+    step, gaps, duplicates = _z_gaps(zs)
+    uids = [h["sop_instance_uid"] for h in headers if h["sop_instance_uid"]]
+    return {
+        "series_instance_uid": uid,
+        "series_number": first["series_number"],
+        "description": first["series_description"],
+        "modality": first["modality"],
+        "count": len(headers),
+        "localizer": all(_is_localizer(h) for h in headers),
+        "orientation": first["orientation"],
+        "axial": _is_axial(first["orientation"]),
+        "shapes": sorted({(h["rows"], h["columns"]) for h in headers}),
+        "pixel_spacing": first["pixel_spacing"],
+        "slice_thickness": first["slice_thickness"],
+        "z_spacing": round(step, 4) if step else None,
+        "z_range": [round(zs[0], 3), round(zs[-1], 3)] if zs else None,
+        "gaps": gaps,
+        "duplicate_positions": duplicates,
+        "duplicate_instances": len(uids) - len(set(uids)),
+    }
+
+
+def build_series_index(headers, unreadable=(), ignored=()):
+    """按 SeriesInstanceUID 分组汇总，并列出问题项 issues（severity = error / warning）
+
+    主序列与 dicom_series._select_series 的选择一致（文件数最多），但不考虑定位片。
+    """
+    issues = []
+
+    def issue(severity, code, message):
+        issues.append({"severity": severity, "code": code, "message": message})
+
+    groups = {}
+    for h in headers:
+        groups.setdefault(h["series_instance_uid"], []).append(h)
+    series = [_series_summary(uid, hs) for uid, hs in groups.items()]
+    series.sort(key=lambda s: -s["count"])
+
+    candidates = [s for s in series if not s["localizer"]]
+    selected = candidates[0] if candidates else None
+
+    if unreadable:
+        issue("warning", "unreadable_files", f"{len(unreadable)} 个文件无法解析为 DICOM")
+    if not headers:
+        issue("error", "no_dicom", "压缩包中没有可读取的 DICOM 文件")
+    elif selected is None:
+        issue("error", "localizer_only", "只有定位片（LOCALIZER），没有横断面序列")
+    else:
+        if len(candidates) > 1:
+            others = ", ".join(f"{s['description'] or s['series_instance_uid']}({s['count']})" for s in candidates[1:])
+            issue("warning", "mixed_series", f"含 {len(candidates)} 个序列，使用张数最多的序列，忽略: {others}")
+        if selected["axial"] is False:
+            issue("error", "non_axial", "主序列不是横断面（ImageOrientationPatient 法向不沿 Z 轴）")
+        elif selected["axial"] is None:
+            issue("warning", "no_orientation", "主序列缺少 ImageOrientationPatient，无法确认是否为横断面")
+        if selected["modality"] and selected["modality"] != "CT":
+            issue("warning", "not_ct", f"主序列模态为 {selected['modality']}，HU 统计仅对 CT 有意义")
+        if len(selected["shapes"]) > 1:
+            issue("error", "inconsistent_shape", f"主序列切片尺寸不一致: {selected['shapes']}")
+        if selected["count"] < UPLOAD_MIN_SLICES:
+            issue("error", "too_few_slices", f"主序列只有 {selected['count']} 张（至少需要 {UPLOAD_MIN_SLICES} 张）")
+        if selected["z_range"] is None:
+            issue("warning", "no_position", "主序列缺少 ImagePositionPatient，按 InstanceNumber 排序")
+        if selected["gaps"]:
+            missing = sum(g["missing"] for g in selected["gaps"])
+            issue("warning", "missing_slices", f"主序列约缺 {missing} 张（{len(selected['gaps'])} 处间断）")
+        if selected["duplicate_instances"]:
+            # 同一 SOPInstanceUID 出现多次（压缩包里同一张图的副本），解码后体数据会重复切片
+            issue("error", "duplicate_instances", f"主序列有 {selected['duplicate_instances']} 个重复的 SOPInstanceUID")
+        if selected["duplicate_positions"]:
+            issue("warning", "duplicate_positions", f"主序列有 {selected['duplicate_positions']} 张切片位置重复")
+
+    slices = []
+    if selected is not None:
+        sel = sorted(groups[selected["series_instance_uid"]], key=z_sort_key)
+        slices = [{"file": h["file"], "instance_number": h["instance_number"],
+                   "z": h["position"][2] if h["position"] and len(h["position"]) >= 3 else None} for h in sel]
+
+    for s in series:
+        s["shapes"] = [list(shape) for shape in s["shapes"]]
+    return {
+        "version": SERIES_INDEX_VERSION,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "usable": not any(i["severity"] == "error" for i in issues),
+        "issues": issues,
+        "count": len(headers),
+        "unreadable": list(unreadable),
+        "ignored": list(ignored),
+        "selected_series": selected["series_instance_uid"] if selected else None,
+        "spacing": ([selected["pixel_spacing"][1], selected["pixel_spacing"][0], selected["z_spacing"]]
+                    if selected else None),
+        "series": series,
+        "slices": slices,
+    }
+
+
+def summarize_issues(index, severity="error"):
+    return "；".join(i["message"] for i in index["issues"] if i["severity"] == severity)
+
+
+def series_index_path(patient_root):
+    """索引放在 input/ 旁边：data/<病例>/series_index.json"""
+    return os.path.join(patient_root, SERIES_INDEX_FILE)
+
+
+def write_series_index(patient_root, index):
+    path = series_index_path(patient_root)
+    tmp_path = path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_series_index(patient_root):
+    path = series_index_path(patient_root)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def remove_series_index(patient_root):
+    try:
+        os.remove(series_index_path(patient_root))
+    except OSError:
+        pass
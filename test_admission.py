@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""准入控制（admission.AdmissionController）与队列领取的配合测试
+
+运行: python -m pytest test_admission.py -q
+"""
+import pytest
+
+import admission
+from admission import AdmissionController, estimate_cost
+from job_queue import SqliteJobQueue, job_status
+
+
+@pytest.fixture(autouse=True)
+def _no_psutil(monkeypatch):
+    # 只测试预算记账，不受本机实际可用内存影响
+    monkeypatch.setattr(admission, "psutil", None)
+
+
+def test_estimate_scales_with_volume():
+    small = estimate_cost("main", 100, 512, 512)
+    large = estimate_cost("main", 1000, 512, 512)
+    assert large["mem_mb"] > small["mem_mb"] and large["cpus"] > small["cpus"]
+    assert estimate_cost("continue_after_l3", 1000, 512, 512)["mem_mb"] < large["mem_mb"]
+
+
+def test_budget_blocks_head_job_and_reports_position(tmp_path):
+    queue = SqliteJobQueue(str(tmp_path / "jobs.sqlite"))
+    controller = AdmissionController(mem_budget_mb=3000, cpu_budget=8)
+    cost = {"mem_mb": 2000, "cpus": 2}
+    for name in ("a", "b", "c"):
+        queue.enqueue(f"main_{name}_1", "main", {}, cost=cost)
+    queue.enqueue("main_small_1", "main", {}, cost={"mem_mb": 100, "cpus": 1})
+
+    first = queue.claim("w1", admission=controller)
+    assert first["task_id"] == "main_a_1"
+    # 队首放不下时不越过它领取后面的小任务
+    assert queue.claim("w2", admission=controller) is None
+    assert controller.blocked[0] == queue.latest("main_b_1")["id"]
+
+    queue.annotate(*controller.blocked)
+    job = queue.latest("main_c_1")
+    status = job_status(job, queue.position(job))
+    assert status["status"] == "queued" and status["position"] == 2
+    assert job_status(queue.latest("main_b_1"), 1)["message"].startswith("排队中（第 1 位），等待内存")
+
+    controller.release(first["id"])
+    assert queue.claim("w2", admission=controller)["task_id"] == "main_b_1"
+
+
+def test_oversized_job_runs_when_idle():
+    controller = AdmissionController(mem_budget_mb=1000, cpu_budget=2)
+    assert controller.try_admit({"id": 1, "kind": "main", "cost": {"mem_mb": 5000, "cpus": 4}})
+    assert not controller.try_admit({"id": 2, "kind": "main", "cost": {"mem_mb": 10, "cpus": 1}})
+    controller.release(1)
+    assert controller.snapshot()["running"] == 0
+
+
+def test_interactive_lane_has_separate_small_budget():
+    lane = admission.get_interactive_admission_controller()
+    assert lane is admission.get_interactive_admission_controller()
+    assert lane is not admission.get_admission_controller()
+    assert (lane.mem_budget_mb, lane.cpu_budget) == (admission.INTERACTIVE_MEM_BUDGET_MB,
+                                                     admission.INTERACTIVE_CPU_BUDGET)
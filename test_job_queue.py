@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""持久化任务队列（job_queue.SqliteJobQueue）测试
+
+运行: python -m pytest test_job_queue.py -q
+"""
+import time
+
+import pytest
+
+import job_queue
+from job_queue import SqliteJobQueue, job_status
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SqliteJobQueue(str(tmp_path / "jobs.sqlite"), lease_seconds=30, max_attempts=2)
+
+
+def _expire(queue, job_id):
+    with queue._connect() as conn:
+        conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() - 1, job_id))
+
+
+def test_enqueue_deduplicates_active_task(queue):
+    job, created = queue.enqueue("main_a_1", "main", {"profile": "fast"})
+    assert created and job["state"] == "queued"
+    again, created = queue.enqueue("main_a_1", "main", {"profile": "fast"})
+    assert not created and again["id"] == job["id"]
+    other, created = queue.enqueue("main_b_1", "main", {})
+    assert created and other["id"] != job["id"]
+
+
+def test_claim_heartbeat_complete(queue):
+    queue.enqueue("main_a_1", "main", {"profile": "fast"})
+    job = queue.claim("w1")
+    assert job["state"] == "running" and job["attempts"] == 1
+    assert queue.claim("w2") is None
+
+    assert queue.heartbeat(job["id"], "w1", progress=42, stage="psoas_seg", extra={"inference_progress": {"x": 1}})
+    assert not queue.heartbeat(job["id"], "w2", progress=1)
+    status = job_status(queue.latest("main_a_1"))
+    assert status["status"] == "processing" and status["progress"] == 42 and status["stage"] == "psoas_seg"
+    assert status["inference_progress"] == {"x": 1}
+
+    assert queue.complete(job["id"], "w1", {"output_dir": "out"}, message="全流程处理完成")
+    status = job_status(queue.latest("main_a_1"))
+    assert status["status"] == "completed" and status["output_dir"] == "out" and status["profile"] == "fast"
+    # 完成后可以重新提交
+    _, created = queue.enqueue("main_a_1", "main", {})
+    assert created
+
+
+def test_expired_lease_is_requeued_then_failed(queue):
+    queue.enqueue("cont_a_1", "continue_after_l3", {})
+    job = queue.claim("w1")
+    _expire(queue, job["id"])
+
+    retry = queue.claim("w2")
+    assert retry["id"] == job["id"] and retry["attempts"] == 2 and retry["worker"] == "w2"
+    # 原 worker 的结果不再写回
+    assert not queue.complete(job["id"], "w1", {})
+
+    _expire(queue, job["id"])
+    assert queue.claim("w3") is None
+    status = job_status(queue.latest("cont_a_1"))
+    assert status["status"] == "failed" and "租约" in status["error"]
+
+
+def test_claim_filters_kinds_and_orders_fifo(queue):
+    queue.enqueue("cont_a_1", "continue_after_l3", {})
+    queue.enqueue("main_a_1", "main", {})
+    queue.enqueue("main_b_1", "main", {})
+    assert queue.claim("w1", kinds=["main"])["task_id"] == "main_a_1"
+    assert queue.claim("w1")["task_id"] == "cont_a_1"
+    assert queue.counts() == {"queued": 1, "running": 2}
+
+
+def test_unknown_task(queue):
+    assert job_status(queue.latest("nope"))["status"] == "not_found"
+
+
+def test_priority_classes(queue):
+    queue.enqueue("main_a_1", "main", {}, priority="batch")
+    queue.enqueue("main_b_1", "main", {})
+    queue.enqueue("l3_c_1", "l3_detect", {})
+    assert [queue.claim("w")["task_id"] for _ in range(3)] == ["l3_c_1", "main_b_1", "main_a_1"]
+
+
+def test_fair_share_between_users(queue, monkeypatch):
+    monkeypatch.setitem(job_queue.PLAN_WEIGHTS, "专业版", 2.0)
+    for i in range(6):
+        queue.enqueue(f"main_bulk_{i}", "main", {}, user_id="bulk", priority="batch")
+    queue.claim("w")
+    # 后提交的用户不排在积压任务之后；权重 2 的用户领取次数是权重 1 的两倍
+    for i in range(4):
+        queue.enqueue(f"main_pro_{i}", "main", {}, user_id="pro", priority="batch", plan="专业版")
+    job = queue.latest("main_pro_0")
+    assert queue.position(job) == 2
+    order = [queue.claim("w")["user_id"] for _ in range(6)]
+    assert order == ["bulk", "pro", "pro", "bulk", "pro", "pro"]
+
+
+def test_events_follow_job_lifecycle(queue):
+    queue.enqueue("main_a_1", "main", {}, user_id="u1")
+    queue.enqueue("main_b_1", "main", {}, user_id="u2")
+    job = queue.claim("w1")
+    assert queue.heartbeat(job["id"], "w1")
+    assert queue.heartbeat(job["id"], "w1", progress=50, stage="psoas_seg")
+    queue.complete(job["id"], "w1", {"output_dir": "out"})
+
+    events = queue.events(task_id="main_a_1")
+    # 只续约不写事件
+    assert [e["event"] for e in events] == ["queued", "started", "progress", "completed"]
+    assert events[2]["data"]["progress"] == 50 and events[-1]["data"]["output_dir"] == "out"
+    # 按 Last-Event-ID 续传
+    assert [e["event"] for e in queue.events(events[1]["id"], task_id="main_a_1")] == ["progress", "completed"]
+    assert [e["task_id"] for e in queue.events(user_id="u2")] == ["main_b_1"]
+    assert queue.last_event_id() == max(e["id"] for e in queue.events())
+
+
+def test_live_workers_by_kind(queue):
+    assert queue.live_workers("l3_detect") == 0
+    queue.worker_seen("main-0", ["main", "continue_after_l3"])
+    assert queue.live_workers("l3_detect") == 0 and queue.live_workers("main") == 1
+    queue.worker_seen("interactive-0", ["l3_detect"])
+    assert queue.live_workers("l3_detect") == 1
+    with queue._connect() as conn:
+        conn.execute("UPDATE workers SET seen_at = ?", (time.time() - 31,))
+    assert queue.live_workers() == 0
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""阶段图增量执行（pipeline_graph.StageRunner）测试
+
+运行: python -m pytest test_pipeline_graph.py -q
+"""
+import os
+
+import pytest
+
+from pipeline_graph import Stage, PipelineGraph, StageRunner, PipelineAborted, read_stages
+
+
+class Ctx:
+    def __init__(self, root):
+        self.root = root
+        self.param = 1
+        self.calls = []
+
+
+def _write(ctx, name, text):
+    path = os.path.join(ctx.root, name)
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def _graph():
+    def run_a(ctx):
+        ctx.calls.append("a")
+        _write(ctx, "a.txt", f"a{ctx.param}")
+        return ctx.param
+
+    def run_b(ctx):
+        ctx.calls.append("b")
+        _write(ctx, "b.txt", f"b{ctx.runner.value('a')}")
+
+    def run_c(ctx):
+        ctx.calls.append("c")
+        return ctx.runner.deps_changed("c")
+
+    return PipelineGraph([
+        Stage("a", run=run_a, params=lambda ctx: {"p": ctx.param},
+              outputs=lambda ctx, v: [os.path.join(ctx.root, "a.txt")],
+              restore=lambda ctx: int(open(os.path.join(ctx.root, "a.txt")).read()[1:])),
+        Stage("b", deps=["a"], run=run_b, outputs=lambda ctx, v: [os.path.join(ctx.root, "b.txt")]),
+        Stage("c", deps=["b"], run=run_c),
+    ])
+
+
+def _run(tmp_path, ctx=None, **kwargs):
+    ctx = ctx or Ctx(str(tmp_path))
+    runner = StageRunner(_graph(), str(tmp_path), ctx, **kwargs)
+    runner.run(["c"])
+    return ctx, runner
+
+
+def test_second_run_skips_everything(tmp_path):
+    ctx, runner = _run(tmp_path)
+    assert ctx.calls == ["a", "b", "c"]
+    assert set(read_stages(str(tmp_path))) == {"a", "b", "c"}
+    ctx, runner = _run(tmp_path)
+    assert ctx.calls == []
+    assert runner.skipped == {"a", "b", "c"}
+
+
+def test_param_change_reruns_downstream(tmp_path):
+    _run(tmp_path)
+    ctx = Ctx(str(tmp_path))
+    ctx.param = 2
+    ctx, _ = _run(tmp_path, ctx)
+    assert ctx.calls == ["a", "b", "c"]
+    assert open(tmp_path / "b.txt").read() == "b2"
+
+
+def test_edited_output_reruns_stage(tmp_path):
+    _run(tmp_path)
+    (tmp_path / "b.txt").write_text("manual")
+    ctx, runner = _run(tmp_path)
+    # a 的结果从产物恢复，不重新执行；b 重算后产物与记录一致，c 不受影响
+    assert ctx.calls == ["b"]
+    assert runner.skipped == {"a", "c"}
+    assert open(tmp_path / "b.txt").read() == "b1"
+
+
+def test_frozen_stage_keeps_manual_output(tmp_path):
+    _run(tmp_path)
+    (tmp_path / "b.txt").write_text("manual")
+    ctx, runner = _run(tmp_path, frozen=("a", "b"))
+    assert ctx.calls == ["c"]
+    assert runner.value("c") is True
+    assert open(tmp_path / "b.txt").read() == "manual"
+
+
+def test_force_reruns(tmp_path):
+    _run(tmp_path)
+    ctx, _ = _run(tmp_path, force=True)
+    assert ctx.calls == ["a", "b", "c"]
+
+
+def test_aborting_callback_stops_pipeline(tmp_path):
+    def on_stage(name, state):
+        if name == "b" and state == "run":
+            raise PipelineAborted("lease lost")
+
+    ctx = Ctx(str(tmp_path))
+    with pytest.raises(PipelineAborted):
+        _run(tmp_path, ctx, on_stage=on_stage)
+    assert ctx.calls == ["a"]
+    assert set(read_stages(str(tmp_path))) == {"a"}
+
+
+def test_other_callback_errors_are_logged(tmp_path):
+    def on_stage(name, state):
+        raise ValueError("db down")
+
+    ctx, _ = _run(tmp_path, on_stage=on_stage)
+    assert ctx.calls == ["a", "b", "c"]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""ONNX / TorchScript 后端与 PyTorch 滑窗推理的一致性测试
+
+用随机初始化的小型 PlainConvUNet 代替真实权重，不依赖 nnUNet_results。
+运行: python -m pytest test_seg_backends.py -q
+"""
+import types
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("nnunetv2")
+dna = pytest.importorskip("dynamic_network_architectures.architectures.unet")
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunet_batch import predict_logits_batched
+from seg_backends import export_network, TorchScriptForward
+
+PATCH_SIZE = [32, 32]
+
+
+def _tiny_network():
+    torch.manual_seed(0)
+    net = dna.PlainConvUNet(
+        input_channels=1, n_stages=3, features_per_stage=(4, 8, 16),
+        conv_op=torch.nn.Conv2d, kernel_sizes=3, strides=(1, 2, 2),
+        n_conv_per_stage=(1, 1, 1), num_classes=2, n_conv_per_stage_decoder=(1, 1),
+        conv_bias=True, norm_op=torch.nn.InstanceNorm2d, norm_op_kwargs={"eps": 1e-5, "affine": True},
+        nonlin=torch.nn.LeakyReLU, nonlin_kwargs={"inplace": True}, deep_supervision=False,
+    )
+    return net.eval()
+
+
+def _fake_predictor(network, use_mirroring=True):
+    """只提供 predict_logits_batched 用到的属性"""
+    p = types.SimpleNamespace(
+        network=network,
+        device=torch.device("cpu"),
+        use_mirroring=use_mirroring,
+        use_gaussian=True,
+        tile_step_size=0.5,
+        verbose=False,
+        allowed_mirroring_axes=(0, 1),
+        list_of_parameters=[network.state_dict()],
+        configuration_manager=types.SimpleNamespace(patch_size=PATCH_SIZE),
+        label_manager=types.SimpleNamespace(num_segmentation_heads=2),
+        dataset_json={"channel_names": {"0": "CT"}},
+    )
+    p._internal_get_sliding_window_slicers = types.MethodType(
+        nnUNetPredictor._internal_get_sliding_window_slicers, p)
+    return p
+
+
+def _stack():
+    torch.manual_seed(1)
+    # 3 张切片，空间尺寸不是 patch 的整数倍，覆盖滑窗重叠与 padding
+    return torch.randn(1, 3, 45, 40)
+
+
+def test_batched_matches_single_tile_batches():
+    predictor = _fake_predictor(_tiny_network())
+    data = _stack()
+    ref = predict_logits_batched(predictor, data, batch_size=1)
+    out = predict_logits_batched(predictor, data, batch_size=8)
+    assert out.shape == (2, 3, 45, 40)
+    assert torch.allclose(ref, out, atol=1e-5)
+
+
+def _real_predictor(network):
+    """真正的 nnUNetPredictor（不经 initialize_from_trained_model_folder，直接挂上网络与最小配置）"""
+    p = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
+                        perform_everything_on_device=False, device=torch.device("cpu"),
+                        verbose=False, verbose_preprocessing=False, allow_tqdm=False)
+    p.network = network
+    p.list_of_parameters = [network.state_dict()]
+    p.allowed_mirroring_axes = (0, 1)
+    p.configuration_manager = types.SimpleNamespace(patch_size=PATCH_SIZE)
+    p.label_manager = types.SimpleNamespace(num_segmentation_heads=2)
+    p.dataset_json = {"channel_names": {"0": "CT"}}
+    return p
+
+
+@pytest.mark.parametrize("use_mirroring", [True, False])
+def test_batched_matches_nnunet_sliding_window(use_mirroring):
+    predictor = _real_predictor(_tiny_network())
+    predictor.use_mirroring = use_mirroring
+    data = _stack()
+    ref = predictor.predict_sliding_window_return_logits(data)
+    ref = torch.as_tensor(ref).float().cpu()
+    out = predict_logits_batched(predictor, data, batch_size=4)
+    assert out.shape == ref.shape == (2, 3, 45, 40)
+    assert torch.allclose(ref, out, atol=1e-4)
+    assert torch.equal(ref.argmax(0), out.argmax(0))
+
+
+def test_onnx_backend_parity(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from seg_backends import OnnxForward
+
+    network = _tiny_network()
+    predictor = _fake_predictor(network)
+    data = _stack()
+    ref = predict_logits_batched(predictor, data, batch_size=4)
+
+    path = export_network(network, PATCH_SIZE, 1, str(tmp_path / "fold_0.onnx"), fmt="onnx")
+    out = predict_logits_batched(predictor, data, batch_size=4, forward=[OnnxForward(path)])
+    assert torch.allclose(ref, out, atol=1e-4)
+    assert torch.equal(ref.argmax(0), out.argmax(0))
+
+
+def test_torchscript_backend_parity(tmp_path):
+    network = _tiny_network()
+    predictor = _fake_predictor(network)
+    data = _stack()
+    ref = predict_logits_batched(predictor, data, batch_size=4)
+
+    path = export_network(network, PATCH_SIZE, 1, str(tmp_path / "fold_0.pt"), fmt="torchscript")
+    out = predict_logits_batched(predictor, data, batch_size=4, forward=TorchScriptForward(path))
+    assert torch.allclose(ref, out, atol=1e-4)
+    assert torch.equal(ref.argmax(0), out.argmax(0))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""切片栈推理（seg.predict_slice_stack_multi）的逐张等价性与缓存测试
+
+用随机初始化的小型 PlainConvUNet + 最小 plans（ZScore 归一化、crop_to_nonzero），不依赖 nnUNet_results。
+运行: python -m pytest test_seg_stack.py -q
+"""
+import types
+from contextlib import contextmanager
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("nnunetv2")
+pytest.importorskip("dynamic_network_architectures.architectures.unet")
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+import seg
+from seg_cache import SegCache
+from inference_profiles import resolve_profile
+from test_seg_backends import _tiny_network, PATCH_SIZE
+
+MODELS = {"m": ("tiny_model", "checkpoint_final.pth")}
+
+_RESAMPLE_KWARGS = {"is_seg": False, "order": 3, "order_z": 0, "force_separate_z": None}
+PLANS = {
+    "dataset_name": "Dataset999_Tiny",
+    "plans_name": "nnUNetPlans",
+    "original_median_spacing_after_transp": [999.0, 1.0, 1.0],
+    "original_median_shape_after_transp": [1, 48, 48],
+    "image_reader_writer": "NaturalImage2DIO",
+    "transpose_forward": [0, 1, 2],
+    "transpose_backward": [0, 1, 2],
+    "experiment_planner_used": "ExperimentPlanner",
+    "label_manager": "LabelManager",
+    "foreground_intensity_properties_per_channel": {
+        "0": {"max": 255.0, "mean": 100.0, "median": 100.0, "min": 0.0,
+              "percentile_00_5": 0.0, "percentile_99_5": 255.0, "std": 50.0},
+    },
+    "configurations": {
+        "2d": {
+            "data_identifier": "nnUNetPlans_2d",
+            "preprocessor_name": "DefaultPreprocessor",
+            "batch_size": 2,
+            "patch_size": PATCH_SIZE,
+            "median_image_size_in_voxels": [48, 48],
+            "spacing": [1.0, 1.0],
+            "normalization_schemes": ["ZScoreNormalization"],
+            "use_mask_for_norm": [False],
+            "resampling_fn_data": "resample_data_or_seg_to_shape",
+            "resampling_fn_seg": "resample_data_or_seg_to_shape",
+            "resampling_fn_data_kwargs": _RESAMPLE_KWARGS,
+            "resampling_fn_seg_kwargs": dict(_RESAMPLE_KWARGS, is_seg=True, order=1),
+            "resampling_fn_probabilities": "resample_data_or_seg_to_shape",
+            "resampling_fn_probabilities_kwargs": dict(_RESAMPLE_KWARGS, order=1),
+            "batch_dice": True,
+            "architecture": {
+                "network_class_name": "dynamic_network_architectures.architectures.unet.PlainConvUNet",
+                "arch_kwargs": {}, "_kw_requires_import": [],
+            },
+        },
+    },
+}
+DATASET_JSON = {"channel_names": {"0": "CT"}, "labels": {"background": 0, "muscle": 1},
+                "numTraining": 1, "file_ending": ".png"}
+
+
+def _predictor():
+    network = _tiny_network()
+    plans_manager = PlansManager(PLANS)
+    p = types.SimpleNamespace(
+        network=network,
+        device=torch.device("cpu"),
+        use_mirroring=True,
+        use_gaussian=True,
+        tile_step_size=0.5,
+        verbose=False,
+        allowed_mirroring_axes=(0, 1),
+        list_of_parameters=[network.state_dict()],
+        plans_manager=plans_manager,
+        configuration_manager=plans_manager.get_configuration("2d"),
+        label_manager=plans_manager.get_label_manager(DATASET_JSON),
+        dataset_json=DATASET_JSON,
+    )
+    p._internal_get_sliding_window_slicers = types.MethodType(
+        nnUNetPredictor._internal_get_sliding_window_slicers, p)
+    return p
+
+
+@pytest.fixture
+def tiny_model(monkeypatch):
+    predictor = _predictor()
+
+    @contextmanager
+    def fake_predictor(model_dir, checkpoint="checkpoint_final.pth", use_folds="auto"):
+        yield predictor
+
+    monkeypatch.setattr(seg, "nnunet_predictor", fake_predictor)
+    monkeypatch.setattr(seg, "resolve_checkpoint", lambda model_dir, checkpoint="": (None, checkpoint))
+    monkeypatch.setattr(seg, "load_backend_forwards", lambda *a, **k: ("torch", None))
+    return predictor
+
+
+def _slices():
+    rng = np.random.RandomState(0)
+    a = np.zeros((48, 40), np.uint8)
+    a[6:40, 4:36] = rng.randint(60, 140, size=(34, 32))
+    # 亮度分布、非零区域与尺寸都不同的另一张切片
+    b = np.zeros((48, 40), np.uint8)
+    b[2:46, 10:38] = rng.randint(150, 255, size=(44, 28))
+    c = rng.randint(0, 255, size=(45, 52)).astype(np.uint8)
+    return a, b, c
+
+
+def _fresh(slices):
+    profile_name, settings = resolve_profile(None)
+    return seg._predict_stack(list(slices), MODELS, None, profile_name, settings)[0]["m"]
+
+
+def test_label_does_not_depend_on_batch(tiny_model):
+    a, b, c = _slices()
+    together = _fresh([a, b, c])
+    for i, sl in enumerate((a, b, c)):
+        alone = _fresh([sl])[0]
+        assert alone.shape == sl.shape
+        assert np.array_equal(together[i], alone)
+
+
+def test_cached_label_matches_single_slice(tiny_model, tmp_path, monkeypatch):
+    cache = SegCache(str(tmp_path))
+    monkeypatch.setattr(seg, "get_seg_cache", lambda: cache)
+    monkeypatch.setattr(seg, "model_fingerprint", lambda model_dir, checkpoint_path: "tiny")
+    monkeypatch.setattr(seg, "resolve_backend", lambda *a, **k: "torch")
+    a, b, c = _slices()
+
+    fresh = _fresh([a])[0]
+
+    # 先在一个混合批次里推理并写入缓存，再单独请求 a：应全部命中，且与单张新推理一致
+    seg.predict_slice_stack_multi([b, a, c], MODELS)
+    monkeypatch.setattr(seg, "_predict_stack", lambda *args, **kw: pytest.fail("缓存未命中"))
+    backends = {}
+    cached = seg.predict_slice_stack_multi([a], MODELS, backends=backends)["m"][0]
+    assert backends == {"m": "torch"}
+    assert np.array_equal(cached, fresh)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""上传时的 DICOM 头信息索引与校验（series_index.UploadIndexer / build_series_index）测试
+
+用 pydicom 现场生成只有头信息的小 DICOM 文件，不需要真实数据。
+运行: python -m pytest test_series_index.py -q
+"""
+import pytest
+
+pytest.importorskip("numpy")
+pydicom = pytest.importorskip("pydicom")
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from series_index import UploadIndexer
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def _write(folder, name, series_uid, instance, z=None, sop_uid=None, description=""):
+    sop_uid = sop_uid or generate_uid()
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_uid
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = sop_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesDescription = description
+    ds.Modality = "CT"
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+    ds.InstanceNumber = instance
+    if z is not None:
+        ds.ImagePositionPatient = [0.0, 0.0, float(z)]
+    ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    ds.PixelSpacing = [0.8, 0.8]
+    ds.SliceThickness = 1.0
+    ds.Rows = 8
+    ds.Columns = 8
+    try:
+        ds.save_as(str(folder / name), enforce_file_format=True)
+    except TypeError:  # pydicom < 3
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.save_as(str(folder / name), write_like_original=False)
+    return sop_uid
+
+
+def _index(folder):
+    indexer = UploadIndexer(str(folder), workers=1)
+    for path in sorted(folder.iterdir()):
+        indexer.add(path.name)
+    return indexer.finish()
+
+
+def _codes(index, severity=None):
+    return {i["code"] for i in index["issues"] if severity is None or i["severity"] == severity}
+
+
+def _series(folder, count, prefix="IM", positions=True, description=""):
+    uid = generate_uid()
+    for i in range(count):
+        _write(folder, f"{prefix}{i:04d}.dcm", uid, i + 1, z=i * 1.0 if positions else None,
+               description=description)
+    return uid
+
+
+def test_clean_series_is_usable(tmp_path):
+    uid = _series(tmp_path, 12)
+    index = _index(tmp_path)
+    assert index["usable"] and index["issues"] == []
+    assert index["selected_series"] == uid
+    assert [s["z"] for s in index["slices"]] == [float(i) for i in range(12)]
+
+
+def test_mixed_series_uses_largest_and_warns(tmp_path):
+    main = _series(tmp_path, 12, prefix="AX", description="axial")
+    _series(tmp_path, 4, prefix="RE", description="recon")
+    index = _index(tmp_path)
+    assert index["selected_series"] == main
+    assert "mixed_series" in _codes(index, "warning")
+    assert len(index["slices"]) == 12 and all(s["file"].startswith("AX") for s in index["slices"])
+
+
+def test_mixed_series_rejected_when_main_series_too_small(tmp_path):
+    # 两个序列各 6 张：主序列张数不足，整个上传不可用
+    _series(tmp_path, 6, prefix="A")
+    _series(tmp_path, 6, prefix="B")
+    index = _index(tmp_path)
+    assert not index["usable"]
+    assert {"mixed_series", "too_few_slices"} <= _codes(index)
+
+
+def test_missing_position_falls_back_to_instance_number(tmp_path):
+    _series(tmp_path, 12, positions=False)
+    index = _index(tmp_path)
+    assert index["usable"]
+    assert "no_position" in _codes(index, "warning")
+    assert [s["instance_number"] for s in index["slices"]] == list(range(1, 13))
+
+
+def test_duplicate_instance_rejected(tmp_path):
+    uid = _series(tmp_path, 12)
+    # 同一张图以另一个文件名再出现一次
+    first = pydicom.dcmread(str(tmp_path / "IM0000.dcm"))
+    _write(tmp_path, "copy_IM0000.dcm", uid, 1, z=0.0, sop_uid=first.SOPInstanceUID)
+    index = _index(tmp_path)
+    assert not index["usable"]
+    assert "duplicate_instances" in _codes(index, "error")
+    assert index["series"][0]["duplicate_instances"] == 1
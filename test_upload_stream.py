@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""上传请求体的增量解析（upload_stream.MultipartStream / upload_events）测试
+
+运行: python -m pytest test_upload_stream.py -q
+"""
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("python_multipart")
+
+from upload_stream import MultipartStream, upload_events
+
+BOUNDARY = "----idoctor-test"
+PAYLOAD = os.urandom(300000)
+
+
+def _body():
+    def part(name, value, filename=None):
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        head = f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n"
+        if filename:
+            head += "Content-Type: application/zip\r\n"
+        return head.encode() + b"\r\n" + value + b"\r\n"
+
+    # 与前端 FormData 顺序一致：file_size 在 file 之后
+    return (part("patient_name", "张三".encode()) + part("study_date", b"20250101")
+            + part("file", PAYLOAD, "case.zip") + part("file_size", str(len(PAYLOAD)).encode())
+            + f"--{BOUNDARY}--\r\n".encode())
+
+
+class _Request:
+    def __init__(self, body, content_type, chunk=8191):
+        self.headers = {"content-type": content_type}
+        self._body = body
+        self._chunk = chunk
+
+    async def stream(self):
+        for i in range(0, len(self._body), self._chunk):
+            yield self._body[i:i + self._chunk]
+        yield b""
+
+
+def _collect(request):
+    async def run():
+        return [event async for event in upload_events(request)]
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 8191, 1 << 20])
+def test_multipart_events_in_order(chunk):
+    events = _collect(_Request(_body(), f"multipart/form-data; boundary={BOUNDARY}", chunk))
+    kinds = [(k, n) for k, n, _ in events if k != "file"]
+    assert kinds == [("field", "patient_name"), ("field", "study_date"), ("file_start", "file"),
+                     ("file_end", "file"), ("field", "file_size")]
+    fields = {n: v for k, n, v in events if k == "field"}
+    assert fields == {"patient_name": "张三", "study_date": "20250101", "file_size": str(len(PAYLOAD))}
+    assert [v for k, n, v in events if k == "file_start"] == ["case.zip"]
+    assert b"".join(v for k, n, v in events if k == "file") == PAYLOAD
+
+
+def test_file_data_is_emitted_before_body_ends():
+    stream = MultipartStream(f"multipart/form-data; boundary={BOUNDARY}")
+    body = _body()
+    head = body.index(PAYLOAD[:64]) + 100000
+    events = stream.feed(body[:head])
+    assert sum(len(v) for k, _, v in events if k == "file") > 90000
+
+
+def test_raw_zip_body():
+    events = _collect(_Request(PAYLOAD, "application/zip"))
+    assert events[0] == ("file_start", "file", None) and events[-1] == ("file_end", "file", None)
+    assert b"".join(v for k, _, v in events if k == "file") == PAYLOAD
+
+
+def test_truncated_multipart_rejected():
+    with pytest.raises(ValueError):
+        _collect(_Request(_body()[:-200], f"multipart/form-data; boundary={BOUNDARY}"))
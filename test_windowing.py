@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""查表加窗与原逐像素 float32 计算的一致性测试
+
+运行: python -m pytest test_windowing.py -q
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from windowing import HU_WINDOW, _window_float, apply_window, apply_window_stack, window_lut
+
+
+def _reference(pixels, slope=1.0, intercept=0.0, zero_to=None):
+    """原 extract_slice.dicom_to_uint8 / sagit_save.dicom_to_balanced_png 的实现"""
+    hu = pixels.astype(np.float32) * slope + intercept
+    hu_clipped = np.clip(hu, -100, 200)
+    out = np.clip(((hu_clipped + 100) / 300) * 255.0, 0, 255).astype(np.uint8)
+    if zero_to is not None:
+        out[out == 0] = zero_to
+    return out
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint16])
+@pytest.mark.parametrize("slope,intercept", [(1.0, 0.0), (1.0, -1024.0), (0.5, -100.0), (1.0, -100.0)])
+def test_lut_matches_float_path_for_every_value(dtype, slope, intercept):
+    values = np.arange(65536, dtype=np.uint16).view(dtype)
+    expected = _reference(values, slope, intercept)
+    np.testing.assert_array_equal(apply_window(values, slope, intercept), expected)
+
+
+def test_zero_to_matches_sagittal_balancing():
+    rng = np.random.default_rng(0)
+    img = rng.integers(-1024, 3000, size=(64, 48), dtype=np.int16)
+    expected = _reference(img, 1.0, -100.0, zero_to=255)
+    np.testing.assert_array_equal(apply_window(img, 1.0, -100.0, zero_to=255), expected)
+
+
+def test_float_hu_falls_back_to_float_path():
+    hu = np.linspace(-300, 400, 1000, dtype=np.float32).reshape(20, 50)
+    np.testing.assert_array_equal(apply_window(hu), _reference(hu))
+
+
+def test_stack_writes_one_buffer():
+    rng = np.random.default_rng(1)
+    slices = [rng.integers(-500, 500, size=(16, 16), dtype=np.int16) for _ in range(3)]
+    stack = apply_window_stack(slices)
+    assert stack.shape == (3, 16, 16) and stack.dtype == np.uint8
+    for s, out in zip(slices, stack):
+        np.testing.assert_array_equal(out, _reference(s))
+
+
+def test_lut_is_cached_and_read_only():
+    lut = window_lut(np.int16, 1.0, 0.0, HU_WINDOW)
+    assert lut is window_lut(np.int16, 1.0, 0.0, HU_WINDOW)
+    assert lut.shape == (65536,) and not lut.flags.writeable
+    np.testing.assert_array_equal(lut, _window_float(np.arange(65536, dtype=np.uint16).view(np.int16),
+                                                     1.0, 0.0, HU_WINDOW, None))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""边接收边解压（zip_stream.StreamingZipExtractor）与 zipfile 解压结果的一致性测试
+
+运行: python -m pytest test_zip_stream.py -q
+"""
+import io
+import os
+import zipfile
+
+import pytest
+
+from zip_stream import StreamingZipExtractor
+
+FILES = {f"study/series/IM{i:04d}.dcm": os.urandom(2000 * i) + b"\0" * 5000 for i in range(6)}
+
+
+class _Unseekable(io.RawIOBase):
+    """模拟不可 seek 的输出：zipfile 会为每个成员写数据描述符"""
+
+    def __init__(self):
+        self.buf = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buf.write(data)
+
+
+def _build(compression, seekable=True, prefix=b""):
+    f = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(f, "w", compression) as zf:
+        for name, data in FILES.items():
+            zf.writestr(name, data)
+    return prefix + (f if seekable else f.buf).getvalue()
+
+
+def _extract(tmp_path, data, chunk_size):
+    out = tmp_path / "input"
+    out.mkdir()
+    ex = StreamingZipExtractor(str(out), str(tmp_path / "upload.zip.part"))
+    try:
+        for i in range(0, len(data), chunk_size):
+            ex.feed(data[i:i + chunk_size])
+        members = ex.finish()
+    finally:
+        ex.close()
+    assert not (tmp_path / "upload.zip.part").exists()
+    return ex.mode, members, out
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4096, 1 << 20])
+@pytest.mark.parametrize("compression,seekable,prefix,mode", [
+    (zipfile.ZIP_STORED, True, b"", "stream"),
+    (zipfile.ZIP_DEFLATED, True, b"", "stream"),
+    (zipfile.ZIP_DEFLATED, False, b"", "stream"),
+    (zipfile.ZIP_STORED, False, b"", "fallback"),   # stored + 数据描述符无法确定长度
+    (zipfile.ZIP_DEFLATED, True, b"junk", "fallback"),
+])
+def test_matches_zipfile(tmp_path, compression, seekable, prefix, mode, chunk_size):
+    actual_mode, members, out = _extract(tmp_path, _build(compression, seekable, prefix), chunk_size)
+    assert actual_mode == mode
+    assert sorted(members) == sorted(os.path.basename(n) for n in FILES)
+    for name, data in FILES.items():
+        assert (out / os.path.basename(name)).read_bytes() == data
+
+
+def test_truncated_archive_raises(tmp_path):
+    data = _build(zipfile.ZIP_DEFLATED)
+    with pytest.raises(RuntimeError):
+        _extract(tmp_path, data[:len(data) // 2], 4096)
+
+
+def test_crc_mismatch_raises(tmp_path):
+    data = bytearray(_build(zipfile.ZIP_STORED))
+    data[200] ^= 0xFF
+    with pytest.raises(RuntimeError):
+        _extract(tmp_path, bytes(data), 4096)
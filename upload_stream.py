@@ -0,0 +1,115 @@
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# 普通表单字段（非文件）的大小上限，超过视为请求错误，避免把大块数据缓存在内存里
+MAX_FIELD_BYTES = 64 * 1024
+
+
+class MultipartStream:
+    """增量解析 multipart/form-data 请求体，文件部分不落盘、不缓存，随数据到达直接交给调用方
+
+    feed(chunk) / finish() 返回新解析出的事件列表，顺序与请求体一致：
+      ("field", 字段名, str 值)
+      ("file_start", 字段名, 文件名)
+      ("file", 字段名, 数据块)
+      ("file_end", 字段名, None)
+    请求体格式错误时抛 ValueError。
+    """
+
+    def __init__(self, content_type):
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise ValueError("multipart 请求缺少 boundary")
+        self._events = []
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._part = None
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def feed(self, chunk):
+        self._parser.write(chunk)
+        return self._take()
+
+    def finish(self):
+        self._parser.finalize()
+        if self._part is not None:
+            raise ValueError("multipart 请求体不完整")
+        return self._take()
+
+    def _take(self):
+        events, self._events = self._events, []
+        return events
+
+    # ---------- MultipartParser 回调 ----------
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field, self._header_value = b"", b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        if filename is None:
+            self._part = {"name": name, "file": False, "value": bytearray()}
+        else:
+            self._part = {"name": name, "file": True}
+            self._events.append(("file_start", name, filename.decode("utf-8", "replace")))
+
+    def _on_part_data(self, data, start, end):
+        part = self._part
+        if part["file"]:
+            self._events.append(("file", part["name"], bytes(data[start:end])))
+            return
+        part["value"] += data[start:end]
+        if len(part["value"]) > MAX_FIELD_BYTES:
+            raise ValueError(f"表单字段过大: {part['name']}")
+
+    def _on_part_end(self):
+        part, self._part = self._part, None
+        if part["file"]:
+            self._events.append(("file_end", part["name"], None))
+        else:
+            self._events.append(("field", part["name"], part["value"].decode("utf-8", "replace")))
+
+
+async def upload_events(request):
+    """请求体 → 事件流（见 MultipartStream），边从网络读取边产出
+
+    multipart/form-data 按部分解析；其它类型（application/zip 等原始请求体）整体视为名为 file 的文件，
+    文件名为 None（由调用方从查询参数获取）。
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        parser = MultipartStream(content_type)
+        async for chunk in request.stream():
+            for event in parser.feed(chunk):
+                yield event
+        for event in parser.finish():
+            yield event
+        return
+    yield ("file_start", "file", None)
+    async for chunk in request.stream():
+        if chunk:
+            yield ("file", "file", chunk)
+    yield ("file_end", "file", None)
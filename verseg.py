@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 import os
+import time
 import torch
 from pipeline_logging import write_log
 from detectron2.config import get_cfg
@@ -8,9 +9,21 @@ from detectron2.engine import DefaultPredictor
 from detectron2.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog
 from detectron2 import model_zoo
+from model_registry import get_registry
+from pipeline_graph import file_signature
 
+CONFIG_FILE = "COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"
+WHOLE_WEIGHTS = "outputwhole/model_final.pth"
+VERTEBRA_WEIGHTS = "outputnew/model_final.pth"
+SCORE_THRESH = 0.5
+NUM_CLASSES = 1
+# CPU 部署时对 Mask R-CNN 的全连接层做动态 INT8 量化（精度差异见 scripts/quantize_models.py 的报告）
+VERSEG_QUANTIZE = os.environ.get("IDOCTOR_VERSEG_QUANTIZE", "0") == "1"
 
-def get_predictor(config_file, weights, num_classes, score_thresh=0.5):
+_PREDICTOR_REGISTRY = get_registry("detectron2")
+
+
+def get_predictor(config_file, weights, num_classes, score_thresh=0.5, quantize=False):
     """构建 detectron2 predictor"""
     cfg = get_cfg()
     cfg.merge_from_file(model_zoo.get_config_file(config_file))
@@ -24,7 +37,78 @@ def get_predictor(config_file, weights, num_classes, score_thresh=0.5):
     else:
         cfg.MODEL.DEVICE = "cpu"
 
-    return DefaultPredictor(cfg)
+    predictor = DefaultPredictor(cfg)
+    # 动态量化只有 CPU kernel，GPU 上忽略
+    if quantize and cfg.MODEL.DEVICE == "cpu":
+        from quantization import quantize_detectron2_model
+        predictor.model = quantize_detectron2_model(predictor.model)
+    return predictor
+
+
+def _predictor_key(config_file, weights, num_classes, score_thresh, quantize=False):
+    # 含权重文件签名：model_final.pth 原地替换后按新 key 重新构建，不会继续使用旧模型
+    signature = tuple(file_signature(weights) or ())
+    return (config_file, os.path.abspath(weights), signature, int(num_classes), float(score_thresh), bool(quantize))
+
+
+def cached_predictor(config_file, weights, num_classes, score_thresh=0.5, quantize=None):
+    """从进程级缓存中获取 predictor 的上下文管理器（每个 worker 只构建一次）
+
+    key = (config, weights + 文件签名, num_classes, score_thresh, quantize)；with 块内独占使用。
+    """
+    quantize = VERSEG_QUANTIZE if quantize is None else quantize
+    key = _predictor_key(config_file, weights, num_classes, score_thresh, quantize)
+    return _PREDICTOR_REGISTRY.acquire(
+        key, lambda: get_predictor(config_file, weights, num_classes, score_thresh, quantize)
+    )
+
+
+def warmup_predictors(whole_weights=WHOLE_WEIGHTS, vertebra_weights=VERTEBRA_WEIGHTS,
+                      config_file=CONFIG_FILE, num_classes=NUM_CLASSES, score_thresh=SCORE_THRESH,
+                      run_inference=True):
+    """启动时预加载两个模型，可选跑一次空白图推理（触发权重加载/算子初始化）"""
+    timings = {}
+    dummy = np.zeros((512, 512, 3), dtype=np.uint8) if run_inference else None
+    for name, weights in (("whole", whole_weights), ("vertebra", vertebra_weights)):
+        if not os.path.isfile(weights):
+            timings[name] = "missing"
+            continue
+        t0 = time.time()
+        with cached_predictor(config_file, weights, num_classes, score_thresh) as predictor:
+            if dummy is not None:
+                with torch.no_grad():
+                    predictor(dummy)
+        timings[name] = round(time.time() - t0, 2)
+    return timings
+
+
+def spine_mask(instances):
+    """整脊柱检测结果 -> 脊柱 mask（uint8）；假设只有一个脊柱实例，未检出返回 None"""
+    if len(instances) == 0:
+        return None
+    return instances.pred_masks[0].numpy().astype(np.uint8)
+
+
+def sort_vertebrae(vertebra_instances):
+    """椎体 mask 按质心 Y 坐标从上到下排序，返回 [(实例序号, centroid_y, mask)]（空 mask 跳过）"""
+    masks = vertebra_instances.pred_masks.numpy().astype(np.uint8)
+    sorted_vertebrae = []
+    for i, m in enumerate(masks):
+        ys, xs = np.where(m > 0)
+        if len(ys) == 0:
+            continue
+        centroid_y = np.mean(ys)
+        sorted_vertebrae.append((i, centroid_y, m))
+
+    sorted_vertebrae.sort(key=lambda x: x[1])
+    return sorted_vertebrae
+
+
+def select_l3_mask(sorted_vertebrae):
+    """从排序后的椎体中取 L3（第3个）；不足 3 个返回 None"""
+    if len(sorted_vertebrae) < 3:
+        return None
+    return sorted_vertebrae[2][2]
 
 
 def process_spine_and_vertebrae(
@@ -58,30 +142,26 @@ def process_spine_and_vertebrae(
     log_root = os.path.dirname(output_dir) if os.path.dirname(output_dir) else output_dir
     write_log(log_root, f"[Vertebra] START img={img_path} whole_weights={whole_weights} vertebra_weights={vertebra_weights}")
 
-    config_file="COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"
-    score_thresh=0.5
-    num_classes=1
-
-    # === 加载两个模型 ===
-    whole_predictor = get_predictor(config_file, whole_weights, num_classes, score_thresh)
-    vertebra_predictor = get_predictor(config_file, vertebra_weights, num_classes, score_thresh)
+    config_file = CONFIG_FILE
+    score_thresh = SCORE_THRESH
+    num_classes = NUM_CLASSES
 
-    # === 第一步：检测整条脊柱 ===
-    whole_outputs = whole_predictor(im)
+    # === 第一步：检测整条脊柱（模型来自进程级缓存，只在首次调用时构建） ===
+    with cached_predictor(config_file, whole_weights, num_classes, score_thresh) as whole_predictor:
+        whole_outputs = whole_predictor(im)
     instances = whole_outputs["instances"].to("cpu")
 
-    if len(instances) == 0:
+    mask = spine_mask(instances)
+    if mask is None:
         write_log(log_root, "[Vertebra] NO_SPINE_DETECTED")
         raise ValueError("未检测到脊柱！")
 
-    # 假设只有一个脊柱实例
-    mask = instances.pred_masks[0].numpy().astype(np.uint8)
-
     # === 用 mask 裁剪出脊柱区域 ===
     spine_crop = cv2.bitwise_and(im, im, mask=mask)
 
     # === 第二步：检测椎体 ===
-    vertebra_outputs = vertebra_predictor(spine_crop)
+    with cached_predictor(config_file, vertebra_weights, num_classes, score_thresh) as vertebra_predictor:
+        vertebra_outputs = vertebra_predictor(spine_crop)
     vertebra_instances = vertebra_outputs["instances"].to("cpu")
     write_log(log_root, f"[Vertebra] vertebra_detected={len(vertebra_instances)}")
 
@@ -101,16 +181,7 @@ def process_spine_and_vertebrae(
     cv2.imwrite(os.path.join(output_dir, f"{base_name}_vertebra.png"), out2.get_image()[:, :, ::-1])
 
     # === 提取每个椎体 mask 并按Y坐标排序 ===
-    masks = vertebra_instances.pred_masks.numpy().astype(np.uint8)
-    sorted_vertebrae = []
-    for i, m in enumerate(masks):
-        ys, xs = np.where(m > 0)
-        if len(ys) == 0:
-            continue
-        centroid_y = np.mean(ys)
-        sorted_vertebrae.append((i, centroid_y, m))
-
-    sorted_vertebrae.sort(key=lambda x: x[1])
+    sorted_vertebrae = sort_vertebrae(vertebra_instances)
 
     for idx, (i, cy, m) in enumerate(sorted_vertebrae):
         label = f"L{idx+1}"
@@ -128,8 +199,7 @@ def process_spine_and_vertebrae(
     write_log(log_root, f"[Vertebra] overlays_saved output_dir={output_dir}")
     
     # === ✅ 仅提取并返回 L3 相关结果（返回路径，不再重复保存） ===
-    if len(sorted_vertebrae) >= 3:
-        _, _, L3_mask_array = sorted_vertebrae[2]  # 第3个是L3
+    if select_l3_mask(sorted_vertebrae) is not None:
         label = "L3"
 
         base_name = os.path.splitext(os.path.basename(img_path))[0]
@@ -0,0 +1,94 @@
+import threading
+import numpy as np
+
+# 肌肉分割 / L3 定位统一使用的 HU 窗口（-100 ~ 200 线性映射到 0 ~ 255）
+HU_WINDOW = (-100, 200)
+
+_LUTS = {}
+_LUT_LOCK = threading.Lock()
+
+
+def _window_float(values, slope, intercept, window, zero_to):
+    """逐像素 float32 计算：float32(v) * slope + intercept → clip → 线性归一 → uint8
+
+    与原 dicom_to_uint8 / hu_to_uint8 / dicom_to_balanced_png 的运算顺序完全一致，查找表也由它生成。
+    """
+    hu = np.asarray(values).astype(np.float32)
+    if slope != 1 or intercept != 0:
+        hu = hu * slope + intercept
+    min_val, max_val = window
+    hu_clipped = np.clip(hu, min_val, max_val)
+    hu_norm = ((hu_clipped - min_val) / (max_val - min_val)) * 255.0
+    out = np.clip(hu_norm, 0, 255).astype(np.uint8)
+    if zero_to is not None:
+        out[out == 0] = zero_to
+    return out
+
+
+def window_lut(dtype, slope=1.0, intercept=0.0, window=HU_WINDOW, zero_to=None):
+    """16 位像素 → uint8 的查找表（65536 项），按 (dtype, slope, intercept, window, zero_to) 缓存
+
+    下标为像素值按 uint16 重新解释后的位模式，int16 与 uint16 都能直接 view 后查表。
+    """
+    dtype = np.dtype(dtype)
+    key = (dtype.str, float(slope), float(intercept), tuple(window), zero_to)
+    lut = _LUTS.get(key)
+    if lut is None:
+        values = np.arange(65536, dtype=np.uint16).view(dtype)
+        lut = _window_float(values, slope, intercept, window, zero_to)
+        lut.flags.writeable = False
+        with _LUT_LOCK:
+            lut = _LUTS.setdefault(key, lut)
+    return lut
+
+
+def _lut_dtype(arr):
+    if arr.dtype in (np.int16, np.uint16):
+        return arr
+    if arr.dtype in (np.int8, np.uint8):
+        return arr.astype(np.int16)
+    if arr.dtype.kind in "iu" and arr.size and arr.min() >= -32768 and arr.max() <= 32767:
+        return arr.astype(np.int16)
+    return None
+
+
+def apply_window(pixels, slope=1.0, intercept=0.0, window=HU_WINDOW, zero_to=None, out=None):
+    """像素（存储值或 HU）→ uint8 窗宽图像
+
+    16 位整数输入一次查表完成（out 给定时不再分配内存）；浮点输入（非整数 HU）退回逐像素计算，结果相同。
+    """
+    pixels = np.asarray(pixels)
+    src = _lut_dtype(pixels)
+    if src is None:
+        result = _window_float(pixels, slope, intercept, window, zero_to)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+    lut = window_lut(src.dtype, slope, intercept, window, zero_to)
+    return np.take(lut, src.view(np.uint16), out=out)
+
+
+def apply_window_stack(slices, slope=1.0, intercept=0.0, window=HU_WINDOW, zero_to=None):
+    """整叠切片一次加窗，返回 [N, H, W] uint8
+
+    slices 可以是 [N, H, W] 数组或同尺寸切片列表；尺寸不一致时逐张处理并返回列表。
+    """
+    if isinstance(slices, np.ndarray):
+        return apply_window(slices, slope, intercept, window, zero_to)
+    slices = list(slices)
+    if not slices:
+        return np.empty((0, 0, 0), dtype=np.uint8)
+    if len({s.shape for s in slices}) != 1:
+        return [apply_window(s, slope, intercept, window, zero_to) for s in slices]
+    out = np.empty((len(slices),) + slices[0].shape, dtype=np.uint8)
+    for i, s in enumerate(slices):
+        apply_window(s, slope, intercept, window, zero_to, out=out[i])
+    return out
+
+
+def dataset_to_uint8(ds, window=HU_WINDOW, zero_to=None):
+    """pydicom Dataset 直接按 RescaleSlope / RescaleIntercept 查表加窗，不生成中间的 float32 HU 图"""
+    slope = float(ds.get("RescaleSlope", 1))
+    intercept = float(ds.get("RescaleIntercept", 0))
+    return apply_window(ds.pixel_array, slope, intercept, window, zero_to)
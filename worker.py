@@ -0,0 +1,319 @@
+import os
+import time
+import json
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing as mp
+
+from job_queue import get_job_queue, JOB_LEASE_SECONDS, KIND_PRIORITY
+from admission import get_admission_controller, get_interactive_admission_controller
+from pipeline_logging import write_log
+from pipeline_graph import PipelineAborted
+from dicom_series import input_signature
+from all_new import main, continue_after_l3, l3_detect, read_inference_meta
+
+try:
+    import psutil  # optional for memory diagnostics
+except ImportError:  # graceful fallback
+    psutil = None
+
+# API 进程内启动的 worker 线程数（同时执行的任务上限，实际并发再由 admission 按资源预算限制）；
+# 单独运行 worker.py 时设为 0，API 只负责入队
+EMBEDDED_WORKERS = int(os.environ.get("IDOCTOR_EMBEDDED_WORKERS", "1"))
+# 另外启动的交互通道线程数：只领取交互类任务（/l3_detect），使用单独的小预算（admission.INTERACTIVE_MEM_BUDGET_MB），
+# 保证长时间的全流程任务占满 worker 时 L3 检测仍能立即执行，同时交互通道本身的内存占用有上限
+INTERACTIVE_WORKERS = int(os.environ.get("IDOCTOR_INTERACTIVE_WORKERS", "1"))
+# 续约间隔（秒），默认为租约的 1/4
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("IDOCTOR_JOB_HEARTBEAT_SECONDS", str(JOB_LEASE_SECONDS / 4)))
+# 队列为空时的轮询间隔（秒）
+JOB_POLL_SECONDS = float(os.environ.get("IDOCTOR_JOB_POLL_SECONDS", "1"))
+# 两次进度写库之间的最短间隔（秒）
+PROGRESS_FLUSH_SECONDS = 1.0
+DEBUG_ENABLED = os.environ.get("IDOCTOR_DEBUG", "1") not in ("0", "false", "False")
+
+# 分割推理在任务总进度中占的区间（之前为读取 DICOM / 定位 L3，之后为统计与出图）
+INFERENCE_PROGRESS_RANGE = (10, 90)
+# 各阶段开始时的进度与提示
+STAGE_PROGRESS = {
+    "load": (2, "读取 DICOM"),
+    "sagittal": (4, "生成矢状面"),
+    "vertebra": (6, "椎体检测"),
+    "l3_clean": (8, "L3 mask 清理"),
+    "axial_select": (9, "横断面选取"),
+    "psoas_seg": (10, "腰大肌分割"),
+    "full_seg": (10, "全肌肉分割"),
+    "metrics": (90, "统计与出图"),
+}
+
+
+def _debug_log(output_folder, line):
+    print(line, flush=True)
+    write_log(output_folder, line, filename="pipeline_debug.log")
+
+
+def _resource_snapshot():
+    snap = {}
+    if psutil:
+        p = psutil.Process()
+        with p.oneshot():
+            mem = p.memory_info()
+            snap["rss_mb"] = round(mem.rss / 1024 / 1024, 2)
+            snap["cpu_percent"] = p.cpu_percent(interval=None)
+            snap["num_threads"] = p.num_threads()
+            snap["open_files"] = len(p.open_files())
+    return snap
+
+
+class LeaseLost(PipelineAborted):
+    """任务租约已失效（已被回收，可能正由其它 worker 重新执行），当前执行必须停止"""
+
+
+class JobReporter:
+    """任务执行期间的续约与进度上报
+
+    后台线程每 JOB_HEARTBEAT_SECONDS 续约一次；进度 / 阶段变化时至多每秒写一次库。
+    续约失败（租约已过期、任务被回收）时 lease_lost 置位，之后的阶段 / 进度回调抛出 LeaseLost，
+    中止流水线，避免与接手的 worker 同时写同一病例的产物。
+    """
+
+    def __init__(self, queue, job, worker_id, kinds=None):
+        self.queue = queue
+        self.job = job
+        self.worker_id = worker_id
+        self.kinds = kinds
+        self.lease_lost = False
+        self._fields = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f"job-{job['id']}-heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def check_lease(self):
+        if self.lease_lost:
+            raise LeaseLost(f"任务 {self.job['task_id']} 租约已失效，停止执行")
+
+    def update(self, force=False, **fields):
+        self.check_lease()
+        with self._lock:
+            self._fields.update(fields)
+            if not force and time.time() - self._last_flush < PROGRESS_FLUSH_SECONDS:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            fields, self._fields = self._fields, {}
+            self._last_flush = time.time()
+        ok = self.queue.heartbeat(self.job["id"], self.worker_id, **fields)
+        if not ok and not self.lease_lost:
+            self.lease_lost = True
+            print(f"[WORKER {self.worker_id}] 任务 {self.job['task_id']} 租约已失效", flush=True)
+
+    def _beat(self):
+        while not self._stop.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                self.flush()
+                self.queue.worker_seen(self.worker_id, self.kinds)
+            except Exception as e:
+                print(f"[WORKER {self.worker_id}] 续约失败: {e}", flush=True)
+
+    # ---------- 传给流水线的回调 ----------
+    def on_stage(self, name, state):
+        self.check_lease()
+        if state != "run" or name not in STAGE_PROGRESS:
+            return
+        progress, label = STAGE_PROGRESS[name]
+        self.update(force=True, stage=name, progress=progress, message=f"{label}...")
+
+    def inference_progress(self, event):
+        """推理循环上报的切片进度 → 任务进度（见 inference_progress.InferenceProgress）"""
+        lo, hi = INFERENCE_PROGRESS_RANGE
+        eta = event.get("eta_seconds")
+        self.update(
+            progress=int(lo + (hi - lo) * event["fraction"]),
+            message=(f"分割推理中 {event['slices_done']}/{event['slices_total']} 张切片，"
+                     f"{event['throughput']} 张/秒" + (f"，预计剩余 {eta:.0f} 秒" if eta is not None else "")),
+            extra={"inference_progress": event},
+        )
+
+
+def run_main_job(job, reporter):
+    """全流程（/process）"""
+    task_id, payload = job["task_id"], job["payload"]
+    input_folder, output_folder, profile = payload["input_folder"], payload["output_folder"], payload.get("profile")
+    if DEBUG_ENABLED:
+        _debug_log(output_folder, f"[TASK {task_id}] ===== 开始 main() input={input_folder} attempt={job['attempts']}")
+        inp_sig = input_signature(input_folder) if os.path.isdir(input_folder) else {"error": "input_missing"}
+        _debug_log(output_folder, f"[TASK {task_id}] 输入签名 {json.dumps(inp_sig, ensure_ascii=False)}")
+        _debug_log(output_folder, f"[TASK {task_id}] 资源快照(before) {_resource_snapshot()}")
+        if os.path.isdir(output_folder):
+            _debug_log(output_folder, f"[TASK {task_id}] 现有output子项目: {os.listdir(output_folder)}")
+    main(input_folder, output_folder, profile=profile, progress=reporter.inference_progress,
+         force=payload.get("force", False), on_stage=reporter.on_stage)
+    if DEBUG_ENABLED:
+        _debug_log(output_folder, f"[TASK {task_id}] main() 完成 资源after={_resource_snapshot()}")
+    result = {"output_dir": output_folder, "inference": read_inference_meta(output_folder)}
+    return result, "全流程处理完成"
+
+
+def run_l3_job(job, reporter):
+    """L3 检测（/l3_detect，接口同步等待结果）"""
+    payload = job["payload"]
+    return l3_detect(payload["input_folder"], payload["output_folder"]), "L3 检测完成"
+
+
+def run_continue_job(job, reporter):
+    """L3 确认后的后续流程（/continue_after_l3）"""
+    task_id, payload = job["task_id"], job["payload"]
+    input_folder, output_folder, profile = payload["input_folder"], payload["output_folder"], payload.get("profile")
+    if DEBUG_ENABLED:
+        _debug_log(output_folder, f"[TASK {task_id}] ===== 开始 continue_after_l3() input={input_folder}")
+        if os.path.isdir(output_folder):
+            _debug_log(output_folder, f"[TASK {task_id}] output初始: {os.listdir(output_folder)}")
+    reporter.update(force=True, progress=10, message="正在读取 DICOM 和 L3 mask...")
+    result = continue_after_l3(input_folder, output_folder, profile=profile,
+                               progress=reporter.inference_progress, on_stage=reporter.on_stage)
+    if DEBUG_ENABLED:
+        _debug_log(output_folder, f"[TASK {task_id}] continue_after_l3() 完成")
+    return {"result": result}, "处理完成"
+
+
+# 任务类型 → 处理函数 handler(job, reporter) -> (结果字典, 完成提示)
+JOB_HANDLERS = {
+    "main": run_main_job,
+    "continue_after_l3": run_continue_job,
+    "l3_detect": run_l3_job,
+}
+INTERACTIVE_KINDS = [k for k in JOB_HANDLERS if KIND_PRIORITY.get(k) == "interactive"]
+
+
+class Worker:
+    def __init__(self, worker_id=None, queue=None, kinds=None, admission=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.queue = queue or get_job_queue()
+        self.kinds = list(kinds) if kinds else list(JOB_HANDLERS)
+        self.admission = admission or get_admission_controller()
+        self._seen_at = 0.0
+
+    def mark_alive(self):
+        """空闲轮询时每 JOB_HEARTBEAT_SECONDS 报告一次存活（执行任务期间由 JobReporter 报告）"""
+        if time.time() - self._seen_at >= JOB_HEARTBEAT_SECONDS:
+            self.queue.worker_seen(self.worker_id, self.kinds)
+            self._seen_at = time.time()
+
+    def run_once(self):
+        """领取并执行一个任务；队列为空或队首任务放不进资源预算时返回 False"""
+        job = self.queue.claim(self.worker_id, self.kinds, admission=self.admission)
+        if job is None:
+            self._note_blocked()
+            return False
+        try:
+            self.execute(job)
+        finally:
+            self.admission.release(job["id"])
+        return True
+
+    def _note_blocked(self):
+        """把等待资源的原因写到队首任务上（/task_status 中显示），原因不变时不重复写"""
+        blocked = self.admission.blocked
+        if blocked is None or blocked == self.admission.noted:
+            return
+        self.admission.noted = blocked
+        self.queue.annotate(*blocked)
+
+    def execute(self, job):
+        task_id = job["task_id"]
+        output_folder = (job["payload"] or {}).get("output_folder")
+        print(f"[WORKER {self.worker_id}] 开始 {task_id} job={job['id']} attempt={job['attempts']}", flush=True)
+        reporter = JobReporter(self.queue, job, self.worker_id, self.kinds)
+        reporter.start()
+        start = time.time()
+        try:
+            result, message = JOB_HANDLERS[job["kind"]](job, reporter)
+            reporter.stop()
+            if not self.queue.complete(job["id"], self.worker_id, result, message=message):
+                print(f"[WORKER {self.worker_id}] {task_id} 已完成但租约失效，结果未写回", flush=True)
+            print(f"[WORKER {self.worker_id}] 完成 {task_id} 耗时={time.time()-start:.2f}s", flush=True)
+        except LeaseLost as e:
+            # 任务已归还队列，不再写失败状态，由重新领取的 worker 负责
+            reporter.stop()
+            print(f"[WORKER {self.worker_id}] 中止 {task_id}: {e}", flush=True)
+        except Exception as e:
+            reporter.stop()
+            tb = traceback.format_exc()
+            if DEBUG_ENABLED and output_folder:
+                _debug_log(output_folder, f"[TASK {task_id}] 异常: {e}\n{tb}")
+            print(f"[WORKER {self.worker_id}] 失败 {task_id}: {e}", flush=True)
+            self.queue.fail(job["id"], self.worker_id, str(e))
+
+    def run_forever(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.mark_alive()
+                if self.run_once():
+                    continue
+            except Exception as e:
+                print(f"[WORKER {self.worker_id}] 领取任务失败: {e}", flush=True)
+            stop_event.wait(JOB_POLL_SECONDS)
+
+
+def _interactive_workers(base, count):
+    """交互通道：只领取 INTERACTIVE_KINDS，所有交互线程共用进程级的交互小预算"""
+    admission = get_interactive_admission_controller()
+    return [Worker(worker_id=f"{base}:interactive-{i}", kinds=INTERACTIVE_KINDS, admission=admission)
+            for i in range(count)]
+
+
+def start_embedded_workers(count=EMBEDDED_WORKERS, stop_event=None, interactive=INTERACTIVE_WORKERS):
+    """在当前进程（API）中启动 count 个 worker 线程，外加 interactive 个交互通道线程"""
+    threads = []
+    base = f"{socket.gethostname()}:{os.getpid()}"
+    workers = [Worker(worker_id=f"{base}:embedded-{i}") for i in range(count)]
+    workers += _interactive_workers(base, interactive)
+    for i, worker in enumerate(workers):
+        t = threading.Thread(target=worker.run_forever, args=(stop_event,), name=f"job-worker-{i}", daemon=True)
+        t.start()
+        threads.append(t)
+    return threads
+
+
+if __name__ == "__main__":
+    try:
+        mp.set_start_method("spawn", force=True)
+    except RuntimeError:
+        pass
+
+    parser = argparse.ArgumentParser(description="从任务队列领取并执行流水线任务")
+    parser.add_argument("--concurrency", type=int, default=1, help="本进程同时执行的任务数")
+    parser.add_argument("--kinds", default=",".join(JOB_HANDLERS), help="只领取这些类型的任务（逗号分隔）")
+    parser.add_argument("--interactive", type=int, default=0, help="另外启动的交互通道线程数（只领取 L3 检测）")
+    args = parser.parse_args()
+
+    kinds = [k for k in args.kinds.split(",") if k]
+    base = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    runners = [Worker(worker_id=f"{base}:{i}", kinds=kinds) for i in range(max(1, args.concurrency))]
+    runners += _interactive_workers(base, args.interactive)
+    workers = [threading.Thread(target=w.run_forever, args=(stop,), name=f"job-worker-{i}")
+               for i, w in enumerate(runners)]
+    print(f"[WORKER] 启动 {len(workers)} 个 worker kinds={kinds}", flush=True)
+    for t in workers:
+        t.start()
+    try:
+        while any(t.is_alive() for t in workers):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("[WORKER] 收到中断，当前任务完成后退出", flush=True)
+        stop.set()
+        for t in workers:
+            t.join()
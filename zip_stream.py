@@ -0,0 +1,298 @@
+import os
+import struct
+import zipfile
+import zlib
+
+# 上传 ZIP 边接收边解压：1 = 按本地文件头流式解压（默认），0 = 先完整落盘再用 zipfile 解压
+UPLOAD_STREAM_UNZIP = os.environ.get("IDOCTOR_UPLOAD_STREAM_UNZIP", "1") not in ("0", "false", "False")
+
+_LOCAL_HEADER = b"PK\x03\x04"
+_DATA_DESCRIPTOR = b"PK\x07\x08"
+# 中央目录 / ZIP64 结束记录 / 结束记录：出现即说明所有成员的数据都已经过去
+_ARCHIVE_TAIL = (b"PK\x01\x02", b"PK\x06\x06", b"PK\x06\x07", b"PK\x05\x06")
+_LOCAL_HEADER_STRUCT = struct.Struct("<4sHHHHHIIIHH")
+_ZIP64_EXTRA_ID = 0x0001
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_FLAG_UTF8 = 0x800
+
+
+def member_filename(name):
+    """ZIP 内路径 → 写入 input 目录的文件名（只保留 basename，目录项返回 None）"""
+    base = os.path.basename(name)
+    if not base or base in (".", ".."):
+        return None
+    return base
+
+
+def extract_zip(zip_path, out_dir, min_offset=0, on_member=None):
+    """用中央目录解压 zip_path 中的成员（平铺到 out_dir）
+
+    min_offset > 0 时跳过本地头位于该偏移之前的成员（流式阶段已经写出）。返回写出的文件名列表。
+    on_member: 每写完一个文件调用 on_member(文件名)
+    """
+    written = []
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for info in zf.infolist():
+            base = member_filename(info.filename)
+            if base is None or info.header_offset < min_offset:
+                continue
+            with zf.open(info) as src, open(os.path.join(out_dir, base), "wb") as dst:
+                while True:
+                    buf = src.read(1024 * 1024)
+                    if not buf:
+                        break
+                    dst.write(buf)
+            written.append(base)
+            if on_member is not None:
+                on_member(base)
+    return written
+
+
+class _NeedFallback(Exception):
+    pass
+
+
+class StreamingZipExtractor:
+    """按本地文件头边接收边解压 ZIP，成员直接写入 out_dir
+
+    feed(chunk) 随上传数据调用，finish() 在接收完成后调用。
+    遇到流式无法处理的成员（加密、非 stored/deflate、stored + 数据描述符、未知记录）时，
+    从该成员的本地头开始把后续字节写入 spool_path（文件中前面的部分为空洞，偏移与原 ZIP 一致），
+    finish() 再按中央目录解压剩余成员。
+    on_member: 每写完（并校验完）一个文件调用 on_member(文件名)，例如上传时解析 DICOM 头
+    """
+
+    def __init__(self, out_dir, spool_path, on_member=None):
+        self.out_dir = out_dir
+        self.spool_path = spool_path
+        self.on_member = on_member
+        self.members = []
+        self.mode = "stream"
+        self._buf = bytearray()
+        self._offset = 0          # _buf[0] 在 ZIP 中的绝对偏移
+        self._state = "header"
+        self._member = None
+        self._out = None
+        self._spool = None
+        self._spool_start = None
+
+    # ---------- 接收 ----------
+    def feed(self, chunk):
+        if self._spool is not None:
+            self._spool.write(chunk)
+            return
+        if self._state == "done":
+            return
+        self._buf += chunk
+        try:
+            self._drain(final=False)
+        except _NeedFallback:
+            self._start_spool()
+
+    def finish(self):
+        """返回写出的文件名列表；ZIP 不完整或损坏时抛 RuntimeError"""
+        if self._spool is None and self._state != "done":
+            try:
+                self._drain(final=True)
+            except _NeedFallback:
+                self._start_spool()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+            self.members += extract_zip(self.spool_path, self.out_dir, min_offset=self._spool_start,
+                                        on_member=self.on_member)
+            return self.members
+        if self._state != "done":
+            raise RuntimeError("ZIP 数据不完整")
+        return self.members
+
+    def close(self):
+        """释放文件句柄并删除 spool 文件（成功或失败后都应调用）"""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if os.path.isfile(self.spool_path):
+            try:
+                os.remove(self.spool_path)
+            except OSError:
+                pass
+
+    # ---------- 解析 ----------
+    def _consume(self, n):
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        self._offset += n
+        return data
+
+    def _drain(self, final):
+        while True:
+            if self._state == "header":
+                if not self._read_header(final):
+                    return
+            elif self._state == "data":
+                if not self._read_data():
+                    return
+            elif self._state == "descriptor":
+                if not self._read_descriptor(final):
+                    return
+            else:
+                return
+
+    def _read_header(self, final):
+        if len(self._buf) < 4:
+            if final and self._buf:
+                raise _NeedFallback()
+            return False
+        sig = bytes(self._buf[:4])
+        if sig in _ARCHIVE_TAIL:
+            self._state = "done"
+            self._buf.clear()
+            return False
+        if sig != _LOCAL_HEADER:
+            raise _NeedFallback()
+        if len(self._buf) < _LOCAL_HEADER_STRUCT.size:
+            return False
+        (_, _, flags, method, _, _, crc, comp_size, size,
+         name_len, extra_len) = _LOCAL_HEADER_STRUCT.unpack_from(self._buf)
+        header_len = _LOCAL_HEADER_STRUCT.size + name_len + extra_len
+        if len(self._buf) < header_len:
+            return False
+        if flags & _FLAG_ENCRYPTED or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise _NeedFallback()
+        if flags & _FLAG_DATA_DESCRIPTOR and method == zipfile.ZIP_STORED:
+            raise _NeedFallback()
+
+        raw_name = bytes(self._buf[_LOCAL_HEADER_STRUCT.size:_LOCAL_HEADER_STRUCT.size + name_len])
+        extra = bytes(self._buf[_LOCAL_HEADER_STRUCT.size + name_len:header_len])
+        name = raw_name.decode("utf-8" if flags & _FLAG_UTF8 else "cp437")
+        zip64 = False
+        if comp_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            zip64 = True
+            size, comp_size = _zip64_sizes(extra, size, comp_size)
+        elif _find_extra(extra, _ZIP64_EXTRA_ID) is not None:
+            zip64 = True
+
+        self._consume(header_len)
+        has_descriptor = bool(flags & _FLAG_DATA_DESCRIPTOR)
+        base = member_filename(name)
+        self._member = {
+            "name": base,
+            "method": method,
+            "descriptor": has_descriptor,
+            "zip64": zip64,
+            "crc": crc,
+            "size": size,
+            "remaining": None if has_descriptor else comp_size,
+            "crc_actual": 0,
+            "size_actual": 0,
+            "decomp": zlib.decompressobj(-zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else None,
+        }
+        self._out = open(os.path.join(self.out_dir, base), "wb") if base else None
+        self._state = "data"
+        return True
+
+    def _write(self, data):
+        if not data:
+            return
+        m = self._member
+        m["crc_actual"] = zlib.crc32(data, m["crc_actual"])
+        m["size_actual"] += len(data)
+        if self._out is not None:
+            self._out.write(data)
+
+    def _read_data(self):
+        m = self._member
+        if not self._buf and m["remaining"] != 0:
+            return False
+        if m["remaining"] is None:
+            # deflate + 数据描述符：压缩长度未知，由 deflate 流自身的结束标记判断
+            n = len(self._buf)
+            data = self._consume(n)
+            out = m["decomp"].decompress(data)
+            self._write(out)
+            if not m["decomp"].eof:
+                return False
+            unused = m["decomp"].unused_data
+            self._buf[:0] = unused
+            self._offset -= len(unused)
+        else:
+            n = min(m["remaining"], len(self._buf))
+            data = self._consume(n)
+            m["remaining"] -= n
+            self._write(m["decomp"].decompress(data) if m["decomp"] else data)
+            if m["remaining"]:
+                return False
+            if m["decomp"]:
+                self._write(m["decomp"].flush())
+        if m["descriptor"]:
+            self._state = "descriptor"
+        else:
+            self._finish_member(m["crc"], m["size"])
+        return True
+
+    def _read_descriptor(self, final):
+        m = self._member
+        skip = 4 if bytes(self._buf[:4]) == _DATA_DESCRIPTOR else 0
+        length = skip + (20 if m["zip64"] else 12)
+        if len(self._buf) < length:
+            if final:
+                raise RuntimeError("ZIP 数据不完整")
+            return False
+        crc, = struct.unpack_from("<I", self._buf, skip)
+        if m["zip64"]:
+            _, size = struct.unpack_from("<QQ", self._buf, skip + 4)
+        else:
+            _, size = struct.unpack_from("<II", self._buf, skip + 4)
+        self._consume(length)
+        self._finish_member(crc, size)
+        return True
+
+    def _finish_member(self, crc, size):
+        m = self._member
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        if m["crc_actual"] != crc or m["size_actual"] != size:
+            raise RuntimeError(f"ZIP 成员校验失败: {m['name']}")
+        if m["name"]:
+            self.members.append(m["name"])
+            if self.on_member is not None:
+                self.on_member(m["name"])
+        self._member = None
+        self._state = "header"
+
+    def _start_spool(self):
+        """切换到回退模式：从当前未处理字节的绝对偏移开始写 spool（之前的部分留作稀疏空洞）"""
+        if self._state != "header":
+            raise RuntimeError("ZIP 成员数据无法解析")
+        self.mode = "fallback"
+        self._spool_start = self._offset
+        self._spool = open(self.spool_path, "wb")
+        self._spool.seek(self._offset)
+        self._spool.write(self._buf)
+        self._buf.clear()
+
+
+def _find_extra(extra, header_id):
+    pos = 0
+    while pos + 4 <= len(extra):
+        hid, size = struct.unpack_from("<HH", extra, pos)
+        if hid == header_id:
+            return extra[pos + 4:pos + 4 + size]
+        pos += 4 + size
+    return None
+
+
+def _zip64_sizes(extra, size, comp_size):
+    data = _find_extra(extra, _ZIP64_EXTRA_ID) or b""
+    pos = 0
+    if size == 0xFFFFFFFF and pos + 8 <= len(data):
+        size, = struct.unpack_from("<Q", data, pos)
+        pos += 8
+    if comp_size == 0xFFFFFFFF and pos + 8 <= len(data):
+        comp_size, = struct.unpack_from("<Q", data, pos)
+    return size, comp_size